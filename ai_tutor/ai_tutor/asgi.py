@@ -3,6 +3,11 @@ ASGI config for ai_tutor project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve l'endpoint asincrono /api/llm/async (e /api/llm con LLM_API_MODE=async)
+senza bloccare un thread per ogni stream, ad esempio con:
+
+    uvicorn ai_tutor.asgi:application --workers 2
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
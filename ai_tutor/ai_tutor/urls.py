@@ -23,9 +23,16 @@ from home import views
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.homepage, name='homepage'),
-    path('api/llm', views.llm_api, name='llm_api'),
+    # /api/llm usa la variante selezionata da LLM_API_MODE; le altre due sono sempre disponibili
+    path('api/llm', views.llm_api_async if settings.LLM_API_MODE == 'async' else views.llm_api, name='llm_api'),
+    path('api/llm/sync', views.llm_api, name='llm_api_sync'),
+    path('api/llm/async', views.llm_api_async, name='llm_api_async'),
+    path('api/llm/stream/<str:turn_id>', views.resume_llm_stream, name='resume_llm_stream'),
     path('api/configurations', views.get_configurations, name='get_configurations'),
     path('api/session/<str:session_id>/history', views.get_session_history, name='get_session_history'),
+    path('api/messages/search', views.search_chat_messages, name='search_chat_messages'),
+    path('api/usage', views.get_token_usage, name='get_token_usage'),
+    path('metrics', views.metrics, name='metrics'),
 ]
 
 # Serve static files in development
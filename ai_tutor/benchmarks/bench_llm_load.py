@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark end-to-end di /api/llm sotto carico, completamente offline.
+
+Avvia il server finto di fake_openai_server.py in un processo separato, crea
+una LLMConfiguration con base_url puntato sul server e simula N sessioni
+concorrenti di più turni attraverso l'intero stack Django (middleware, view,
+ORM su un database SQLite temporaneo configurato via DATABASE_URL).
+
+Per ogni esecuzione riporta:
+- TTFT: tempo dalla richiesta al primo evento con contenuto (p50/p99)
+- latenza del turno fino a [DONE] (p50/p99)
+- throughput (turni/s e token/s) ed errori
+- query al database per turno
+- frame e byte SSE per turno, CPU del processo Django per token
+  (confronto dell'accorpamento dei frame: --coalesce-ms 0 = un frame per token)
+
+Uso:
+    python benchmarks/bench_llm_load.py --sessions 20 --turns 4 --mode sync
+    python benchmarks/bench_llm_load.py --mode async --first-token-ms 500 --error-rate 0.05
+    python benchmarks/bench_llm_load.py --token-ms 5 --coalesce-ms 0
+    python benchmarks/bench_llm_load.py --response-cache
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+BENCH_DIR = Path(__file__).resolve().parent
+
+PROMPTS = [
+    "scrivi un articolo sul clima",
+    "per studenti delle scuole medie",
+    "circa 600 parole con un tono semplice",
+    "voglio che spieghi cause e conseguenze",
+    "sì, va bene così",
+    "aggiungi qualche esempio pratico",
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_fake_server(args):
+    """Avvia il server finto in un processo separato (non compete per il GIL con Django)"""
+    process = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / 'fake_openai_server.py'), '0',
+         str(args.first_token_ms), str(args.token_ms), str(args.tokens), str(args.error_rate)],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    base_url = line.split(' su ', 1)[1].split(' ', 1)[0]
+    return process, base_url
+
+
+def setup_django(database_path, args):
+    os.environ['DATABASE_URL'] = f"sqlite:///{database_path}"
+    if args.coalesce_ms is not None:
+        os.environ['SSE_COALESCE_MS'] = str(args.coalesce_ms)
+    if args.coalesce_bytes is not None:
+        os.environ['SSE_COALESCE_BYTES'] = str(args.coalesce_bytes)
+    os.environ.setdefault('TRACING_EXPORTER', 'none')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai_tutor.settings')
+    sys.path.insert(0, str(PROJECT_DIR))
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    # Aggiunge 'testserver' ad ALLOWED_HOSTS per il client di test
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+
+
+class QueryCounter:
+    """Conta le query eseguite su tutte le connessioni (anche quelle aperte dai thread)"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connection
+        from django.db.backends.signals import connection_created
+
+        connection.ensure_connection()
+        connection.execute_wrappers.append(self)
+        connection_created.connect(self.on_connection_created, weak=False)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        # Il segnale arriva a ogni riconnessione (le connessioni si chiudono a fine richiesta)
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class TurnStats:
+    def __init__(self):
+        self.ttft = []
+        self.latency = []
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, reader, latency):
+        with self._lock:
+            if reader.ttft is not None:
+                self.ttft.append(reader.ttft)
+            self.latency.append(latency)
+            self.frames += reader.frames
+            self.bytes += reader.size
+            self.errors += int(reader.error)
+
+
+class TurnReader:
+    """Interpreta gli eventi SSE di un turno man mano che arrivano"""
+
+    def __init__(self, started):
+        self.started = started
+        self.buffer = ''
+        self.session_id = None
+        self.ttft = None
+        self.frames = 0
+        self.size = 0
+        self.error = False
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        self.buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while '\n\n' in self.buffer:
+            event, self.buffer = self.buffer.split('\n\n', 1)
+            data = next((line[len('data: '):] for line in event.split('\n') if line.startswith('data: ')), '')
+            if not data or data == '[DONE]':
+                continue
+            payload = json.loads(data)
+            self.session_id = self.session_id or payload.get('session_id')
+            content = payload.get('content')
+            if not content:
+                continue
+            if content.startswith('Errore:'):
+                self.error = True
+                continue
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self.started
+            self.frames += 1
+
+
+def run_sync(args, stats):
+    from django.db import connection
+    from django.test import Client
+
+    def session():
+        client = Client()
+        session_id = None
+        try:
+            for turn in range(args.turns):
+                started = time.perf_counter()
+                response = client.post(
+                    '/api/llm/sync',
+                    json.dumps({"prompt": PROMPTS[turn % len(PROMPTS)], "session_id": session_id}),
+                    content_type='application/json'
+                )
+                reader = TurnReader(started)
+                for chunk in response.streaming_content:
+                    reader.feed(chunk)
+                response.close()
+                session_id = session_id or reader.session_id
+                stats.record(reader, time.perf_counter() - started)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        for future in [executor.submit(session) for _ in range(args.sessions)]:
+            future.result()
+
+
+async def run_async(args, stats):
+    from django.test import AsyncClient
+
+    async def session():
+        client = AsyncClient()
+        session_id = None
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            response = await client.post(
+                '/api/llm/async',
+                json.dumps({"prompt": PROMPTS[turn % len(PROMPTS)], "session_id": session_id}),
+                content_type='application/json'
+            )
+            reader = TurnReader(started)
+            async for chunk in response.streaming_content:
+                reader.feed(chunk)
+            session_id = session_id or reader.session_id
+            stats.record(reader, time.perf_counter() - started)
+
+    await asyncio.gather(*(session() for _ in range(args.sessions)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di carico offline di /api/llm")
+    parser.add_argument('--sessions', type=int, default=20, help="sessioni concorrenti")
+    parser.add_argument('--turns', type=int, default=4, help="turni per sessione")
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync', help="view da usare")
+    parser.add_argument('--first-token-ms', type=float, default=300, help="attesa del server finto prima del primo token")
+    parser.add_argument('--token-ms', type=float, default=20, help="attesa tra un token e il successivo")
+    parser.add_argument('--tokens', type=int, default=80, help="token per risposta")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="frazione di richieste upstream che falliscono")
+    parser.add_argument('--coalesce-ms', type=float, help="finestra di accorpamento dei frame SSE (default: impostazioni)")
+    parser.add_argument('--coalesce-bytes', type=int, help="dimensione massima del testo accumulato")
+    parser.add_argument('--response-cache', action='store_true',
+                        help="attiva la cache delle risposte di analisi (tutte le sessioni partono dallo stesso prompt)")
+    parser.add_argument('--json', action='store_true', help="stampa i risultati in JSON")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            setup_django(Path(tmp) / 'bench.sqlite3', args)
+
+            from home.models import LLMConfiguration
+            LLMConfiguration.objects.create(
+                name="bench", model_name="gpt-4o-mini", api_key="bench", base_url=base_url, is_default=True,
+                cache_responses=args.response_cache
+            )
+
+            if args.response_cache:
+                # Un turno di riscaldamento riempie la cache: i primi turni misurati sono tutti hit
+                run_sync(argparse.Namespace(**{**vars(args), 'sessions': 1, 'turns': 1}), TurnStats())
+
+            queries = QueryCounter()
+            queries.install()
+            stats = TurnStats()
+
+            started = time.perf_counter()
+            cpu_started = time.process_time()
+            if args.mode == 'sync':
+                run_sync(args, stats)
+            else:
+                asyncio.run(run_async(args, stats))
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_started
+    finally:
+        server.terminate()
+        server.wait()
+
+    turns = len(stats.latency)
+    # Le risposte complete del server finto hanno sempre args.tokens token
+    tokens = (turns - stats.errors) * args.tokens
+    results = {
+        'mode': args.mode,
+        'sessions': args.sessions,
+        'turns': turns,
+        'errors': stats.errors,
+        'ttft_p50_ms': percentile(stats.ttft, 0.50) * 1000,
+        'ttft_p99_ms': percentile(stats.ttft, 0.99) * 1000,
+        'latency_p50_ms': percentile(stats.latency, 0.50) * 1000,
+        'latency_p99_ms': percentile(stats.latency, 0.99) * 1000,
+        'turns_per_s': turns / elapsed,
+        'tokens_per_s': tokens / elapsed,
+        'queries_per_turn': queries.count / turns if turns else 0,
+        'frames_per_turn': stats.frames / turns if turns else 0,
+        'bytes_per_turn': stats.bytes / turns if turns else 0,
+        'cpu_us_per_token': cpu / tokens * 1e6 if tokens else 0,
+    }
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(
+        f"{args.mode}: {args.sessions} sessioni x {args.turns} turni, primo token {args.first_token_ms:.0f} ms, "
+        f"{args.tokens} token ogni {args.token_ms:.0f} ms, errori upstream {args.error_rate:.0%}\n"
+    )
+    print(f"{'turni':<22}{results['turns']:>10}   errori {results['errors']}")
+    print(f"{'TTFT p50 / p99 ms':<22}{results['ttft_p50_ms']:>10.1f} {results['ttft_p99_ms']:>10.1f}")
+    print(f"{'turno p50 / p99 ms':<22}{results['latency_p50_ms']:>10.1f} {results['latency_p99_ms']:>10.1f}")
+    print(f"{'turni/s  token/s':<22}{results['turns_per_s']:>10.2f} {results['tokens_per_s']:>10.1f}")
+    print(f"{'query per turno':<22}{results['queries_per_turn']:>10.2f}")
+    print(f"{'frame / byte per turno':<22}{results['frames_per_turn']:>10.1f} {results['bytes_per_turn']:>10.0f}")
+    print(f"{'CPU µs per token':<22}{results['cpu_us_per_token']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
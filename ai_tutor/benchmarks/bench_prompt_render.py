@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark del rendering dei prompt degli agenti.
+
+Confronta:
+- legacy: str.format sul template completo a ogni turno (comportamento precedente)
+- compilato (cold): template precompilato, cache di rendering svuotata a ogni chiamata
+- compilato (warm): stato della sessione invariato, rendering servito dalla cache
+
+Uso:
+    python benchmarks/bench_prompt_render.py [iterazioni]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from home.agent_prompts import AGENT_PROMPTS, CONTEXT_PHASES, get_agent_prompt, _render_prompt
+
+
+CONTEXT = {
+    'original_prompt': "Scrivi un articolo sul cambiamento climatico",
+    'identified_issues': ['vaghezza', 'pubblico non definito', 'lunghezza non specificata'],
+    'collected_info': {
+        'obiettivo': "scrivere un articolo divulgativo sul cambiamento climatico",
+        'contesto': "per studenti delle scuole medie",
+        'vincoli': "circa 600 parole | tono semplice",
+    },
+    'iteration_count': 3,
+    'refined_prompt': "**Contesto**: per studenti delle scuole medie\n**Obiettivo**: scrivere un articolo divulgativo",
+    'confidence_score': 72.0,
+}
+
+
+def render_legacy(phase, context):
+    return AGENT_PROMPTS[phase].format(
+        final_prompt=context['refined_prompt'] or context['original_prompt'],
+        **context
+    )
+
+
+def render_cold(phase, context):
+    _render_prompt.cache_clear()
+    return get_agent_prompt(phase, context)
+
+
+def render_warm(phase, context):
+    return get_agent_prompt(phase, context)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"Rendering prompt agenti ({iterations} iterazioni per fase, µs per render)\n")
+    print(f"{'fase':<16}{'legacy':>10}{'cold':>10}{'warm':>10}{'speedup':>10}")
+
+    for phase in CONTEXT_PHASES:
+        assert render_legacy(phase, CONTEXT) == render_warm(phase, CONTEXT)
+
+        results = []
+        for render in (render_legacy, render_cold, render_warm):
+            elapsed = min(timeit.repeat(lambda: render(phase, CONTEXT), number=iterations, repeat=3))
+            results.append(elapsed / iterations * 1e6)
+
+        legacy, cold, warm = results
+        print(f"{phase:<16}{legacy:>10.2f}{cold:>10.2f}{warm:>10.2f}{legacy / warm:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
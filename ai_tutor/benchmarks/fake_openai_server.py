@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Server locale compatibile con l'endpoint chat completions di OpenAI.
+
+Sostituisce il provider nei benchmark (nessuna chiamata di rete esterna):
+- POST .../chat/completions con stream=true: chunk SSE chat.completion.chunk,
+  chunk finale con usage se stream_options.include_usage è impostato
+- POST .../chat/completions senza stream: risposta JSON (usata dall'estrazione,
+  il contenuto è un risultato di estrazione valido)
+
+Latenza e guasti sono configurabili:
+- first_token_ms: attesa prima del primo chunk (elaborazione del prompt)
+- token_ms: attesa tra un token e il successivo
+- tokens: token generati per risposta
+- error_rate: frazione di richieste che falliscono (metà con HTTP 500 prima
+  dello stream, metà interrotte a metà stream)
+
+Uso autonomo (per puntare il server di sviluppo su base_url http://127.0.0.1:8765/v1):
+    python benchmarks/fake_openai_server.py [porta] [first_token_ms] [token_ms] [tokens] [error_rate]
+"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Testo delle risposte: accenti ed emoji come nelle risposte reali del tutor
+ANSWER_WORDS = (
+    "Perfetto! Ecco una versione più chiara del tuo prompt: specifica il pubblico, "
+    "la lunghezza e il tono. Così l'articolo sarà più efficace e leggibile per gli studenti 🌍 "
+    "Puoi anche indicare le fonti da citare e la struttura che preferisci, per esempio "
+    "introduzione, cause, conseguenze e soluzioni possibili già adottate nelle città."
+).split(' ')
+
+EXTRACTION_RESULT = {"category": "contesto", "value": "per studenti delle scuole medie", "confidence": 0.8}
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+
+        options = self.server.options
+        failing = random.random() < options['error_rate']
+        if failing and random.random() < 0.5:
+            self.send_json(500, {"error": {"message": "errore simulato", "type": "server_error"}})
+            return
+
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 4
+
+        if not body.get('stream'):
+            time.sleep(options['first_token_ms'] / 1000)
+            self.send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get('model', 'fake'),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": json.dumps(EXTRACTION_RESULT)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        tokens = options['tokens']
+        # Le richieste che falliscono a metà stream si interrompono dopo metà dei token
+        stop_after = tokens // 2 if failing else None
+
+        time.sleep(options['first_token_ms'] / 1000)
+        for i in range(tokens):
+            if stop_after is not None and i == stop_after:
+                self.close_connection = True
+                return
+            word = ANSWER_WORDS[i % len(ANSWER_WORDS)]
+            self.send_event(self.chunk(completion_id, body, {"content": word if i == 0 else ' ' + word}))
+            time.sleep(options['token_ms'] / 1000)
+
+        self.send_event(self.chunk(completion_id, body, {}, finish_reason='stop'))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self.send_event({
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get('model', 'fake'), "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                    "total_tokens": prompt_tokens + tokens,
+                    "prompt_tokens_details": {"cached_tokens": 0},
+                },
+            })
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def chunk(self, completion_id, body, delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get('model', 'fake'),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def send_event(self, payload):
+        self.send_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, first_token_ms=300, token_ms=20, tokens=80, error_rate=0.0):
+        super().__init__(('127.0.0.1', port), FakeOpenAIHandler)
+        self.options = {
+            'first_token_ms': first_token_ms,
+            'token_ms': token_ms,
+            'tokens': tokens,
+            'error_rate': error_rate,
+        }
+
+    def handle_error(self, request, client_address):
+        # Client che chiudono la connessione (timeout, stream interrotti): non è un errore del server
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        """Avvia il server in un thread in background"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    args = sys.argv[1:]
+    server = FakeOpenAIServer(
+        port=int(args[0]) if len(args) > 0 else 8765,
+        first_token_ms=float(args[1]) if len(args) > 1 else 300,
+        token_ms=float(args[2]) if len(args) > 2 else 20,
+        tokens=int(args[3]) if len(args) > 3 else 80,
+        error_rate=float(args[4]) if len(args) > 4 else 0.0,
+    )
+    print(f"Server OpenAI finto su {server.base_url} ({server.options})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
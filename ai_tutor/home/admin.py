@@ -1,8 +1,10 @@
 from django.contrib import admin
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from .models import Tool, LLMConfiguration, ChatSession, ChatMessage
+from .search import filter_messages
+from .tracing import TRACE_STAGES
 
 @admin.register(Tool)
 class ToolAdmin(admin.ModelAdmin):
@@ -59,7 +61,7 @@ class LLMConfigurationAdmin(admin.ModelAdmin):
             'description': 'Parametri per controllare il comportamento del modello'
         }),
         ('Parametri Avanzati', {
-            'fields': ('model_parameters', 'stream', 'timeout', 'retry_attempts'),
+            'fields': ('model_parameters', 'stream', 'timeout', 'retry_attempts', 'context_window', 'cache_responses'),
             'classes': ('collapse',),
             'description': 'Parametri specifici del modello e configurazioni tecniche'
         }),
@@ -79,41 +81,97 @@ class LLMConfigurationAdmin(admin.ModelAdmin):
 class ChatMessageInline(admin.TabularInline):
     model = ChatMessage
     extra = 0
-    readonly_fields = ['timestamp', 'tokens_used']
-    fields = ['role', 'content', 'timestamp', 'tokens_used']
+    readonly_fields = ['timestamp', 'agent_phase', 'tokens_used', 'truncated']
+    fields = ['role', 'agent_phase', 'content', 'timestamp', 'tokens_used', 'truncated']
     
     def has_add_permission(self, request, obj=None):
         return False  # I messaggi vengono creati automaticamente
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
-    list_display = ['session_id', 'user', 'configuration', 'message_count', 'created_at']
+    list_display = [
+        'session_id', 'user', 'configuration', 'message_count', 'total_tokens',
+        'last_message_at', 'created_at'
+    ]
     list_filter = ['configuration', 'created_at', 'user']
+    list_select_related = ['user', 'configuration']
     search_fields = ['session_id', 'user__username', 'configuration__name']
-    readonly_fields = ['session_id', 'created_at', 'updated_at']
+    readonly_fields = [
+        'session_id', 'created_at', 'updated_at', 'message_count', 'last_message_at', 'total_tokens',
+        'turn_breakdown'
+    ]
     inlines = [ChatMessageInline]
-    
-    def message_count(self, obj):
-        count = obj.messages.count()
-        return format_html('<span style="color: blue;">{}</span>', count)
-    message_count.short_description = "Messaggi"
-    
+
+    # Turni mostrati nella ripartizione per fase (i più recenti)
+    TRACE_TURNS = 50
+
     fieldsets = (
         ('Informazioni Sessione', {
             'fields': ('session_id', 'user', 'configuration')
         }),
+        ('Statistiche', {
+            'fields': ('message_count', 'last_message_at', 'total_tokens'),
+            'description': 'Contatori aggiornati automaticamente a ogni turno della chat'
+        }),
+        ('Tracing', {
+            'fields': ('turn_breakdown',),
+            'description': 'Millisecondi spesi in ogni fase dei turni (vedi home/tracing.py)'
+        }),
         ('Metadati', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
 
+    def turn_breakdown(self, obj):
+        turns = list(
+            obj.messages.filter(role='user', trace__isnull=False)
+            .order_by('-timestamp', '-id')
+            .values_list('timestamp', 'agent_phase', 'trace')[:self.TRACE_TURNS]
+        )
+        if not turns:
+            return "Nessun turno tracciato"
+
+        header = format_html_join('', '<th>{}</th>', ((stage,) for stage in TRACE_STAGES))
+        rows = format_html_join('', '<tr><td>{}</td><td>{}</td><td><code>{}</code></td>{}<td><strong>{}</strong></td></tr>', (
+            (
+                timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                agent_phase or '-',
+                trace.get('trace_id', '')[:12],
+                format_html_join('', '<td>{}</td>', (
+                    (trace.get('stages', {}).get(stage, '-'),) for stage in TRACE_STAGES
+                )),
+                trace.get('total_ms', '-'),
+            )
+            for timestamp, agent_phase, trace in reversed(turns)
+        ))
+        return format_html(
+            '<table><thead><tr><th>Turno</th><th>Fase</th><th>Trace</th>{}<th>Totale ms</th></tr></thead>'
+            '<tbody>{}</tbody></table>',
+            header, rows
+        )
+    turn_breakdown.short_description = "Durata fasi (ms)"
+
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ['session', 'role', 'content_short', 'tokens_used', 'timestamp']
-    list_filter = ['role', 'timestamp', 'session__configuration']
-    search_fields = ['content', 'session__session_id']
-    readonly_fields = ['timestamp']
+    list_display = [
+        'session', 'role', 'agent_phase', 'content_short', 'prompt_tokens', 'cached_tokens',
+        'completion_tokens', 'tokens_used', 'truncated', 'timestamp'
+    ]
+    list_filter = ['role', 'agent_phase', 'truncated', 'timestamp', 'session__configuration']
+    list_select_related = ['session__configuration']
+    search_fields = ['session__session_id']
+    readonly_fields = [
+        'timestamp', 'agent_phase', 'prompt_tokens', 'completion_tokens', 'cached_tokens',
+        'extraction_prompt_tokens', 'extraction_completion_tokens', 'tokens_used', 'trace', 'truncated'
+    ]
+
+    def get_search_results(self, request, queryset, search_term):
+        # Il contenuto è cercato con l'indice full-text (vedi home/search.py), non con LIKE
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            results = results | filter_messages(queryset, search_term)
+        return results, may_have_duplicates
     
     def content_short(self, obj):
         return obj.content[:100] + "..." if len(obj.content) > 100 else obj.content
@@ -121,7 +179,18 @@ class ChatMessageAdmin(admin.ModelAdmin):
     
     fieldsets = (
         ('Messaggio', {
-            'fields': ('session', 'role', 'content', 'tokens_used', 'timestamp')
+            'fields': ('session', 'role', 'agent_phase', 'content', 'truncated', 'timestamp')
+        }),
+        ('Utilizzo Token', {
+            'fields': (
+                'prompt_tokens', 'cached_tokens', 'completion_tokens',
+                'extraction_prompt_tokens', 'extraction_completion_tokens', 'tokens_used'
+            ),
+            'description': 'Token della chiamata dell\'agente (risposte) e della chiamata di estrazione (messaggi utente)'
+        }),
+        ('Tracing', {
+            'fields': ('trace',),
+            'classes': ('collapse',)
         }),
     )
     
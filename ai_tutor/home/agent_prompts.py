@@ -9,6 +9,9 @@ Ogni agente ha un ruolo specifico nel processo di raffinamento progressivo:
 5. Validator: Verifica completezza e qualità finale
 """
 
+from functools import lru_cache
+from string import Formatter
+
 AGENT_PROMPTS = {
     'analyze': """Sei l'Agente Analizzatore del sistema di tutoraggio per prompt engineering.
 
@@ -401,7 +404,7 @@ FORMATO RISPOSTA:
 
 **PROMPT FINALE**:
 ═══════════════════════════════════
-{refined_prompt if refined_prompt else original_prompt}
+{final_prompt}
 ═══════════════════════════════════
 
 **Perché funziona bene**:
@@ -534,10 +537,89 @@ REGOLE FERREE:
 }
 
 
+# ============================================================================
+# RENDERING PRECOMPILATO
+# ============================================================================
+
+# Segnaposto ammessi nei template degli agenti
+PROMPT_FIELDS = (
+    'original_prompt', 'identified_issues', 'collected_info', 'iteration_count',
+    'refined_prompt', 'final_prompt', 'confidence_score',
+)
+
+# Fasi il cui prompt viene formattato con il contesto della sessione
+CONTEXT_PHASES = ['interview', 'data_collection', 'refine', 'validate']
+
+# Numero massimo di prompt renderizzati tenuti in memoria
+RENDER_CACHE_SIZE = 512
+
+
+def compile_prompt(template):
+    """
+    Compila un template str.format in testo letterale e segnaposto.
+
+    Args:
+        template: Template con segnaposto {nome} e graffe escapate {{ }}
+
+    Returns:
+        tuple: (literals, fields) con len(literals) == len(fields) + 1
+
+    Raises:
+        ValueError: Se il template usa un segnaposto non previsto o un format spec
+    """
+    literals = ['']
+    fields = []
+
+    for literal, field, spec, conversion in Formatter().parse(template):
+        literals[-1] += literal
+        if field is None:
+            continue
+        if field not in PROMPT_FIELDS or spec or conversion:
+            raise ValueError(f"Segnaposto non supportato nel prompt agente: {{{field}}}")
+        fields.append(field)
+        literals.append('')
+
+    return tuple(literals), tuple(fields)
+
+
+# Compilati una sola volta all'avvio
+COMPILED_PROMPTS = {phase: compile_prompt(AGENT_PROMPTS[phase]) for phase in CONTEXT_PHASES}
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_prompt(phase, values):
+    literals, _ = COMPILED_PROMPTS[phase]
+    parts = [literals[0]]
+    for value, literal in zip(values, literals[1:]):
+        parts.append(value)
+        parts.append(literal)
+    return ''.join(parts)
+
+
+def _field_values(phase, context):
+    """Valori (come stringhe) dei segnaposto usati dal template della fase"""
+    original_prompt = context.get('original_prompt', 'N/A')
+    refined_prompt = context.get('refined_prompt', '')
+    field_values = {
+        'original_prompt': original_prompt,
+        'identified_issues': context.get('identified_issues', []),
+        'collected_info': context.get('collected_info', {}),
+        'iteration_count': context.get('iteration_count', 0),
+        'refined_prompt': refined_prompt,
+        'final_prompt': refined_prompt if refined_prompt else original_prompt,
+        'confidence_score': context.get('confidence_score', 0),
+    }
+    _, fields = COMPILED_PROMPTS[phase]
+    return tuple(str(field_values[field]) for field in fields)
+
+
 def get_agent_prompt(phase, context=None):
     """
     Restituisce il prompt dell'agente per la fase specificata.
 
+    Il rendering è memorizzato per (fase, valori dei segnaposto): se lo stato
+    della sessione non cambia tra due turni il prompt non viene ricostruito.
+
     Args:
         phase: Fase dell'agente ('analyze', 'interview', 'data_collection', 'refine', 'validate')
         context: Dict con dati di contesto (original_prompt, identified_issues, etc.)
@@ -545,20 +627,67 @@ def get_agent_prompt(phase, context=None):
     Returns:
         str: Prompt formattato per l'agente
     """
-    base_prompt = AGENT_PROMPTS.get(phase, '')
-
-    if context and phase in ['interview', 'data_collection', 'refine', 'validate']:
-        # Formatta il prompt con i dati di contesto
-        return base_prompt.format(
-            original_prompt=context.get('original_prompt', 'N/A'),
-            identified_issues=context.get('identified_issues', []),
-            collected_info=context.get('collected_info', {}),
-            iteration_count=context.get('iteration_count', 0),
-            refined_prompt=context.get('refined_prompt', ''),
-            confidence_score=context.get('confidence_score', 0)
-        )
-
-    return base_prompt
+    if context and phase in COMPILED_PROMPTS:
+        return _render_prompt(phase, _field_values(phase, context))
+
+    return AGENT_PROMPTS.get(phase, '')
+
+
+# ============================================================================
+# LAYOUT PER PREFIX CACHING
+# ============================================================================
+
+SESSION_CONTEXT_NOTE = (
+    "\n\nNOTA: i valori indicati come <nome> (es: <original_prompt>, <confidence_score>) "
+    "si trovano nel messaggio CONTESTO SESSIONE che segue queste istruzioni."
+)
+
+
+def _compile_static_prompt(phase):
+    literals, fields = COMPILED_PROMPTS[phase]
+    parts = [literals[0]]
+    for field, literal in zip(fields, literals[1:]):
+        parts.append(f"<{field}>")
+        parts.append(literal)
+    return ''.join(parts) + SESSION_CONTEXT_NOTE
+
+
+# Istruzioni statiche per fase: identiche byte per byte in ogni turno e sessione
+STATIC_PROMPTS = {phase: _compile_static_prompt(phase) for phase in CONTEXT_PHASES}
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_session_context(phase, values):
+    _, fields = COMPILED_PROMPTS[phase]
+    lines = ["CONTESTO SESSIONE"]
+    seen = set()
+    for field, value in zip(fields, values):
+        if field in seen:
+            continue
+        seen.add(field)
+        lines.append(f"<{field}>\n{value}\n</{field}>")
+    return "\n".join(lines)
+
+
+def get_agent_prompt_parts(phase, context=None):
+    """
+    Restituisce il prompt dell'agente diviso in istruzioni statiche e contesto di sessione.
+
+    Le istruzioni statiche non contengono dati della sessione, quindi formano un
+    prefisso stabile che i provider possono mettere in cache tra un turno e l'altro.
+    Il contesto di sessione va inviato in un messaggio separato subito dopo.
+
+    Args:
+        phase: Fase dell'agente
+        context: Dict con dati di contesto (come per get_agent_prompt)
+
+    Returns:
+        tuple: (istruzioni statiche, contesto di sessione o stringa vuota)
+    """
+    if context and phase in COMPILED_PROMPTS:
+        return STATIC_PROMPTS[phase], _render_session_context(phase, _field_values(phase, context))
+
+    return AGENT_PROMPTS.get(phase, ''), ''
 
 
 def get_orchestrator_prompt():
@@ -0,0 +1,178 @@
+"""
+Snapshot precompilati delle LLMConfiguration in memoria di processo.
+
+Ogni turno rileggeva la riga di LLMConfiguration, interrogava i tools
+(filter + exists + iterazione) e ricostruiva parametri API, config del client
+e contesto completo. Qui questi valori vengono calcolati una sola volta per
+configurazione e tenuti in un snapshot immutabile: dopo il primo turno il
+percorso della richiesta non esegue query sulla configurazione.
+
+Gli snapshot vengono scartati quando cambia una LLMConfiguration, i suoi tools
+o un Tool (vedi home/signals.py). I segnali raggiungono solo il processo che ha
+fatto la modifica: con più worker gli altri processi ricaricano lo snapshot
+dopo settings.LLM_CONFIG_SNAPSHOT_TTL secondi.
+"""
+
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import LLMConfiguration
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigurationSnapshot:
+    """
+    Vista immutabile di una LLMConfiguration con i valori di richiesta precalcolati.
+
+    Espone gli stessi attributi e metodi usati dal percorso della richiesta
+    (get_api_parameters, get_client_config, get_tools, get_full_context), quindi
+    può essere passata al posto del modello. I metodi restituiscono copie:
+    chi le modifica non altera lo snapshot condiviso.
+    """
+
+    __slots__ = (
+        'pk', 'name', 'provider', 'model_name', 'max_tokens', 'timeout', 'context_window',
+        'cache_responses', '_api_parameters', '_client_config', '_tools', '_full_context', 'loaded_at',
+    )
+
+    def __init__(self, configuration):
+        values = {
+            'pk': configuration.pk,
+            'name': configuration.name,
+            'provider': configuration.provider,
+            'model_name': configuration.model_name,
+            'max_tokens': configuration.max_tokens,
+            'timeout': configuration.timeout,
+            'context_window': configuration.context_window,
+            'cache_responses': configuration.cache_responses,
+            '_api_parameters': configuration.get_api_parameters(),
+            '_client_config': configuration.get_client_config(),
+            '_tools': tuple(configuration.get_tools()),
+            '_full_context': configuration.get_full_context(),
+            'loaded_at': time.monotonic(),
+        }
+        for attr, value in values.items():
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("ConfigurationSnapshot è immutabile")
+
+    @property
+    def id(self):
+        return self.pk
+
+    def get_api_parameters(self):
+        return dict(self._api_parameters)
+
+    def get_client_config(self):
+        return dict(self._client_config)
+
+    def get_tools(self):
+        return [dict(tool) for tool in self._tools]
+
+    def get_full_context(self):
+        return self._full_context
+
+    def __str__(self):
+        return f"{self.name} ({self.provider}: {self.model_name})"
+
+
+_lock = threading.Lock()
+
+# pk configurazione -> ConfigurationSnapshot
+_snapshots = {}
+
+# pk della configurazione usata quando la richiesta non ne indica una
+_default_pk = None
+
+
+def _is_fresh(snapshot):
+    ttl = settings.LLM_CONFIG_SNAPSHOT_TTL
+    return not ttl or time.monotonic() - snapshot.loaded_at < ttl
+
+
+def _load_snapshot(configuration_id):
+    """Legge la configurazione (1 query + 1 per i tools) e ne salva lo snapshot"""
+    global _default_pk
+
+    queryset = LLMConfiguration.objects.filter(is_active=True)
+    if configuration_id is not None:
+        queryset = queryset.filter(pk=configuration_id)
+
+    # Senza id: l'ordinamento di Meta mette prima la configurazione predefinita
+    configuration = queryset.first()
+    if configuration is None:
+        return None
+
+    snapshot = ConfigurationSnapshot(configuration)
+    with _lock:
+        _snapshots[snapshot.pk] = snapshot
+        if configuration_id is None:
+            _default_pk = snapshot.pk
+
+    logger.info(f"Snapshot configurazione caricato: config={snapshot.pk}, tools={len(snapshot._tools)}")
+    return snapshot
+
+
+def _cached_snapshot(configuration_id):
+    pk = _default_pk if configuration_id is None else configuration_id
+    snapshot = _snapshots.get(pk)
+    if snapshot is not None and _is_fresh(snapshot):
+        return snapshot
+    return None
+
+
+def _normalize_id(configuration_id):
+    if configuration_id in (None, ''):
+        return None
+    return int(configuration_id)
+
+
+def get_configuration_snapshot(configuration_id=None):
+    """
+    Restituisce lo snapshot di una configurazione attiva.
+
+    Args:
+        configuration_id: pk della configurazione (None = predefinita, o la prima attiva)
+
+    Returns:
+        ConfigurationSnapshot | None: None se la configurazione non esiste o non è attiva
+
+    Raises:
+        ValueError: Se configuration_id non è un intero
+    """
+    configuration_id = _normalize_id(configuration_id)
+    return _cached_snapshot(configuration_id) or _load_snapshot(configuration_id)
+
+
+async def aget_configuration_snapshot(configuration_id=None):
+    """Versione asincrona di get_configuration_snapshot (thread solo in caso di miss)"""
+    configuration_id = _normalize_id(configuration_id)
+    snapshot = _cached_snapshot(configuration_id)
+    if snapshot is not None:
+        return snapshot
+    return await sync_to_async(_load_snapshot)(configuration_id)
+
+
+def invalidate_snapshots():
+    """
+    Scarta tutti gli snapshot del processo.
+
+    Si svuota tutto e non solo la configurazione modificata: il salvataggio di
+    una predefinita cambia le altre con un update() (senza segnali) e un Tool
+    può essere condiviso da più configurazioni.
+    """
+    global _default_pk
+
+    with _lock:
+        count = len(_snapshots)
+        _snapshots.clear()
+        _default_pk = None
+
+    if count:
+        logger.info(f"Snapshot configurazione invalidati: count={count}")
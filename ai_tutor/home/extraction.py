@@ -0,0 +1,560 @@
+"""
+Estrazione di informazioni strutturate dalle risposte dell'utente.
+
+L'estrazione è a livelli (vedi extract_info_from_response): un classificatore
+locale risolve le risposte con una categoria evidente, una cache evita di
+ripetere chiamate all'LLM per risposte già viste e solo i casi ambigui arrivano
+all'LLM. Risposte brevi e ricorrenti ("formale", "lista puntata",
+"per studenti") non devono pagare ogni volta una chiamata all'LLM.
+
+La cache usa l'alias 'extraction' di CACHES (LRU + TTL con il backend locmem).
+Le chiavi includono il modello e una versione derivata dal testo del prompt di
+estrazione: se uno dei due cambia, le vecchie voci non vengono più lette e
+scadono da sole.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .llm_clients import get_client, get_async_client, EXTRACTION_TIMEOUT
+from .usage import read_usage
+from .metrics import observe_extraction
+
+logger = logging.getLogger(__name__)
+
+# Categorie di informazioni raccolte durante il dialogo
+INFO_CATEGORIES = ['obiettivo', 'contesto', 'vincoli', 'output_format', 'role']
+
+EXTRACTION_SYSTEM_PROMPT = "Sei un assistente che estrae informazioni strutturate. Rispondi SOLO con JSON valido."
+
+EXTRACTION_PROMPT_TEMPLATE = """Analizza la seguente risposta dell'utente e estrai informazioni strutturate per costruire un prompt ottimale.
+
+RISPOSTA UTENTE:
+"{user_message}"
+
+INFORMAZIONI GIÀ RACCOLTE:
+{collected_info}
+
+COMPITO:
+Identifica quale tipo di informazione fornisce l'utente e classificala in UNA di queste categorie:
+- obiettivo: Lo scopo/task principale (es: "creare un articolo", "generare codice", "scrivere email")
+- contesto: Scenario d'uso, pubblico target, background (es: "per studenti", "in ambito aziendale")
+- vincoli: Limitazioni su lunghezza, tono, stile (es: "500 parole", "tono formale", "semplice")
+- output_format: Formato della risposta desiderato (es: "lista puntata", "JSON", "markdown")
+- role: Ruolo che l'AI dovrebbe assumere (es: "esperto di marketing", "tutor paziente")
+
+Rispondi SOLO con un JSON in questo formato:
+{{
+  "category": "obiettivo|contesto|vincoli|output_format|role|nessuna",
+  "value": "testo estratto dalla risposta utente (usa le sue parole, non parafrasare)",
+  "confidence": 0.0-1.0
+}}
+
+REGOLE:
+- Se la risposta non contiene info utili, usa category="nessuna"
+- Mantieni il testo originale dell'utente in "value"
+- Non inventare informazioni non presenti
+- Se l'utente fornisce più info, priorità all'aspetto più rilevante"""
+
+# Versione del prompt di estrazione: cambia automaticamente se il testo viene modificato
+EXTRACTION_PROMPT_VERSION = hashlib.sha1(
+    (EXTRACTION_SYSTEM_PROMPT + EXTRACTION_PROMPT_TEMPLATE).encode('utf-8')
+).hexdigest()[:12]
+
+# Chiavi dei contatori hit/miss (fuori dalla versione del prompt)
+_STATS_KEYS = {
+    'hits': 'extraction:stats:hits',
+    'misses': 'extraction:stats:misses',
+}
+
+
+class _TieredExtraction:
+    """
+    Livelli di un'estrazione, condivisi da extract_info_from_response e dalla
+    variante asincrona: le due funzioni differiscono solo per l'accesso a
+    cache e LLM (sincrono o asincrono).
+    """
+
+    def __init__(self, user_message, current_phase, collected_info, configuration):
+        self.user_message = user_message
+        self.current_phase = current_phase
+        self.collected_info = collected_info
+        self.configuration = configuration
+        self.cache_args = (user_message, collected_info, configuration.model_name)
+        self.started = time.perf_counter()
+        self.usage = None
+
+    def without_io(self):
+        """
+        Risultato senza cache né LLM: risposta troppo breve o classificatore locale.
+
+        Returns:
+            tuple | None: (informazioni aggiornate, None), None se serve il livello successivo
+        """
+        # Se è la prima risposta o una risposta molto breve, usa approccio semplificato
+        if len(self.user_message.strip()) < 5:
+            return self.collected_info.copy(), None
+
+        # Risposte con una categoria evidente: nessuna chiamata all'LLM
+        local_result = classify_locally(self.user_message)
+        if local_result['confidence'] >= settings.EXTRACTION_LOCAL_THRESHOLD:
+            return self._apply('local', local_result)
+        return None
+
+    def from_cache(self, cached):
+        """Risultato dal livello cache (None se la risposta non è in cache)"""
+        if cached is None:
+            return None
+        return self._apply('cache', cached)
+
+    def llm_request(self):
+        """Parametri della chiamata di estrazione all'LLM"""
+        return {
+            'model': self.configuration.model_name,
+            'messages': build_extraction_messages(self.user_message, self.collected_info),
+            'temperature': 0.3,  # Bassa temperatura per output più deterministico
+            'max_tokens': 200,
+        }
+
+    def parse(self, response):
+        # Token spesi anche se la risposta non è interpretabile (fallback)
+        self.usage = read_usage(getattr(response, 'usage', None))
+        return parse_extraction_result(response.choices[0].message.content)
+
+    def from_llm(self, extraction_result):
+        return self._apply('llm', extraction_result, self.usage)
+
+    def fallback(self, error):
+        """Se l'estrazione LLM fallisce, usa l'approccio a keyword semplificato"""
+        logger.warning(f"LLM extraction failed: {str(error)}, using fallback keyword extraction")
+        _record_tier('fallback', self.started, self.configuration, self.current_phase)
+        return extract_info_fallback(self.user_message, self.collected_info), self.usage
+
+    def _apply(self, tier, extraction_result, usage=None):
+        _record_tier(tier, self.started, self.configuration, self.current_phase)
+        return apply_extraction_result(extraction_result, self.collected_info), usage
+
+
+def extract_info_from_response(user_message, current_phase, collected_info, configuration):
+    """
+    Estrae informazioni strutturate dalla risposta dell'utente.
+
+    L'estrazione è a livelli, dal più economico al più costoso:
+    1. local: classificatore a pattern precompilati (se confidence >= soglia)
+    2. cache: risultato LLM già ottenuto per la stessa risposta
+    3. llm: chiamata di estrazione all'LLM
+    4. fallback: keyword semplici se la chiamata LLM fallisce
+
+    Args:
+        user_message: Messaggio dell'utente
+        current_phase: Fase corrente
+        collected_info: Dict con info già raccolte
+        configuration: LLMConfiguration per fare la chiamata di estrazione
+
+    Returns:
+        tuple: (informazioni aggiornate, usage della chiamata all'LLM o None)
+    """
+    extraction = _TieredExtraction(user_message, current_phase, collected_info, configuration)
+
+    result = extraction.without_io()
+    if result is None:
+        # Risposte identiche già classificate dall'LLM
+        result = extraction.from_cache(get_cached_extraction(*extraction.cache_args))
+    if result is not None:
+        return result
+
+    try:
+        # Chiama l'LLM per estrarre info (client condiviso, connessioni già aperte)
+        client = get_client(configuration, timeout=EXTRACTION_TIMEOUT)
+        extraction_result = extraction.parse(client.chat.completions.create(**extraction.llm_request()))
+        set_cached_extraction(*extraction.cache_args, extraction_result)
+        return extraction.from_llm(extraction_result)
+
+    except Exception as e:
+        return extraction.fallback(e)
+
+
+async def aextract_info_from_response(user_message, current_phase, collected_info, configuration):
+    """
+    Versione asincrona di extract_info_from_response, usata dall'endpoint ASGI.
+    Stessi livelli e stesso fallback, ma cache e chiamata all'LLM non bloccano l'event loop.
+    """
+    extraction = _TieredExtraction(user_message, current_phase, collected_info, configuration)
+
+    result = extraction.without_io()
+    if result is None:
+        result = extraction.from_cache(await aget_cached_extraction(*extraction.cache_args))
+    if result is not None:
+        return result
+
+    try:
+        client = get_async_client(configuration, timeout=EXTRACTION_TIMEOUT)
+        extraction_result = extraction.parse(await client.chat.completions.create(**extraction.llm_request()))
+        await aset_cached_extraction(*extraction.cache_args, extraction_result)
+        return extraction.from_llm(extraction_result)
+
+    except Exception as e:
+        return extraction.fallback(e)
+
+
+def extract_info_fallback(user_message, collected_info):
+    """
+    Fallback method: estrazione basata su keyword semplici.
+    Usato solo se l'estrazione LLM fallisce (ultimo livello).
+    """
+    updated_info = collected_info.copy()
+    message_lower = user_message.lower()
+
+    # Obiettivo
+    if any(word in message_lower for word in ['creare', 'generare', 'scrivere', 'fare', 'produrre', 'voglio', 'vorrei']):
+        if not updated_info.get('obiettivo'):
+            updated_info['obiettivo'] = user_message
+
+    # Contesto/Pubblico
+    if any(word in message_lower for word in ['per', 'studenti', 'professionisti', 'bambini', 'utenti', 'clienti', 'pubblico']):
+        if not updated_info.get('contesto'):
+            updated_info['contesto'] = user_message
+
+    # Vincoli (lunghezza, tono)
+    if any(word in message_lower for word in ['parole', 'caratteri', 'paragrafi', 'breve', 'lungo',
+                                               'formale', 'informale', 'tecnico', 'semplice']):
+        if not updated_info.get('vincoli'):
+            updated_info['vincoli'] = user_message
+        else:
+            updated_info['vincoli'] += ' | ' + user_message
+
+    # Formato output
+    if any(word in message_lower for word in ['lista', 'elenco', 'tabella', 'json', 'markdown', 'html']):
+        if not updated_info.get('output_format'):
+            updated_info['output_format'] = user_message
+
+    # Ruolo
+    if any(word in message_lower for word in ['esperto', 'tutor', 'assistente', 'consulente', 'come']):
+        if not updated_info.get('role'):
+            updated_info['role'] = user_message
+
+    return updated_info
+
+
+def build_extraction_messages(user_message, collected_info):
+    """
+    Costruisce i messaggi per la chiamata di estrazione strutturata.
+
+    Args:
+        user_message: Messaggio dell'utente
+        collected_info: Dict con info già raccolte
+
+    Returns:
+        list: Messaggi in formato chat completions
+    """
+    extraction_prompt = EXTRACTION_PROMPT_TEMPLATE.format(
+        user_message=user_message,
+        collected_info=json.dumps(collected_info, ensure_ascii=False, indent=2)
+    )
+
+    return [
+        {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+        {"role": "user", "content": extraction_prompt}
+    ]
+
+
+def parse_extraction_result(result_text):
+    """
+    Interpreta il JSON restituito dall'LLM di estrazione.
+
+    Args:
+        result_text: Testo della risposta dell'LLM
+
+    Returns:
+        dict: {'category', 'value', 'confidence'}
+
+    Raises:
+        json.JSONDecodeError: Se la risposta non è JSON valido
+    """
+    result_text = result_text.strip()
+
+    # Rimuovi eventuali markdown code blocks
+    if result_text.startswith('```'):
+        result_text = result_text.split('```')[1]
+        if result_text.startswith('json'):
+            result_text = result_text[4:]
+
+    extraction_result = json.loads(result_text.strip())
+
+    return {
+        'category': extraction_result.get('category', 'nessuna'),
+        'value': extraction_result.get('value', ''),
+        'confidence': extraction_result.get('confidence', 0.0),
+    }
+
+
+def apply_extraction_result(extraction_result, collected_info):
+    """
+    Aggiorna collected_info con un risultato di estrazione.
+
+    Args:
+        extraction_result: Dict restituito da parse_extraction_result
+        collected_info: Dict con info già raccolte
+
+    Returns:
+        dict: Informazioni aggiornate (nuovo dict, l'originale non viene modificato)
+    """
+    updated_info = collected_info.copy()
+
+    category = extraction_result['category']
+    value = extraction_result['value']
+    confidence = extraction_result['confidence']
+
+    # Solo se confidence > 0.5 e categoria valida
+    if confidence > 0.5 and category in INFO_CATEGORIES:
+        if category == 'vincoli':
+            # Per vincoli, aggiungi invece di sovrascrivere
+            if updated_info.get('vincoli'):
+                updated_info['vincoli'] += ' | ' + value
+            else:
+                updated_info['vincoli'] = value
+        else:
+            # Per altri campi, aggiorna solo se vuoto o se nuovo valore è più dettagliato
+            if not updated_info.get(category) or len(value) > len(updated_info.get(category, '')):
+                updated_info[category] = value
+
+    logger.info(f"Extraction: category={category}, confidence={confidence:.2f}, value_length={len(value)}")
+
+    return updated_info
+
+
+# ============================================================================
+# CLASSIFICATORE LOCALE
+# ============================================================================
+
+# Pattern per categoria con il loro peso: un match con peso 1.0 è un segnale forte.
+# Compilati una sola volta all'import del modulo.
+LOCAL_PATTERNS = {
+    'obiettivo': [
+        (r'\b(creare|crea|generare|genera|scrivere|scrivi|produrre|redigere|preparare|riassumere|tradurre)\b', 1.0),
+        (r'\b(voglio|vorrei|mi serve|ho bisogno)\b', 0.6),
+    ],
+    'contesto': [
+        (r'\bper (gli |i |le |la |il |l\'|un |una |dei |delle |degli |miei |mie )?(studenti|professionisti|bambini|ragazzi|'
+         r'utenti|clienti|colleghi|docenti|insegnanti|principianti|esperti|manager|lettori|genitori)\b', 1.0),
+        (r'\b(pubblico|target|destinatari|in ambito|aziendale|scolastico|universitario)\b', 0.8),
+    ],
+    'vincoli': [
+        (r'\b\d+\s*(parole|caratteri|righe|paragrafi|pagine|frasi|minuti)\b', 1.0),
+        (r'\b(formale|informale|tecnico|semplice|breve|conciso|sintetico|lungo|dettagliato|ironico|'
+         r'professionale|amichevole|divulgativo)\b', 0.9),
+        (r'\b(tono|stile|al massimo|non più di|massimo)\b', 0.7),
+    ],
+    'output_format': [
+        (r'\b(lista|elenco)( puntat[ao]| numerat[ao])?\b', 1.0),
+        (r'\b(tabella|json|markdown|html|csv|xml|yaml|punti elenco|schema)\b', 1.0),
+    ],
+    'role': [
+        (r'\b(come|fai da|agisci come|comportati come|sei)\s+(un |una |uno |un\')?\s*(esperto|esperta|tutor|insegnante|'
+         r'consulente|professore|professoressa|giornalista|copywriter|sviluppatore|programmatore|coach)\b', 1.0),
+        (r'\b(esperto|esperta|tutor|consulente)\b', 0.6),
+    ],
+}
+
+_COMPILED_PATTERNS = {
+    category: [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in patterns]
+    for category, patterns in LOCAL_PATTERNS.items()
+}
+
+# Oltre questa lunghezza (in parole) una risposta contiene spesso più informazioni:
+# la confidence locale viene ridotta per lasciare la decisione all'LLM
+LOCAL_SHORT_MESSAGE_WORDS = 8
+
+
+def classify_locally(user_message):
+    """
+    Classifica la risposta dell'utente con pattern precompilati, senza chiamare l'LLM.
+
+    Ogni categoria riceve il peso del suo pattern più forte. La confidence
+    è alta solo se una categoria prevale nettamente sulle altre e il messaggio
+    è breve.
+
+    Args:
+        user_message: Messaggio dell'utente
+
+    Returns:
+        dict: {'category', 'value', 'confidence'} come parse_extraction_result
+    """
+    scores = {}
+    for category, patterns in _COMPILED_PATTERNS.items():
+        score = max((weight for regex, weight in patterns if regex.search(user_message)), default=0.0)
+        if score:
+            scores[category] = score
+
+    if not scores:
+        return {'category': 'nessuna', 'value': '', 'confidence': 0.0}
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    category, best = ranked[0]
+    second = ranked[1][1] if len(ranked) > 1 else 0.0
+
+    # Margine sulla seconda categoria: 1.0 se non c'è concorrenza, 0.0 se pari
+    margin = (best - second) / best
+    words = len(user_message.split())
+    length_factor = 1.0 if words <= LOCAL_SHORT_MESSAGE_WORDS else max(0.5, LOCAL_SHORT_MESSAGE_WORDS / words)
+
+    confidence = min(best, 1.0) * (0.5 + 0.5 * margin) * length_factor
+
+    return {
+        'category': category,
+        'value': user_message.strip(),
+        'confidence': round(confidence, 3),
+    }
+
+
+# ============================================================================
+# STATISTICHE PER LIVELLO
+# ============================================================================
+
+EXTRACTION_TIERS = ['local', 'cache', 'llm', 'fallback']
+
+_tier_lock = threading.Lock()
+_tier_stats = {tier: {'count': 0, 'total_ms': 0.0} for tier in EXTRACTION_TIERS}
+
+
+def _record_tier(tier, started, configuration, phase):
+    elapsed = time.perf_counter() - started
+    with _tier_lock:
+        _tier_stats[tier]['count'] += 1
+        _tier_stats[tier]['total_ms'] += elapsed * 1000
+    observe_extraction(configuration, phase, tier, elapsed)
+    logger.info(f"Extraction tier={tier}, latency={elapsed * 1000:.1f}ms")
+
+
+def get_extraction_tier_stats():
+    """
+    Hit rate e latenza media di ogni livello di estrazione (per processo).
+
+    Returns:
+        dict: {tier: {'count', 'share', 'avg_ms'}}
+    """
+    with _tier_lock:
+        snapshot = {tier: dict(values) for tier, values in _tier_stats.items()}
+
+    total = sum(values['count'] for values in snapshot.values())
+
+    return {
+        tier: {
+            'count': values['count'],
+            'share': round(values['count'] / total, 3) if total else 0.0,
+            'avg_ms': round(values['total_ms'] / values['count'], 2) if values['count'] else 0.0,
+        }
+        for tier, values in snapshot.items()
+    }
+
+
+# ============================================================================
+# CACHE DEI RISULTATI
+# ============================================================================
+
+def normalize_message(user_message):
+    """Normalizza un messaggio per la chiave di cache (spazi e maiuscole)"""
+    return ' '.join(user_message.split()).casefold()
+
+
+def get_extraction_cache_key(user_message, collected_info, model_name):
+    """
+    Chiave di cache per un'estrazione.
+
+    Dello stato della sessione conta solo quali categorie sono già compilate:
+    i valori variano tra sessioni e renderebbero la cache inutile.
+
+    Args:
+        user_message: Messaggio dell'utente
+        collected_info: Dict con info già raccolte
+        model_name: Modello usato per l'estrazione
+
+    Returns:
+        str: Chiave di cache
+    """
+    filled = ','.join(sorted(key for key in INFO_CATEGORIES if collected_info.get(key)))
+    raw = f"{model_name}\n{filled}\n{normalize_message(user_message)}"
+    return 'extraction:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _count(outcome):
+    cache = caches['extraction']
+    key = _STATS_KEYS[outcome]
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Contatore rimosso dal backend tra add e incr
+        cache.set(key, 1, timeout=None)
+
+
+async def _acount(outcome):
+    cache = caches['extraction']
+    key = _STATS_KEYS[outcome]
+    await cache.aadd(key, 0, timeout=None)
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        await cache.aset(key, 1, timeout=None)
+
+
+def get_cached_extraction(user_message, collected_info, model_name):
+    """
+    Restituisce il risultato di estrazione in cache, se presente.
+
+    Returns:
+        dict | None: Risultato come da parse_extraction_result
+    """
+    key = get_extraction_cache_key(user_message, collected_info, model_name)
+    result = caches['extraction'].get(key, version=EXTRACTION_PROMPT_VERSION)
+    _count('hits' if result is not None else 'misses')
+    return result
+
+
+async def aget_cached_extraction(user_message, collected_info, model_name):
+    """Variante asincrona di get_cached_extraction (non blocca l'event loop)"""
+    key = get_extraction_cache_key(user_message, collected_info, model_name)
+    result = await caches['extraction'].aget(key, version=EXTRACTION_PROMPT_VERSION)
+    await _acount('hits' if result is not None else 'misses')
+    return result
+
+
+def set_cached_extraction(user_message, collected_info, model_name, extraction_result):
+    """Salva in cache un risultato di estrazione ottenuto dall'LLM"""
+    key = get_extraction_cache_key(user_message, collected_info, model_name)
+    caches['extraction'].set(key, extraction_result, version=EXTRACTION_PROMPT_VERSION)
+
+
+async def aset_cached_extraction(user_message, collected_info, model_name, extraction_result):
+    key = get_extraction_cache_key(user_message, collected_info, model_name)
+    await caches['extraction'].aset(key, extraction_result, version=EXTRACTION_PROMPT_VERSION)
+
+
+def get_extraction_cache_stats():
+    """
+    Contatori della cache di estrazione, utili per dimensionarla.
+
+    Con un backend condiviso (es: Redis) i contatori aggregano tutti i worker;
+    con locmem sono per processo.
+
+    Returns:
+        dict: {'hits', 'misses', 'hit_rate', 'prompt_version'}
+    """
+    cache = caches['extraction']
+    hits = cache.get(_STATS_KEYS['hits'], 0)
+    misses = cache.get(_STATS_KEYS['misses'], 0)
+    total = hits + misses
+
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 3) if total else 0.0,
+        'prompt_version': EXTRACTION_PROMPT_VERSION,
+    }
@@ -0,0 +1,193 @@
+"""
+Selezione della cronologia da inviare all'LLM in base a un budget di token.
+
+Invece di includere sempre gli ultimi N messaggi, la cronologia viene riempita
+dal più recente al più vecchio finché il budget lo consente: una sessione con
+documenti incollati non sfora la finestra di contesto e una sessione con
+messaggi brevi usa tutto lo spazio disponibile.
+
+I token sono contati localmente con tiktoken se installato (pip install tiktoken),
+altrimenti con una stima sui caratteri. Il conteggio di ogni messaggio è salvato
+in ChatMessage.content_tokens e calcolato una sola volta.
+"""
+
+import logging
+from functools import lru_cache
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Finestra di contesto per prefisso del nome modello (il primo prefisso che corrisponde vince)
+MODEL_CONTEXT_WINDOWS = [
+    ('gpt-5', 400000),
+    ('gpt-4.1', 1047576),
+    ('gpt-4o', 128000),
+    ('gpt-4-turbo', 128000),
+    ('gpt-4', 8192),
+    ('gpt-3.5', 16385),
+    ('o1', 200000),
+    ('o3', 200000),
+    ('o4', 200000),
+    ('claude', 200000),
+    ('gemini', 1000000),
+]
+
+# Finestra usata per modelli sconosciuti
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Token di overhead per ogni messaggio (ruolo e separatori del formato chat)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Margine di sicurezza sul budget (errori di stima del tokenizer)
+BUDGET_SAFETY_MARGIN = 256
+
+# Sotto questa soglia non conviene troncare un messaggio: viene scartato
+MIN_TRUNCATED_TOKENS = 64
+
+TRUNCATION_MARKER = "\n[...messaggio troncato...]"
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+
+def count_tokens(text, model_name):
+    """
+    Conta i token di un testo per il modello indicato.
+
+    Args:
+        text: Testo da misurare
+        model_name: Nome del modello (sceglie il tokenizer)
+
+    Returns:
+        int: Numero di token (stimato se tiktoken non è installato)
+    """
+    if not text:
+        return 0
+
+    if tiktoken is None:
+        # Circa 4 caratteri per token sui testi in italiano/inglese
+        return len(text) // 4 + 1
+
+    return len(_get_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model_name):
+    """Tronca un testo a circa max_tokens token mantenendone l'inizio"""
+    if tiktoken is None:
+        return text[:max_tokens * 4] + TRUNCATION_MARKER
+
+    encoding = _get_encoding(model_name)
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + TRUNCATION_MARKER
+
+
+def get_context_window(configuration):
+    """
+    Finestra di contesto del modello della configurazione.
+
+    Args:
+        configuration: LLMConfiguration
+
+    Returns:
+        int: Token totali (input + output) accettati dal modello
+    """
+    if configuration.context_window:
+        return configuration.context_window
+
+    model_name = configuration.model_name.lower()
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model_name.startswith(prefix):
+            return window
+
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def get_history_budget(configuration, fixed_texts):
+    """
+    Token disponibili per la cronologia in una richiesta.
+
+    Il budget è quanto resta della finestra di contesto dopo la risposta
+    (max_tokens), le parti fisse della richiesta e un margine di sicurezza,
+    limitato da settings.HISTORY_MAX_TOKENS per contenere i costi.
+
+    Args:
+        configuration: LLMConfiguration
+        fixed_texts: Testi sempre presenti (system prompt, contesto, messaggio utente)
+
+    Returns:
+        int: Budget in token (>= 0)
+    """
+    fixed_tokens = sum(
+        count_tokens(text, configuration.model_name) + MESSAGE_OVERHEAD_TOKENS
+        for text in fixed_texts if text
+    )
+    available = get_context_window(configuration) - configuration.max_tokens - fixed_tokens - BUDGET_SAFETY_MARGIN
+
+    return max(0, min(available, settings.HISTORY_MAX_TOKENS))
+
+
+def fill_token_counts(messages, model_name):
+    """
+    Calcola content_tokens per i messaggi che non l'hanno ancora.
+
+    Args:
+        messages: ChatMessage da controllare
+        model_name: Nome del modello
+
+    Returns:
+        list: Messaggi aggiornati, da salvare con bulk_update(..., ['content_tokens'])
+    """
+    updated = []
+    for msg in messages:
+        if msg.content_tokens is None:
+            msg.content_tokens = count_tokens(msg.content, model_name)
+            updated.append(msg)
+    return updated
+
+
+def pack_history(messages, budget, model_name):
+    """
+    Seleziona la cronologia che entra nel budget, partendo dai messaggi più recenti.
+
+    Quando un messaggio non entra viene troncato (se resta spazio sufficiente)
+    e i messaggi più vecchi vengono scartati.
+
+    Args:
+        messages: ChatMessage dal più recente al più vecchio, con content_tokens valorizzato
+        budget: Token disponibili (da get_history_budget)
+        model_name: Nome del modello
+
+    Returns:
+        list: [{'role', 'content'}] in ordine cronologico
+    """
+    packed = []
+    remaining = budget
+
+    for msg in messages:
+        cost = msg.content_tokens + MESSAGE_OVERHEAD_TOKENS
+        if cost <= remaining:
+            packed.append({'role': msg.role, 'content': msg.content})
+            remaining -= cost
+            continue
+
+        available = remaining - MESSAGE_OVERHEAD_TOKENS
+        if available >= MIN_TRUNCATED_TOKENS:
+            packed.append({'role': msg.role, 'content': truncate_to_tokens(msg.content, available, model_name)})
+        break
+
+    packed.reverse()
+
+    if len(packed) < len(messages):
+        logger.info(f"History packing: {len(packed)}/{len(messages)} messaggi, budget={budget}, residuo={remaining}")
+
+    return packed
@@ -0,0 +1,95 @@
+"""
+Chiavi di idempotenza (header Idempotency-Key) per POST /api/llm.
+
+Il client genera una chiave per ogni messaggio e la reinvia a ogni tentativo
+(doppio invio, nuovo tentativo dopo un errore di rete). La prima richiesta con
+la chiave registra il proprio turno nella cache 'streams' con cache.add, che è
+atomica anche su Redis: con più worker un solo turno vince. Le richieste
+successive non avviano un nuovo turno (niente seconda estrazione, niente
+doppio incremento di iteration_count) ma ricevono gli eventi del turno
+registrato dal suo buffer (vedi home/resumable.py): in diretta se è ancora in
+corso, riprodotti se è concluso da meno di RESUMABLE_STREAM_GRACE secondi.
+
+La chiave resta registrata per IDEMPOTENCY_KEY_TTL secondi. La stessa chiave
+con un corpo della richiesta diverso è un errore del client.
+
+alookup e aclaim sono le varianti per l'endpoint ASGI (API asincrone della
+cache: con Redis non bloccano l'event loop).
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .resumable import STREAM_CACHE
+
+HEADER = 'Idempotency-Key'
+
+MAX_KEY_LENGTH = 255
+
+
+class KeyReused(Exception):
+    """Idempotency-Key già registrata per una richiesta con un corpo diverso"""
+
+
+def _cache_key(idempotency_key):
+    # Hash: la chiave arriva dal client e può contenere caratteri non ammessi dai backend di cache
+    return "idempotency:" + hashlib.sha256(idempotency_key.encode()).hexdigest()
+
+
+def _fingerprint(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def _registered_turn(entry, body):
+    if entry is None:
+        return None
+    if entry['fingerprint'] != _fingerprint(body):
+        raise KeyReused()
+    return entry['turn_id']
+
+
+def lookup(idempotency_key, body):
+    """
+    Turno registrato per la chiave.
+
+    Returns:
+        str: ID del turno, None se la chiave è nuova
+
+    Raises:
+        KeyReused: se la chiave appartiene a una richiesta con un altro corpo
+    """
+    return _registered_turn(caches[STREAM_CACHE].get(_cache_key(idempotency_key)), body)
+
+
+async def alookup(idempotency_key, body):
+    """Variante asincrona di lookup"""
+    return _registered_turn(await caches[STREAM_CACHE].aget(_cache_key(idempotency_key)), body)
+
+
+def claim(idempotency_key, body, turn_id):
+    """
+    Registra turn_id come turno della chiave.
+
+    Returns:
+        str: turn_id se la registrazione riesce, altrimenti il turno della
+             richiesta che ha registrato la chiave per prima
+
+    Raises:
+        KeyReused: se la chiave appartiene a una richiesta con un altro corpo
+    """
+    cache = caches[STREAM_CACHE]
+    entry = {'turn_id': turn_id, 'fingerprint': _fingerprint(body)}
+    if cache.add(_cache_key(idempotency_key), entry, settings.IDEMPOTENCY_KEY_TTL):
+        return turn_id
+    return _registered_turn(cache.get(_cache_key(idempotency_key)), body) or turn_id
+
+
+async def aclaim(idempotency_key, body, turn_id):
+    """Variante asincrona di claim"""
+    cache = caches[STREAM_CACHE]
+    entry = {'turn_id': turn_id, 'fingerprint': _fingerprint(body)}
+    if await cache.aadd(_cache_key(idempotency_key), entry, settings.IDEMPOTENCY_KEY_TTL):
+        return turn_id
+    return _registered_turn(await cache.aget(_cache_key(idempotency_key)), body) or turn_id
@@ -0,0 +1,155 @@
+"""
+Registry di client LLM condivisi a livello di processo.
+
+Creare un nuovo client OpenAI a ogni turno butta via il pool di connessioni HTTP
+(keep-alive e sessione TLS), quindi ogni richiesta paga di nuovo handshake e
+connect. Qui i client vengono creati una sola volta per combinazione
+(api_key, base_url, timeout) e riutilizzati da tutte le richieste del processo.
+
+Quando una LLMConfiguration viene salvata o eliminata i client associati vengono
+rimossi dal registry (vedi home/signals.py): la richiesta successiva ne crea uno nuovo.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+
+from openai import OpenAI, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Timeout (secondi) usato per la chiamata di estrazione informazioni
+EXTRACTION_TIMEOUT = 10
+
+_lock = threading.Lock()
+
+# chiave client -> OpenAI
+_sync_clients = {}
+
+# event loop -> {chiave client -> AsyncOpenAI}
+# I client asincroni sono legati al loop su cui sono stati creati
+_async_clients = weakref.WeakKeyDictionary()
+
+# pk configurazione -> insieme delle chiavi client create per quella configurazione
+_configuration_keys = {}
+
+
+def get_client_key(configuration, timeout=None):
+    """
+    Chiave del registry per una configurazione.
+
+    Args:
+        configuration: LLMConfiguration
+        timeout: Timeout specifico (default: configuration.timeout)
+
+    Returns:
+        tuple: (api_key, base_url, timeout)
+    """
+    client_config = configuration.get_client_config()
+    if timeout is not None:
+        client_config['timeout'] = timeout
+
+    return (
+        client_config['api_key'],
+        client_config.get('base_url'),
+        client_config['timeout'],
+    )
+
+
+def _client_kwargs(key):
+    api_key, base_url, timeout = key
+    kwargs = {'api_key': api_key, 'timeout': timeout}
+    if base_url:
+        kwargs['base_url'] = base_url
+    return kwargs
+
+
+def _track(configuration, key):
+    if configuration.pk is not None:
+        _configuration_keys.setdefault(configuration.pk, set()).add(key)
+
+
+def get_client(configuration, timeout=None):
+    """
+    Restituisce il client OpenAI condiviso per la configurazione.
+
+    Args:
+        configuration: LLMConfiguration
+        timeout: Timeout specifico (es: EXTRACTION_TIMEOUT), default configuration.timeout
+
+    Returns:
+        OpenAI: Client con pool di connessioni persistente
+    """
+    key = get_client_key(configuration, timeout)
+
+    client = _sync_clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            client = OpenAI(**_client_kwargs(key))
+            _sync_clients[key] = client
+            logger.info(f"Nuovo client LLM: config={configuration.pk}, base_url={key[1]}, timeout={key[2]}")
+        _track(configuration, key)
+
+    return client
+
+
+def get_async_client(configuration, timeout=None):
+    """
+    Restituisce il client AsyncOpenAI condiviso per la configurazione.
+
+    Va chiamato dall'interno di un event loop: i client vengono tenuti separati
+    per loop perché il pool di connessioni asincrono non può essere condiviso tra loop.
+
+    Args:
+        configuration: LLMConfiguration
+        timeout: Timeout specifico (es: EXTRACTION_TIMEOUT), default configuration.timeout
+
+    Returns:
+        AsyncOpenAI: Client con pool di connessioni persistente
+    """
+    key = get_client_key(configuration, timeout)
+    loop = asyncio.get_running_loop()
+
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(**_client_kwargs(key))
+            loop_clients[key] = client
+            logger.info(f"Nuovo client LLM async: config={configuration.pk}, base_url={key[1]}, timeout={key[2]}")
+        _track(configuration, key)
+
+    return client
+
+
+def invalidate_clients(configuration_pk=None):
+    """
+    Rimuove dal registry i client di una configurazione (o tutti se pk è None).
+
+    I client rimossi non vengono chiusi esplicitamente: eventuali stream ancora
+    in corso li stanno usando. Le connessioni vengono rilasciate dal garbage collector.
+
+    Args:
+        configuration_pk: pk della LLMConfiguration modificata
+    """
+    with _lock:
+        if configuration_pk is None:
+            keys = set(_sync_clients)
+            for loop_clients in _async_clients.values():
+                keys.update(loop_clients)
+            _configuration_keys.clear()
+        else:
+            keys = _configuration_keys.pop(configuration_pk, set())
+
+        for key in keys:
+            _sync_clients.pop(key, None)
+            for loop_clients in _async_clients.values():
+                loop_clients.pop(key, None)
+
+    if keys:
+        logger.info(f"Client LLM invalidati: config={configuration_pk}, count={len(keys)}")
@@ -0,0 +1,186 @@
+"""
+Metriche Prometheus del tutor (latenza, throughput, fasi, errori).
+
+Le metriche usano prometheus_client se installato (pip install prometheus-client),
+altrimenti le funzioni di registrazione non fanno nulla e l'endpoint /metrics
+risponde 503.
+
+Con più worker (gunicorn/uvicorn --workers N) ogni processo ha i propri
+contatori: impostare PROMETHEUS_MULTIPROC_DIR su una directory vuota e
+scrivibile, condivisa dai worker, prima dell'avvio. L'endpoint aggrega allora
+i valori di tutti i processi (vedi il README per la pulizia dei worker terminati).
+"""
+
+import logging
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Histogram, CollectorRegistry, multiprocess
+except ImportError:  # pragma: no cover - dipendenza opzionale
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+LABELS = ['configuration', 'provider', 'phase']
+
+# Secondi: dal ricevimento della richiesta al primo token / durata dell'estrazione
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0, 13.0, 21.0, 30.0)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 30, 40, 50, 75, 100, 150, 200, 300)
+
+if prometheus_client is not None:
+    REQUESTS = Counter(
+        'tutor_llm_requests', "Turni di /api/llm per configurazione e fase dell'agente", LABELS
+    )
+    ERRORS = Counter(
+        'tutor_llm_errors', 'Turni terminati con errore', LABELS + ['stage']
+    )
+    TIME_TO_FIRST_TOKEN = Histogram(
+        'tutor_llm_time_to_first_token_seconds', 'Tempo dalla richiesta al primo token inviato',
+        LABELS, buckets=LATENCY_BUCKETS
+    )
+    STREAM_DURATION = Histogram(
+        'tutor_llm_stream_duration_seconds', 'Durata complessiva del turno in streaming',
+        LABELS, buckets=LATENCY_BUCKETS
+    )
+    TOKENS_PER_SECOND = Histogram(
+        'tutor_llm_tokens_per_second', 'Token generati al secondo dopo il primo token',
+        LABELS, buckets=TOKENS_PER_SECOND_BUCKETS
+    )
+    TOKENS = Counter(
+        'tutor_llm_tokens', 'Token della chiamata dell\'agente', LABELS + ['kind']
+    )
+    CANCELLED = Counter(
+        'tutor_llm_cancelled', 'Turni annullati per disconnessione del client', LABELS
+    )
+    TOKENS_SAVED = Counter(
+        'tutor_llm_tokens_saved', 'Token non generati grazie all\'annullamento (stima su max_tokens)', LABELS
+    )
+    RESPONSE_CACHE = Counter(
+        'tutor_llm_response_cache', 'Letture della cache delle risposte (vedi home/response_cache.py)',
+        LABELS + ['outcome']
+    )
+    EXTRACTION_LATENCY = Histogram(
+        'tutor_extraction_latency_seconds', 'Latenza dell\'estrazione informazioni per livello',
+        LABELS + ['tier'], buckets=LATENCY_BUCKETS
+    )
+
+
+def _labels(configuration, phase):
+    if configuration is None:
+        return {'configuration': '', 'provider': '', 'phase': phase or ''}
+    return {'configuration': configuration.name, 'provider': configuration.provider, 'phase': phase or ''}
+
+
+def observe_extraction(configuration, phase, tier, seconds):
+    """Registra la latenza di un'estrazione (tier: local, cache, llm, fallback)"""
+    if prometheus_client is None:
+        return
+    EXTRACTION_LATENCY.labels(tier=tier, **_labels(configuration, phase)).observe(seconds)
+
+
+def observe_response_cache(configuration, phase, outcome):
+    """Conta una lettura della cache delle risposte (outcome: hit, miss)"""
+    if prometheus_client is None:
+        return
+    RESPONSE_CACHE.labels(outcome=outcome, **_labels(configuration, phase)).inc()
+
+
+def observe_error(configuration, phase, stage):
+    """Conta un errore (stage: request, stream, persistence)"""
+    if prometheus_client is None:
+        return
+    ERRORS.labels(stage=stage, **_labels(configuration, phase)).inc()
+
+
+class TurnMetrics:
+    """
+    Misura un turno di /api/llm dalla ricezione della richiesta alla fine dello stream.
+
+    Uso nel generatore SSE: start_phase() quando la fase è nota, first_token()
+    al primo token inviato, finish(usage) a fine stream, error(stage) in caso di errore,
+    cancelled(saved_tokens) se il client si disconnette.
+    """
+
+    def __init__(self, configuration, started=None):
+        self.configuration = configuration
+        self.started = started if started is not None else time.perf_counter()
+        self.phase = ''
+        self.first_token_at = None
+
+    def start_phase(self, phase):
+        self.phase = phase
+        if prometheus_client is not None:
+            REQUESTS.labels(**_labels(self.configuration, phase)).inc()
+
+    def first_token(self):
+        if self.first_token_at is not None:
+            return
+        self.first_token_at = time.perf_counter()
+        if prometheus_client is not None:
+            TIME_TO_FIRST_TOKEN.labels(**_labels(self.configuration, self.phase)).observe(
+                self.first_token_at - self.started
+            )
+
+    def finish(self, usage=None):
+        """
+        Chiude il turno.
+
+        Args:
+            usage: Dict restituito da read_usage (opzionale)
+        """
+        if prometheus_client is None:
+            return
+
+        now = time.perf_counter()
+        labels = _labels(self.configuration, self.phase)
+        STREAM_DURATION.labels(**labels).observe(now - self.started)
+
+        if not usage:
+            return
+
+        for kind in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+            TOKENS.labels(kind=kind.replace('_tokens', ''), **labels).inc(usage[kind])
+
+        generation_seconds = now - self.first_token_at if self.first_token_at is not None else 0
+        if generation_seconds > 0 and usage['completion_tokens']:
+            TOKENS_PER_SECOND.labels(**labels).observe(usage['completion_tokens'] / generation_seconds)
+
+    def error(self, stage):
+        observe_error(self.configuration, self.phase, stage)
+
+    def cancelled(self, saved_tokens):
+        """
+        Conta un turno annullato.
+
+        Args:
+            saved_tokens: Token stimati non generati (max_tokens meno quelli già ricevuti)
+        """
+        if prometheus_client is None:
+            return
+        labels = _labels(self.configuration, self.phase)
+        CANCELLED.labels(**labels).inc()
+        TOKENS_SAVED.labels(**labels).inc(saved_tokens)
+
+
+def is_available():
+    return prometheus_client is not None
+
+
+def render_metrics():
+    """
+    Metriche in formato testo Prometheus.
+
+    Con PROMETHEUS_MULTIPROC_DIR impostata aggrega i valori di tutti i worker.
+
+    Returns:
+        tuple: (contenuto, content type)
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:56
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0005_tool_llmconfiguration_tools'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='content_tokens',
+            field=models.IntegerField(blank=True, help_text='Token del contenuto (conteggio locale per il budget della cronologia)', null=True),
+        ),
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='context_window',
+            field=models.IntegerField(blank=True, help_text='Finestra di contesto del modello in token (vuoto = dedotta dal nome del modello)', null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
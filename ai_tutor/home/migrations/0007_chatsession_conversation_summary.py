@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0006_chatmessage_content_tokens_llmconfiguration_context_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='conversation_summary',
+            field=models.TextField(blank=True, help_text='Riassunto dei messaggi più vecchi, aggiornato in background'),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='summarized_message_count',
+            field=models.IntegerField(default=0, help_text='Numero di messaggi (dal più vecchio) già inclusi nel riassunto'),
+        ),
+    ]
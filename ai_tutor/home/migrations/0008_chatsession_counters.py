@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:02
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    ChatSession = apps.get_model('home', 'ChatSession')
+    ChatMessage = apps.get_model('home', 'ChatMessage')
+
+    messages = ChatMessage.objects.filter(session=OuterRef('pk')).order_by().values('session')
+    ChatSession.objects.update(
+        message_count=Coalesce(Subquery(messages.annotate(n=Count('pk')).values('n')), 0),
+        last_message_at=Subquery(messages.annotate(last=Max('timestamp')).values('last')),
+        total_tokens=Coalesce(
+            Subquery(messages.annotate(tokens=Sum('tokens_used')).values('tokens'), output_field=IntegerField()), 0
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0007_chatsession_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, help_text="Data dell'ultimo messaggio", null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.IntegerField(default=0, help_text='Numero di messaggi della sessione'),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='total_tokens',
+            field=models.IntegerField(default=0, help_text="Token cumulativi utilizzati dalle chiamate all'LLM della sessione"),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
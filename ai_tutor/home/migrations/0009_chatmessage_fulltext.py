@@ -0,0 +1,72 @@
+from django.db import migrations
+
+# Deve coincidere con home.search.SEARCH_CONFIG
+SEARCH_CONFIG = 'italian'
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE home_chatmessage_fts USING fts5(
+        content,
+        content='home_chatmessage',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER home_chatmessage_fts_insert AFTER INSERT ON home_chatmessage BEGIN
+        INSERT INTO home_chatmessage_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER home_chatmessage_fts_delete AFTER DELETE ON home_chatmessage BEGIN
+        INSERT INTO home_chatmessage_fts(home_chatmessage_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER home_chatmessage_fts_update AFTER UPDATE OF content ON home_chatmessage BEGIN
+        INSERT INTO home_chatmessage_fts(home_chatmessage_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO home_chatmessage_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Indicizza i messaggi già presenti
+    "INSERT INTO home_chatmessage_fts(home_chatmessage_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS home_chatmessage_fts_update",
+    "DROP TRIGGER IF EXISTS home_chatmessage_fts_delete",
+    "DROP TRIGGER IF EXISTS home_chatmessage_fts_insert",
+    "DROP TABLE IF EXISTS home_chatmessage_fts",
+]
+
+POSTGRESQL_FORWARD = [
+    f"CREATE INDEX home_chatmessage_content_fts ON home_chatmessage USING GIN (to_tsvector('{SEARCH_CONFIG}', content))",
+]
+
+POSTGRESQL_REVERSE = [
+    "DROP INDEX IF EXISTS home_chatmessage_content_fts",
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD})
+
+
+def drop_fulltext_index(apps, schema_editor):
+    _run(schema_editor, {'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRESQL_REVERSE})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0008_chatsession_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
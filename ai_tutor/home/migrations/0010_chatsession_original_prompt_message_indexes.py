@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:05
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_original_prompt(apps, schema_editor):
+    ChatSession = apps.get_model('home', 'ChatSession')
+    ChatMessage = apps.get_model('home', 'ChatMessage')
+
+    first_user_message = ChatMessage.objects.filter(
+        session=OuterRef('pk'), role='user'
+    ).order_by('timestamp', 'id').values('content')[:1]
+    # Sessioni senza messaggi utente: stringa vuota
+    ChatSession.objects.update(original_prompt=Coalesce(Subquery(first_user_message), Value('')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0009_chatmessage_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='original_prompt',
+            field=models.TextField(blank=True, help_text="Primo prompt dell'utente, salvato alla creazione della sessione"),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session', 'timestamp', 'id'], name='home_msg_session_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session', 'role', 'timestamp'], name='home_msg_session_role_ts_idx'),
+        ),
+        migrations.RunPython(backfill_original_prompt, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0010_chatsession_original_prompt_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='agent_phase',
+            field=models.CharField(blank=True, help_text="Fase dell'agente nel turno del messaggio", max_length=50),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='cached_tokens',
+            field=models.IntegerField(blank=True, help_text='Token di input letti dalla cache del provider', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='completion_tokens',
+            field=models.IntegerField(blank=True, help_text="Token generati dalla chiamata dell'agente", null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='extraction_completion_tokens',
+            field=models.IntegerField(blank=True, help_text='Token generati dalla chiamata di estrazione', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='extraction_prompt_tokens',
+            field=models.IntegerField(blank=True, help_text='Token di input della chiamata di estrazione', null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, help_text="Token di input della chiamata dell'agente", null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0011_chatmessage_token_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='trace',
+            field=models.JSONField(blank=True, help_text='Durata delle fasi del turno (vedi home/tracing.py)', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0012_chatmessage_trace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='truncated',
+            field=models.BooleanField(default=False, help_text='Risposta parziale: generazione annullata alla disconnessione del client'),
+        ),
+    ]
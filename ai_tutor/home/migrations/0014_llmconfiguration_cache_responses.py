@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_chatmessage_truncated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='cache_responses',
+            field=models.BooleanField(default=False, help_text='Riutilizza la risposta della fase di analisi per prompt iniziali identici (consigliato con temperature bassa)'),
+        ),
+    ]
@@ -155,6 +155,16 @@ class LLMConfiguration(models.Model):
         default=3,
         help_text="Numero di tentativi in caso di errore"
     )
+    context_window = models.IntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        help_text="Finestra di contesto del modello in token (vuoto = dedotta dal nome del modello)"
+    )
+    cache_responses = models.BooleanField(
+        default=False,
+        help_text="Riutilizza la risposta della fase di analisi per prompt iniziali identici (consigliato con temperature bassa)"
+    )
 
     # Stato e metadati
     is_active = models.BooleanField(default=True)
@@ -223,9 +233,9 @@ class LLMConfiguration(models.Model):
 
     def get_tools(self):
         """Restituisce i tools attivi formattati per l'API del provider"""
-        active_tools = self.tools.filter(is_active=True)
+        active_tools = list(self.tools.filter(is_active=True))
 
-        if not active_tools.exists():
+        if not active_tools:
             return []
 
         tools_list = []
@@ -310,6 +320,37 @@ class ChatSession(models.Model):
         help_text="Punteggio di confidence (0-100) sulla completezza delle informazioni raccolte"
     )
 
+    original_prompt = models.TextField(
+        blank=True,
+        help_text="Primo prompt dell'utente, salvato alla creazione della sessione"
+    )
+
+    # Riassunto incrementale dei messaggi più vecchi (sostituisce la cronologia esclusa)
+    conversation_summary = models.TextField(
+        blank=True,
+        help_text="Riassunto dei messaggi più vecchi, aggiornato in background"
+    )
+    summarized_message_count = models.IntegerField(
+        default=0,
+        help_text="Numero di messaggi (dal più vecchio) già inclusi nel riassunto"
+    )
+
+    # Contatori denormalizzati, aggiornati con F() a ogni scrittura dei messaggi
+    # (vedi home/persistence.py): l'admin non deve contare i messaggi riga per riga
+    message_count = models.IntegerField(
+        default=0,
+        help_text="Numero di messaggi della sessione"
+    )
+    last_message_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Data dell'ultimo messaggio"
+    )
+    total_tokens = models.IntegerField(
+        default=0,
+        help_text="Token cumulativi utilizzati dalle chiamate all'LLM della sessione"
+    )
+
     def __str__(self):
         return f"Chat {self.session_id} - {self.configuration.name} [{self.agent_phase}] ({self.confidence_score:.0f}%)"
 
@@ -328,6 +369,22 @@ class ChatMessage(models.Model):
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     tokens_used = models.IntegerField(null=True, blank=True, help_text="Token utilizzati per questo messaggio")
+    content_tokens = models.IntegerField(null=True, blank=True, help_text="Token del contenuto (conteggio locale per il budget della cronologia)")
+    agent_phase = models.CharField(max_length=50, blank=True, help_text="Fase dell'agente nel turno del messaggio")
+
+    # Usage restituito dal provider: chiamata dell'agente sulla risposta dell'assistente,
+    # chiamata di estrazione sul messaggio utente analizzato
+    prompt_tokens = models.IntegerField(null=True, blank=True, help_text="Token di input della chiamata dell'agente")
+    completion_tokens = models.IntegerField(null=True, blank=True, help_text="Token generati dalla chiamata dell'agente")
+    cached_tokens = models.IntegerField(null=True, blank=True, help_text="Token di input letti dalla cache del provider")
+    extraction_prompt_tokens = models.IntegerField(null=True, blank=True, help_text="Token di input della chiamata di estrazione")
+    extraction_completion_tokens = models.IntegerField(null=True, blank=True, help_text="Token generati dalla chiamata di estrazione")
+
+    # Riepilogo del trace del turno (sul messaggio utente): trace_id, total_ms e ms per fase
+    trace = models.JSONField(null=True, blank=True, help_text="Durata delle fasi del turno (vedi home/tracing.py)")
+
+    # Risposta interrotta perché il client si è disconnesso durante lo stream
+    truncated = models.BooleanField(default=False, help_text="Risposta parziale: generazione annullata alla disconnessione del client")
     
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
@@ -336,3 +393,9 @@ class ChatMessage(models.Model):
         ordering = ['timestamp']
         verbose_name = "Messaggio Chat"
         verbose_name_plural = "Messaggi Chat"
+        indexes = [
+            # Cronologia della sessione in ordine di tempo (l'id risolve i timestamp uguali)
+            models.Index(fields=['session', 'timestamp', 'id'], name='home_msg_session_ts_idx'),
+            # Messaggi di un ruolo nella sessione (es: primo messaggio utente)
+            models.Index(fields=['session', 'role', 'timestamp'], name='home_msg_session_role_ts_idx'),
+        ]
@@ -0,0 +1,78 @@
+"""
+Persistenza transazionale di un turno di chat.
+
+Un turno scrive lo stato della sessione (fase, confidence, info raccolte) e i
+messaggi utente/assistente. Invece di salvarli uno alla volta in autocommit
+(su SQLite ogni scrittura prende il lock dell'intero database), le scritture
+vengono raccolte durante lo stream e salvate insieme a fine turno in
+un'unica transazione.
+"""
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ChatSession, ChatMessage
+
+
+class TurnPersistence:
+    """Raccoglie le scritture di un turno e le salva in un'unica transazione"""
+
+    def __init__(self, session):
+        self.session = session
+        self.session_fields = set()
+        self.messages = []
+
+    def update_session(self, *fields):
+        """Segna i campi della sessione modificati nel turno"""
+        self.session_fields.update(fields)
+
+    def add_message(self, role, content, **fields):
+        """
+        Accoda un messaggio da salvare con il turno.
+
+        Returns:
+            ChatMessage: Messaggio non ancora salvato
+        """
+        message = ChatMessage(session=self.session, role=role, content=content, **fields)
+        self.messages.append(message)
+        return message
+
+    def commit(self):
+        """
+        Salva sessione e messaggi in un'unica transazione.
+
+        Una sessione nuova viene inserita qui, insieme ai suoi primi messaggi;
+        una esistente riceve un solo UPDATE con i campi modificati e i contatori
+        dei messaggi incrementati con F() (corretto anche con turni concorrenti).
+        """
+        now = timezone.now()
+        message_count = len(self.messages)
+        tokens = sum(message.tokens_used or 0 for message in self.messages)
+
+        with transaction.atomic():
+            if self.session._state.adding:
+                if message_count:
+                    self.session.message_count = message_count
+                    self.session.last_message_at = now
+                    self.session.total_tokens = tokens
+                self.session.save()
+            elif self.session_fields or message_count:
+                values = {field: getattr(self.session, field) for field in self.session_fields}
+                values['updated_at'] = now
+                if message_count:
+                    values['message_count'] = F('message_count') + message_count
+                    values['last_message_at'] = now
+                    values['total_tokens'] = F('total_tokens') + tokens
+                ChatSession.objects.filter(pk=self.session.pk).update(**values)
+
+            if self.messages:
+                ChatMessage.objects.bulk_create(self.messages)
+
+        self.session_fields.clear()
+        self.messages = []
+
+    async def acommit(self):
+        """Versione asincrona di commit (la transazione gira in un thread)"""
+        await sync_to_async(self.commit)()
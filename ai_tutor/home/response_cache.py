@@ -0,0 +1,110 @@
+"""
+Cache delle risposte dei turni che dipendono solo dal prompt.
+
+Il primo turno di ogni sessione (fase 'analyze') non ha cronologia: la
+risposta dipende solo dal prompt iniziale. In classe molti studenti partono
+dallo stesso prompt ("scrivi un articolo sul clima") e ognuno pagava la stessa
+chiamata con il prompt dell'agente più lungo. Con
+LLMConfiguration.cache_responses attivo la risposta viene salvata e i turni
+successivi con la stessa chiave la ricevono senza chiamare l'LLM.
+
+La chiave è l'hash di fase, system message renderizzati, prompt dell'utente
+normalizzato, modello e parametri della richiesta (temperatura inclusa).
+Le configurazioni con tools non usano la cache: la risposta dipende da dati
+esterni (es: web search).
+
+La cache usa l'alias 'responses' di CACHES (LRU + TTL con il backend locmem,
+vedi RESPONSE_CACHE_TTL e RESPONSE_CACHE_MAX_ENTRIES); l'endpoint ASGI usa
+aget_cached_response/aset_cached_response per non bloccare l'event loop
+con un backend di rete. Un hit viene
+restituito come stream di chunk nel formato di chat.completions, una parola
+per chunk: attraversa lo stesso percorso di una risposta dell'LLM
+(accorpamento dei frame SSE, metriche, salvataggio del turno).
+"""
+
+import hashlib
+import json
+import re
+from types import SimpleNamespace
+
+from django.core.cache import caches
+
+from .extraction import normalize_message
+from .metrics import observe_response_cache
+
+# Fasi la cui risposta dipende solo dal prompt (se il turno non ha cronologia)
+CACHEABLE_PHASES = ('analyze',)
+
+# Parole con lo spazio che le precede, come i token dello stream dell'LLM
+_CHUNK_PATTERN = re.compile(r'\s*\S+|\s+')
+
+
+def is_cacheable(configuration, phase, history, params):
+    """True se la risposta del turno può essere letta e salvata in cache"""
+    return (
+        configuration.cache_responses
+        and phase in CACHEABLE_PHASES
+        and not history
+        and not params.get('tools')
+    )
+
+
+def get_response_cache_key(phase, system_messages, prompt, model_name, params):
+    """
+    Chiave di cache della risposta di un turno.
+
+    Args:
+        phase: Fase dell'agente
+        system_messages: Da build_system_messages
+        prompt: Messaggio dell'utente
+        model_name: Modello della configurazione
+        params: Parametri della richiesta (temperatura, max_tokens, ...)
+
+    Returns:
+        str: Chiave di cache
+    """
+    raw = json.dumps(
+        [phase, system_messages, normalize_message(prompt), model_name, params],
+        sort_keys=True, ensure_ascii=False
+    )
+    return 'response:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def get_cached_response(key, configuration, phase):
+    """Risposta in cache (None se assente o scaduta)"""
+    content = caches['responses'].get(key)
+    observe_response_cache(configuration, phase, 'hit' if content is not None else 'miss')
+    return content
+
+
+async def aget_cached_response(key, configuration, phase):
+    """Variante asincrona di get_cached_response"""
+    content = await caches['responses'].aget(key)
+    observe_response_cache(configuration, phase, 'hit' if content is not None else 'miss')
+    return content
+
+
+def set_cached_response(key, content):
+    caches['responses'].set(key, content)
+
+
+async def aset_cached_response(key, content):
+    await caches['responses'].aset(key, content)
+
+
+def _chunk(text):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=None)],
+        usage=None
+    )
+
+
+def replay_chunks(content):
+    """Risposta in cache come stream di chunk di chat.completions"""
+    return [_chunk(piece) for piece in _CHUNK_PATTERN.findall(content)]
+
+
+async def areplay_chunks(content):
+    """Variante asincrona di replay_chunks (per il ciclo async for della view)"""
+    for chunk in replay_chunks(content):
+        yield chunk
@@ -0,0 +1,471 @@
+"""
+Stream SSE riprendibili di /api/llm.
+
+Ogni frame inviato al client riceve un ID evento `<turn_id>:<n>` e viene
+salvato nel buffer del turno nella cache 'streams'. Il buffer è scritto a
+intervalli (checkpoint ogni RESUMABLE_CHECKPOINT_MS, subito per il primo
+evento e per la chiusura del turno) e scade RESUMABLE_STREAM_GRACE secondi
+dopo la fine del turno.
+
+Ogni checkpoint scrive solo gli eventi nuovi, in un segmento a sé
+(`stream:<turn_id>:<n>`), e aggiorna l'intestazione del buffer
+(`stream:<turn_id>`) con la posizione di fine di ogni segmento: il costo di
+un checkpoint non cresce con la lunghezza della risposta, e una ripresa legge
+solo i segmenti successivi all'ultimo evento ricevuto. Il percorso asincrono
+usa le API asincrone della cache (aset_many, aget_many) per non bloccare
+l'event loop con un backend di rete come Redis.
+
+Se il client si disconnette il turno non si interrompe subito: la generazione
+prosegue in background e continua a riempire il buffer. Una riconnessione
+con l'header Last-Event-ID (POST su /api/llm o GET su /api/llm/stream/<turn_id>)
+riceve gli eventi successivi dal buffer, senza una nuova chiamata all'LLM.
+Se entro UPSTREAM_CANCEL_AFTER secondi nessun client riprende lo stream, il
+turno viene annullato: la risposta dell'upstream viene chiusa e la risposta
+parziale salvata come troncata (vedi stream() in home/views.py). La scadenza è
+controllata da un timer avviato alla disconnessione (un thread nel percorso
+sincrono, un task in quello asincrono), non all'arrivo dei frame: anche un
+upstream fermo, che non produce chunk, viene chiuso in tempo.
+
+Con più worker la cache 'streams' deve essere condivisa (STREAM_CACHE_URL,
+es: redis://localhost:6379/1).
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+STREAM_CACHE = 'streams'
+
+# Secondi senza checkpoint dopo i quali un turno non concluso è considerato perso
+# (worker terminato durante la generazione)
+STALE_AFTER = 60
+
+# Intervallo di lettura del buffer durante la ripresa di un turno ancora in corso
+POLL_INTERVAL = 0.1
+
+# Secondi di validità del segnale di presenza di un client che sta riprendendo lo stream
+READER_TIMEOUT = 2
+
+# Turni proseguiti in background dopo la disconnessione del client (percorso sincrono)
+_detached_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='llm-detached')
+
+# Task dei turni asincroni (riferimento forte finché non terminano)
+_background_tasks = set()
+
+
+def is_enabled():
+    return settings.RESUMABLE_STREAM_GRACE > 0
+
+
+def _buffer_key(turn_id):
+    return f"stream:{turn_id}"
+
+
+def _segment_key(turn_id, index):
+    return f"stream:{turn_id}:{index}"
+
+
+def _reader_key(turn_id):
+    return f"stream:{turn_id}:reader"
+
+
+def mark_reader(turn_id):
+    """Segnala che un client sta leggendo il buffer del turno (il turno non va annullato)"""
+    caches[STREAM_CACHE].set(_reader_key(turn_id), True, READER_TIMEOUT)
+
+
+async def amark_reader(turn_id):
+    await caches[STREAM_CACHE].aset(_reader_key(turn_id), True, READER_TIMEOUT)
+
+
+def has_reader(turn_id):
+    return caches[STREAM_CACHE].get(_reader_key(turn_id)) is not None
+
+
+async def ahas_reader(turn_id):
+    return await caches[STREAM_CACHE].aget(_reader_key(turn_id)) is not None
+
+
+def with_event_id(frame, event_id):
+    """Aggiunge il campo id all'ultimo evento del frame (un frame può contenerne più di uno)"""
+    start = frame.rfind('\n\n', 0, len(frame) - 2)
+    start = 0 if start == -1 else start + 2
+    return f"{frame[:start]}id: {event_id}\n{frame[start:]}"
+
+
+def parse_event_id(last_event_id):
+    """
+    Interpreta un Last-Event-ID.
+
+    Returns:
+        tuple: (turn_id, numero dell'ultimo evento ricevuto) oppure (None, 0) se non valido
+    """
+    turn_id, _, seq = (last_event_id or '').strip().rpartition(':')
+    if not turn_id or not seq.isdigit():
+        return None, 0
+    return turn_id, int(seq)
+
+
+class TurnStreamBuffer:
+    """Eventi di un turno con ID progressivi, salvati a checkpoint nella cache"""
+
+    def __init__(self, turn_id):
+        self.turn_id = turn_id
+        self.events = []
+        self.done = False
+        self.cancelled = False
+        self._close_upstream = None
+        self._last_checkpoint = None
+        # Posizione di fine di ogni segmento già scritto
+        self._segments = []
+        self._lock = threading.Lock()
+
+    def append(self, frame):
+        """
+        Registra un frame nel buffer.
+
+        Returns:
+            str: Frame con l'ID evento
+        """
+        with self._lock:
+            framed, checkpoint = self._add(frame)
+            if checkpoint:
+                self._write(checkpoint)
+        return framed
+
+    async def aappend(self, frame):
+        """Variante asincrona di append (un solo produttore: il task del turno)"""
+        framed, checkpoint = self._add(frame)
+        if checkpoint:
+            await self._awrite(checkpoint)
+        return framed
+
+    def finish(self):
+        """Ultimo checkpoint: il buffer resta disponibile per RESUMABLE_STREAM_GRACE secondi"""
+        with self._lock:
+            self.done = True
+            self._write(self._take_checkpoint(time.monotonic()))
+
+    async def afinish(self):
+        self.done = True
+        await self._awrite(self._take_checkpoint(time.monotonic()))
+
+    def watch_upstream(self, close):
+        """
+        Registra la funzione che chiude la risposta dell'upstream del turno
+        (percorso sincrono): il timer di annullamento la chiama anche mentre il
+        turno è fermo in attesa di un chunk.
+        """
+        with self._lock:
+            self._close_upstream = close
+            cancelled = self.cancelled
+        if cancelled:
+            close()
+
+    def cancel(self):
+        """Annulla il turno e chiude la risposta dell'upstream, se già aperta"""
+        with self._lock:
+            self.cancelled = True
+            close = self._close_upstream
+        if close is not None:
+            close()
+
+    def _add(self, frame):
+        framed = with_event_id(frame, f"{self.turn_id}:{len(self.events) + 1}")
+        self.events.append(framed)
+        now = time.monotonic()
+        interval = settings.RESUMABLE_CHECKPOINT_MS / 1000
+        if self._last_checkpoint is None or now - self._last_checkpoint >= interval:
+            return framed, self._take_checkpoint(now)
+        return framed, None
+
+    def _take_checkpoint(self, now):
+        """Valori da scrivere in cache: segmento con gli eventi nuovi (se ce ne sono) e intestazione"""
+        self._last_checkpoint = now
+        written = self._segments[-1] if self._segments else 0
+        values = {}
+        if len(self.events) > written:
+            values[_segment_key(self.turn_id, len(self._segments))] = self.events[written:]
+            self._segments.append(len(self.events))
+        # Segmento prima dell'intestazione: chi legge l'intestazione trova già il segmento
+        values[_buffer_key(self.turn_id)] = {
+            'segments': list(self._segments),
+            'done': self.done,
+            'updated': time.time(),
+        }
+        return values
+
+    def _timeout(self):
+        return settings.RESUMABLE_STREAM_GRACE if self.done else settings.RESUMABLE_STREAM_TTL
+
+    def _write(self, values):
+        try:
+            caches[STREAM_CACHE].set_many(values, self._timeout())
+        except Exception as e:
+            logger.warning(f"Checkpoint dello stream {self.turn_id} fallito: {str(e)}")
+
+    async def _awrite(self, values):
+        try:
+            await caches[STREAM_CACHE].aset_many(values, self._timeout())
+        except Exception as e:
+            logger.warning(f"Checkpoint dello stream {self.turn_id} fallito: {str(e)}")
+
+
+def _empty_header():
+    return {'segments': [], 'done': False, 'updated': time.time()}
+
+
+def open_buffer(turn_id):
+    """Buffer vuoto di un turno non ancora iniziato: una ripresa lo trova anche prima del primo evento"""
+    caches[STREAM_CACHE].set(_buffer_key(turn_id), _empty_header(), settings.RESUMABLE_STREAM_TTL)
+
+
+async def aopen_buffer(turn_id):
+    await caches[STREAM_CACHE].aset(_buffer_key(turn_id), _empty_header(), settings.RESUMABLE_STREAM_TTL)
+
+
+def buffer_exists(turn_id):
+    """True se il buffer del turno è in cache (legge solo l'intestazione)"""
+    return caches[STREAM_CACHE].get(_buffer_key(turn_id)) is not None
+
+
+async def abuffer_exists(turn_id):
+    return await caches[STREAM_CACHE].aget(_buffer_key(turn_id)) is not None
+
+
+def _segments_after(turn_id, header, after):
+    """Chiavi dei segmenti con eventi successivi ad after e posizione del primo evento del primo segmento"""
+    keys = []
+    first = None
+    start = 0
+    for index, end in enumerate(header['segments']):
+        if end > after:
+            keys.append(_segment_key(turn_id, index))
+            if first is None:
+                first = start
+        start = end
+    return keys, first or 0
+
+
+def _assemble(header, keys, segments, first, after):
+    # Un segmento scaduto prima dell'intestazione: il buffer non è più completo
+    if any(key not in segments for key in keys):
+        return None
+    events = [event for key in keys for event in segments[key]]
+    return {
+        'events': events[after - first:],
+        'done': header['done'],
+        'updated': header['updated'],
+    }
+
+
+def get_buffered_stream(turn_id, after=0):
+    """
+    Stato del buffer di un turno.
+
+    Args:
+        turn_id: ID del turno
+        after: Numero di eventi già ricevuti (vengono letti solo i segmenti successivi)
+
+    Returns:
+        dict | None: events (successivi ad after), done, updated; None se scaduto o inesistente
+    """
+    cache = caches[STREAM_CACHE]
+    header = cache.get(_buffer_key(turn_id))
+    if header is None:
+        return None
+    keys, first = _segments_after(turn_id, header, after)
+    return _assemble(header, keys, cache.get_many(keys) if keys else {}, first, after)
+
+
+async def aget_buffered_stream(turn_id, after=0):
+    """Variante asincrona di get_buffered_stream"""
+    cache = caches[STREAM_CACHE]
+    header = await cache.aget(_buffer_key(turn_id))
+    if header is None:
+        return None
+    keys, first = _segments_after(turn_id, header, after)
+    return _assemble(header, keys, await cache.aget_many(keys) if keys else {}, first, after)
+
+
+# Chiusura del buffer di un turno annullato (i client che riprendono ricevono la risposta parziale)
+CANCELLED_FRAME = 'data: {"content": "", "truncated": true}\n\ndata: [DONE]\n\n'
+
+
+def _start_cancel_timer(buffer, delay):
+    timer = threading.Timer(delay, _cancel_abandoned, args=(buffer,))
+    timer.daemon = True
+    timer.start()
+
+
+def _cancel_abandoned(buffer):
+    """
+    Scadenza del timer di annullamento (percorso sincrono): annulla il turno se
+    nessun client lo sta riprendendo, altrimenti ricontrolla dopo READER_TIMEOUT.
+    """
+    if buffer.done:
+        return
+    if has_reader(buffer.turn_id):
+        _start_cancel_timer(buffer, READER_TIMEOUT)
+        return
+    logger.info(f"Nessuna ripresa del turno {buffer.turn_id}: generazione annullata")
+    buffer.cancel()
+
+
+def _finish_detached(frames, buffer):
+    try:
+        for frame in frames:
+            buffer.append(frame)
+            if buffer.cancelled:
+                # Annullato dal timer tra due chunk: la view salva la risposta parziale
+                frames.close()
+                break
+    except Exception as e:
+        logger.error(f"Errore nel turno {buffer.turn_id} proseguito in background: {str(e)}")
+    finally:
+        if buffer.cancelled:
+            buffer.append(CANCELLED_FRAME)
+        buffer.finish()
+        close_old_connections()
+
+
+def relay_stream(frames, buffer):
+    """
+    Inoltra i frame di un turno registrandoli nel buffer.
+
+    Se il client si disconnette (close() del generatore) il resto del turno
+    viene consumato in background, così il buffer si completa e il turno viene
+    salvato, salvo annullamento dopo UPSTREAM_CANCEL_AFTER secondi senza riprese.
+    """
+    iterator = iter(frames)
+    try:
+        for frame in iterator:
+            yield buffer.append(frame)
+    except GeneratorExit:
+        logger.info(f"Client disconnesso dal turno {buffer.turn_id}: generazione proseguita in background")
+        _start_cancel_timer(buffer, settings.UPSTREAM_CANCEL_AFTER)
+        _detached_executor.submit(_finish_detached, iterator, buffer)
+        raise
+    buffer.finish()
+
+
+async def _acancel_abandoned(buffer, task):
+    """Timer di annullamento del percorso asincrono: cancella il task del turno (vedi _cancel_abandoned)"""
+    delay = settings.UPSTREAM_CANCEL_AFTER
+    while True:
+        await asyncio.sleep(delay)
+        if task.done():
+            return
+        if not await ahas_reader(buffer.turn_id):
+            logger.info(f"Nessuna ripresa del turno {buffer.turn_id}: generazione annullata")
+            buffer.cancelled = True
+            task.cancel()
+            return
+        delay = READER_TIMEOUT
+
+
+def _spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def arelay_stream(frames, buffer):
+    """
+    Variante asincrona di relay_stream.
+
+    Il turno gira in un task separato che scrive nel buffer: se la risposta
+    viene cancellata (client disconnesso) il task prosegue fino alla fine, o
+    fino all'annullamento come in relay_stream. Il timer di annullamento
+    cancella il task: la CancelledError arriva a stream() in home/views.py
+    anche mentre attende l'upstream.
+    """
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for frame in frames:
+                queue.put_nowait(await buffer.aappend(frame))
+        except asyncio.CancelledError:
+            if not buffer.cancelled:
+                raise
+        except Exception as e:
+            logger.error(f"Errore nel turno {buffer.turn_id}: {str(e)}")
+        finally:
+            try:
+                if buffer.cancelled:
+                    # Cancellato tra due frame: aclose() porta stream() al salvataggio della risposta parziale
+                    await frames.aclose()
+                    await buffer.aappend(CANCELLED_FRAME)
+            finally:
+                await buffer.afinish()
+                queue.put_nowait(None)
+
+    task = _spawn(produce())
+
+    try:
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                return
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        logger.info(f"Client disconnesso dal turno {buffer.turn_id}: generazione proseguita in background")
+        _spawn(_acancel_abandoned(buffer, task))
+        raise
+
+
+# Turno scaduto dal buffer o rimasto senza checkpoint per STALE_AFTER secondi
+INTERRUPTED_FRAME = 'data: {"content": "Errore: turno interrotto"}\n\ndata: [DONE]\n\n'
+
+
+def _pending_events(state):
+    """Eventi da inviare e indicazione se la ripresa è conclusa"""
+    events = state['events']
+    if state['done']:
+        return events, True
+    if time.time() - state['updated'] > STALE_AFTER:
+        return events + [INTERRUPTED_FRAME], True
+    return events, False
+
+
+def replay_stream(turn_id, after):
+    """Eventi del buffer successivi ad after, attendendo quelli nuovi finché il turno non termina"""
+    while True:
+        mark_reader(turn_id)
+        state = get_buffered_stream(turn_id, after)
+        if state is None:
+            yield INTERRUPTED_FRAME
+            return
+        events, finished = _pending_events(state)
+        after += len(events)
+        yield from events
+        if finished:
+            return
+        time.sleep(POLL_INTERVAL)
+
+
+async def areplay_stream(turn_id, after):
+    """Variante asincrona di replay_stream"""
+    while True:
+        await amark_reader(turn_id)
+        state = await aget_buffered_stream(turn_id, after)
+        if state is None:
+            yield INTERRUPTED_FRAME
+            return
+        events, finished = _pending_events(state)
+        after += len(events)
+        for event in events:
+            yield event
+        if finished:
+            return
+        await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,239 @@
+"""
+Ricerca full-text nei messaggi delle chat.
+
+search_fields = ['content'] diventa un LIKE '%...%' senza indice su tutti i
+messaggi. Qui la ricerca usa l'indice full-text del database:
+
+- SQLite: tabella virtuale FTS5 home_chatmessage_fts (external content su
+  home_chatmessage), tenuta allineata da trigger su INSERT/UPDATE/DELETE
+- PostgreSQL: indice GIN sull'espressione to_tsvector(SEARCH_CONFIG, content)
+
+Indice e trigger sono creati dalla migrazione 0009_chatmessage_fulltext.
+Su SQLite le migrazioni che ricostruiscono home_chatmessage (es: AddField)
+eliminano i trigger: ensure_fulltext_triggers li ricrea dopo ogni migrate
+(vedi home/signals.py). Su altri database la ricerca ripiega su icontains.
+"""
+
+import re
+
+from django.db import connection, connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .models import ChatMessage
+
+# Configurazione testuale di PostgreSQL (deve coincidere con quella dell'indice GIN)
+SEARCH_CONFIG = 'italian'
+
+FTS_TABLE = 'home_chatmessage_fts'
+
+# Marcatori dei termini trovati negli snippet (testo semplice, non HTML)
+SNIPPET_START = '**'
+SNIPPET_END = '**'
+
+# Token massimi di uno snippet SQLite / parole massime di uno snippet PostgreSQL
+SNIPPET_TOKENS = 16
+
+MAX_PAGE_SIZE = 50
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+FTS_TRIGGERS = {
+    'home_chatmessage_fts_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS home_chatmessage_fts_insert AFTER INSERT ON home_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+    'home_chatmessage_fts_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS home_chatmessage_fts_delete AFTER DELETE ON home_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    """,
+    'home_chatmessage_fts_update': f"""
+        CREATE TRIGGER IF NOT EXISTS home_chatmessage_fts_update AFTER UPDATE OF content ON home_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END
+    """,
+}
+
+
+def ensure_fulltext_triggers(using='default'):
+    """
+    Ricrea i trigger FTS5 mancanti e riallinea l'indice (solo SQLite).
+
+    Returns:
+        bool: True se qualche trigger mancava ed è stato ricreato
+    """
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return False
+
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT type, name FROM sqlite_master WHERE name = %s OR name LIKE %s",
+            [FTS_TABLE, 'home_chatmessage_fts_%']
+        )
+        existing = {name for _, name in cursor.fetchall()}
+        if FTS_TABLE not in existing:
+            return False
+
+        missing = [name for name in FTS_TRIGGERS if name not in existing]
+        if not missing:
+            return False
+
+        for name in missing:
+            cursor.execute(FTS_TRIGGERS[name])
+        # Indicizza i messaggi scritti mentre i trigger mancavano
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+    return True
+
+
+def build_fts_query(query):
+    """
+    Converte il testo dell'utente in una query FTS5 sicura.
+
+    Ogni parola diventa un termine tra virgolette (tutti richiesti), così la
+    sintassi FTS5 (AND, NEAR, *, :, virgolette) non può generare errori.
+
+    Returns:
+        str: Query FTS5 (vuota se il testo non contiene parole)
+    """
+    return ' '.join(f'"{term}"' for term in _TERM_RE.findall(query))
+
+
+def _fulltext_backend():
+    if connection.vendor in ('sqlite', 'postgresql'):
+        return connection.vendor
+    return None
+
+
+def filter_messages(queryset, query):
+    """
+    Filtra un queryset di ChatMessage con la ricerca full-text.
+
+    Args:
+        queryset: QuerySet di ChatMessage
+        query: Testo cercato
+
+    Returns:
+        QuerySet: Messaggi che contengono tutti i termini
+    """
+    backend = _fulltext_backend()
+
+    if backend == 'sqlite':
+        fts_query = build_fts_query(query)
+        if not fts_query:
+            return queryset.none()
+        return queryset.filter(pk__in=RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [fts_query]
+        ))
+
+    if backend == 'postgresql':
+        return queryset.filter(RawSQL(
+            f"to_tsvector('{SEARCH_CONFIG}', {ChatMessage._meta.db_table}.content) "
+            f"@@ websearch_to_tsquery('{SEARCH_CONFIG}', %s)",
+            [query], output_field=BooleanField()
+        ))
+
+    return queryset.filter(content__icontains=query)
+
+
+def _ranked_ids_sqlite(query, session_pk, limit, offset):
+    fts_query = build_fts_query(query)
+    if not fts_query:
+        return []
+
+    sql = (
+        f"SELECT m.id, -bm25({FTS_TABLE}), "
+        f"snippet({FTS_TABLE}, 0, %s, %s, '…', %s) "
+        f"FROM {FTS_TABLE} JOIN home_chatmessage m ON m.id = {FTS_TABLE}.rowid "
+        f"WHERE {FTS_TABLE} MATCH %s"
+    )
+    params = [SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, fts_query]
+    if session_pk is not None:
+        sql += " AND m.session_id = %s"
+        params.append(session_pk)
+    sql += f" ORDER BY bm25({FTS_TABLE}) LIMIT %s OFFSET %s"
+    params += [limit, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _ranked_ids_postgresql(query, session_pk, limit, offset):
+    document = f"to_tsvector('{SEARCH_CONFIG}', m.content)"
+    sql = (
+        f"SELECT m.id, ts_rank({document}, q), "
+        f"ts_headline('{SEARCH_CONFIG}', m.content, q, %s) "
+        f"FROM home_chatmessage m, websearch_to_tsquery('{SEARCH_CONFIG}', %s) q "
+        f"WHERE {document} @@ q"
+    )
+    options = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords={SNIPPET_TOKENS}, MinWords=5"
+    params = [options, query]
+    if session_pk is not None:
+        sql += " AND m.session_id = %s"
+        params.append(session_pk)
+    sql += " ORDER BY 2 DESC LIMIT %s OFFSET %s"
+    params += [limit, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _ranked_ids_fallback(query, session_pk, limit, offset):
+    queryset = ChatMessage.objects.filter(content__icontains=query).order_by('-timestamp', '-id')
+    if session_pk is not None:
+        queryset = queryset.filter(session_id=session_pk)
+    return [(pk, None, content[:200]) for pk, content in queryset.values_list('pk', 'content')[offset:offset + limit]]
+
+
+def search_messages(query, page=1, page_size=20, session_pk=None):
+    """
+    Cerca nei messaggi con risultati ordinati per rilevanza e paginati.
+
+    Args:
+        query: Testo cercato
+        page: Pagina (da 1)
+        page_size: Risultati per pagina (massimo MAX_PAGE_SIZE)
+        session_pk: Limita la ricerca a una sessione (pk della ChatSession)
+
+    Returns:
+        tuple: (lista di dict {'id', 'session_id', 'role', 'timestamp', 'rank', 'snippet'}, True se c'è una pagina successiva)
+    """
+    page = max(1, page)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+
+    ranked = {
+        'sqlite': _ranked_ids_sqlite,
+        'postgresql': _ranked_ids_postgresql,
+    }.get(_fulltext_backend(), _ranked_ids_fallback)
+
+    # Un risultato in più indica se esiste la pagina successiva (nessun COUNT)
+    rows = ranked(query, session_pk, page_size + 1, (page - 1) * page_size)
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+
+    messages = ChatMessage.objects.select_related('session').only(
+        'role', 'timestamp', 'session__session_id'
+    ).in_bulk([row[0] for row in rows])
+
+    results = []
+    for pk, rank, snippet in rows:
+        message = messages.get(pk)
+        if message is None:
+            continue
+        results.append({
+            'id': pk,
+            'session_id': message.session.session_id,
+            'role': message.role,
+            'timestamp': message.timestamp,
+            'rank': rank,
+            'snippet': snippet,
+        })
+
+    return results, has_next
@@ -0,0 +1,43 @@
+"""
+Signal receivers dell'app home.
+
+Mantengono coerenti le cache di processo quando i modelli cambiano.
+"""
+
+from django.db.models.signals import post_save, post_delete, m2m_changed, post_migrate
+from django.dispatch import receiver
+
+from .models import LLMConfiguration, Tool
+from .llm_clients import invalidate_clients
+from .config_snapshots import invalidate_snapshots
+from .search import ensure_fulltext_triggers
+
+
+@receiver(post_save, sender=LLMConfiguration)
+@receiver(post_delete, sender=LLMConfiguration)
+def invalidate_configuration_clients(sender, instance, **kwargs):
+    """Scarta i client LLM creati con i vecchi parametri della configurazione"""
+    invalidate_clients(instance.pk)
+
+
+@receiver(post_save, sender=LLMConfiguration)
+@receiver(post_delete, sender=LLMConfiguration)
+@receiver(post_save, sender=Tool)
+@receiver(post_delete, sender=Tool)
+def invalidate_configuration_snapshots(sender, **kwargs):
+    """Scarta gli snapshot precompilati quando cambia una configurazione o un tool"""
+    invalidate_snapshots()
+
+
+@receiver(m2m_changed, sender=LLMConfiguration.tools.through)
+def invalidate_snapshots_on_tools_change(sender, action, **kwargs):
+    """Scarta gli snapshot quando cambiano i tools associati a una configurazione"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_snapshots()
+
+
+@receiver(post_migrate)
+def restore_fulltext_triggers(sender, using, **kwargs):
+    """Ricrea i trigger FTS5 eliminati da migrazioni che ricostruiscono home_chatmessage"""
+    if sender.name == 'home':
+        ensure_fulltext_triggers(using)
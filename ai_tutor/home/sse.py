@@ -0,0 +1,120 @@
+"""
+Codifica degli eventi Server-Sent Events di /api/llm.
+
+Un frame `data:` per ogni delta dell'upstream significa un json.dumps e una
+scrittura per token: CPU sprecata e tanti pacchetti minuscoli per proxy e
+browser. SSEEncoder accumula i delta di contenuto e li invia in un unico frame
+quando:
+- è il primo token del turno (il TTFT non peggiora)
+- dall'ultimo frame è passato SSE_COALESCE_MS
+- il testo accumulato supera SSE_COALESCE_BYTES
+- arriva un altro evento (fase, confidence, errore), che viene inviato subito dopo
+
+Il JSON è in UTF-8 senza escape (ensure_ascii=False): accenti ed emoji
+occupano i loro byte invece delle sequenze \\uXXXX.
+
+Nel percorso sincrono il controllo del tempo avviene all'arrivo di ogni delta;
+nel percorso asincrono iterate_with_flush invia il testo accumulato anche se
+l'upstream si ferma per più di SSE_COALESCE_MS.
+"""
+
+import asyncio
+import json
+import time
+
+from django.conf import settings
+
+
+def sse_data(payload):
+    """Formatta un payload come evento Server-Sent Events"""
+    return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+
+class SSEEncoder:
+    """Accorpa i delta di contenuto dello stream in frame SSE"""
+
+    def __init__(self, window_ms=None, max_bytes=None):
+        if window_ms is None:
+            window_ms = settings.SSE_COALESCE_MS
+        if max_bytes is None:
+            max_bytes = settings.SSE_COALESCE_BYTES
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self.frames = 0
+        self._pending = []
+        self._size = 0
+        self._first = True
+        self._last_flush = time.monotonic()
+
+    def content(self, text):
+        """
+        Accoda un delta di contenuto.
+
+        Returns:
+            str: Frame da inviare ('' se il delta resta nel buffer)
+        """
+        self._pending.append(text)
+        self._size += len(text.encode())
+        if self._first or self._size >= self.max_bytes or time.monotonic() - self._last_flush >= self.window:
+            self._first = False
+            return self.flush()
+        return ''
+
+    def event(self, payload):
+        """Frame di un evento non di contenuto, preceduto dal contenuto ancora nel buffer"""
+        self.frames += 1
+        return self.flush() + sse_data(payload)
+
+    def flush(self):
+        """Frame con il contenuto nel buffer ('' se il buffer è vuoto)"""
+        if not self._pending:
+            return ''
+        frame = sse_data({"content": ''.join(self._pending)})
+        self._pending = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self.frames += 1
+        return frame
+
+    def pending_timeout(self):
+        """Secondi prima che il contenuto nel buffer vada inviato (None se il buffer è vuoto)"""
+        if not self._pending:
+            return None
+        return max(0.0, self.window - (time.monotonic() - self._last_flush))
+
+
+async def iterate_with_flush(stream, encoder):
+    """
+    Itera uno stream asincrono dell'upstream producendo None quando il
+    contenuto nel buffer di encoder va inviato prima del chunk successivo.
+    """
+    iterator = stream.__aiter__()
+    pending = None
+    try:
+        while True:
+            timeout = encoder.pending_timeout()
+            if pending is None and timeout is None:
+                # Buffer vuoto: nessuna scadenza, si attende direttamente il chunk
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                yield chunk
+                continue
+
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,125 @@
+"""
+Riassunto incrementale delle conversazioni lunghe.
+
+Quando la cronologia non entra più nel budget di token (vedi home/history.py)
+i messaggi più vecchi vengono esclusi dalla richiesta. Per non perderne il
+contenuto, ogni SUMMARY_EVERY_N_TURNS turni un job in background aggiorna
+ChatSession.conversation_summary con i messaggi non ancora riassunti, e il
+riassunto viene inviato al posto della cronologia esclusa.
+
+Il job gira fuori dal percorso della richiesta, in un thread dedicato, e
+viene saltato se la cronologia entra ancora per intero nel budget.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection
+
+from .models import ChatSession
+from .llm_clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# Messaggi più recenti lasciati sempre fuori dal riassunto (sono già nella cronologia)
+SUMMARY_KEEP_RECENT = 6
+
+# Caratteri massimi di ogni messaggio passati al riassunto
+SUMMARY_MESSAGE_CHARS = 2000
+
+# Token massimi del riassunto
+SUMMARY_MAX_TOKENS = 400
+
+# Durata del lock che evita due aggiornamenti contemporanei della stessa sessione
+SUMMARY_LOCK_TIMEOUT = 120
+
+SUMMARY_HEADER = "RIEPILOGO DELLA CONVERSAZIONE PRECEDENTE (messaggi più vecchi non inclusi nella cronologia):"
+
+SUMMARY_SYSTEM_PROMPT = """Sei un assistente che riassume conversazioni di tutoraggio sul prompt engineering.
+Aggiorna il riassunto esistente con i nuovi messaggi. Mantieni: obiettivo dell'utente, contesto,
+vincoli, formato richiesto, decisioni prese e domande ancora aperte. Scrivi in italiano, in modo
+conciso (massimo 200 parole), senza inventare informazioni."""
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summary')
+
+
+def build_summary_message(summary):
+    """
+    System message con il riassunto da inviare al posto della cronologia esclusa.
+
+    Args:
+        summary: Testo del riassunto
+
+    Returns:
+        dict | None: Messaggio in formato chat completions (None se non c'è riassunto)
+    """
+    if not summary:
+        return None
+    return {"role": "system", "content": f"{SUMMARY_HEADER}\n{summary}"}
+
+
+def schedule_summary_update(session_pk):
+    """Accoda l'aggiornamento del riassunto di una sessione (non blocca la richiesta)"""
+    if not cache.add(f'summary-lock:{session_pk}', True, timeout=SUMMARY_LOCK_TIMEOUT):
+        return
+    _summary_executor.submit(update_conversation_summary, session_pk)
+
+
+def update_conversation_summary(session_pk):
+    """
+    Aggiorna il riassunto di una sessione con i messaggi non ancora riassunti.
+
+    Args:
+        session_pk: pk della ChatSession
+    """
+    try:
+        session = ChatSession.objects.select_related('configuration').get(pk=session_pk)
+
+        end = session.message_count - SUMMARY_KEEP_RECENT
+        if end <= session.summarized_message_count:
+            return
+
+        pending = list(
+            session.messages.order_by('timestamp', 'id')
+            .values_list('role', 'content')[session.summarized_message_count:end]
+        )
+
+        transcript = "\n\n".join(
+            f"{role.upper()}: {content[:SUMMARY_MESSAGE_CHARS]}" for role, content in pending
+        )
+        configuration = session.configuration
+
+        response = get_client(configuration).chat.completions.create(
+            model=configuration.model_name,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": (
+                    f"RIASSUNTO ESISTENTE:\n{session.conversation_summary or '(nessuno)'}\n\n"
+                    f"NUOVI MESSAGGI:\n{transcript}"
+                )},
+            ],
+            temperature=0.3,
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+        summary = response.choices[0].message.content.strip()
+
+        # Aggiorna solo se nessun altro job ha già avanzato il riassunto
+        updated = ChatSession.objects.filter(
+            pk=session_pk,
+            summarized_message_count=session.summarized_message_count
+        ).update(
+            conversation_summary=summary,
+            summarized_message_count=session.summarized_message_count + len(pending)
+        )
+
+        if updated:
+            logger.info(f"Session {session.session_id}: riassunto aggiornato (+{len(pending)} messaggi)")
+
+    except Exception as e:
+        logger.warning(f"Aggiornamento riassunto fallito per sessione {session_pk}: {str(e)}")
+
+    finally:
+        cache.delete(f'summary-lock:{session_pk}')
+        # Il job gira in un thread del pool: chiudi la sua connessione al database
+        connection.close()
@@ -1,3 +1,1755 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from .models import LLMConfiguration, ChatSession, ChatMessage, Tool
+from .config_snapshots import get_configuration_snapshot
+from .search import search_messages
+from .usage import get_prompt_cache_stats, get_token_usage_by_configuration, get_token_usage_by_phase
+from .extraction import (
+    aextract_info_from_response, classify_locally, extract_info_from_response,
+    get_extraction_tier_stats, get_extraction_cache_stats, get_cached_extraction, set_cached_extraction
+)
+from .llm_clients import invalidate_clients
+from .metrics import is_available as metrics_available
+from .persistence import TurnPersistence
+from .history import (
+    MESSAGE_OVERHEAD_TOKENS, TRUNCATION_MARKER, count_tokens, get_context_window, get_history_budget, pack_history
+)
+from .summary import SUMMARY_HEADER, SUMMARY_KEEP_RECENT, update_conversation_summary
+from .tracing import JsonlExporter, Trace
+from .sse import SSEEncoder, iterate_with_flush
+from .resumable import (
+    TurnStreamBuffer, aget_buffered_stream, arelay_stream, areplay_stream, get_buffered_stream
+)
+from . import response_cache
+from .views import build_agent_context
+
+# I trace dei turni dei test non vengono esportati (TracingTests usa un file temporaneo)
+_no_trace_export = override_settings(TRACING_EXPORTER='none')
+
+
+def setUpModule():
+    _no_trace_export.enable()
+
+
+def tearDownModule():
+    _no_trace_export.disable()
+
+
+def fake_stream(*tokens, usage=None):
+    """Chunk in formato chat.completions.create(stream=True)"""
+    chunks = [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))], usage=None)
+        for token in tokens
+    ]
+    chunks.append(SimpleNamespace(choices=[], usage=usage))
+    return chunks
+
+
+def sse_events(body):
+    """Payload JSON degli eventi data: di una risposta SSE"""
+    return [
+        json.loads(line[len('data: '):])
+        for line in body.split('\n') if line.startswith('data: ') and line != 'data: [DONE]'
+    ]
+
+
+def first_event(body):
+    return sse_events(body)[0]
+
+
+def client_with(create):
+    """Client OpenAI (o AsyncOpenAI) finto con il create indicato"""
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class LLMTurnTestMixin:
+    """
+    Fixture dei test dei turni di /api/llm: configurazione di default e client
+    OpenAI finti. self.upstream e self.async_upstream registrano le chiamate
+    all'LLM della view sincrona e di quella asincrona.
+    """
+
+    # Token e usage dello stream finto, campi della configurazione diversi dal default
+    TOKENS = ("Ciao", "!")
+    USAGE = None
+    CONFIGURATION = {}
+
+    STARTER = "scrivi un articolo sul clima"
+
+    def setUp(self):
+        super().setUp()
+        self.configuration = LLMConfiguration.objects.create(**{
+            'name': "Test", 'model_name': "gpt-4o-mini", 'api_key': "test", 'is_default': True,
+            **self.CONFIGURATION
+        })
+        self.upstream = mock.Mock(side_effect=lambda **kwargs: fake_stream(*self.TOKENS, usage=self.USAGE))
+
+        async def acreate(**kwargs):
+            async def stream():
+                for chunk in fake_stream(*self.TOKENS, usage=self.USAGE):
+                    yield chunk
+            return stream()
+
+        self.async_upstream = mock.AsyncMock(side_effect=acreate)
+        self.patch_upstream()
+
+    def patch_upstream(self):
+        """Sostituisce i client delle view con quelli finti"""
+        self.patch('home.views.get_client', return_value=client_with(self.upstream))
+        self.patch('home.views.get_async_client', return_value=client_with(self.async_upstream))
+
+    def use_stream(self, stream):
+        """Stream restituito dall'LLM finto al posto dei TOKENS (es: ClosableStream)"""
+        async def acreate(**kwargs):
+            return stream
+
+        self.upstream.side_effect = lambda **kwargs: stream
+        self.async_upstream.side_effect = acreate
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        patched = patcher.start()
+        self.addCleanup(patcher.stop)
+        return patched
+
+    def request_body(self, prompt, session_id):
+        return json.dumps({"prompt": prompt, "session_id": session_id})
+
+    def start_turn(self, prompt=None, session_id=None, path='/api/llm/sync', **headers):
+        """Risposta della view sincrona, con lo stream ancora da leggere"""
+        return self.client.post(
+            path, self.request_body(prompt or self.STARTER, session_id),
+            content_type='application/json', headers=headers
+        )
+
+    def post_turn(self, prompt=None, session_id=None, path='/api/llm/sync', **headers):
+        """
+        Turno completo sulla view sincrona.
+
+        Returns:
+            tuple: (risposta, corpo SSE o None se la risposta non è uno stream)
+        """
+        response = self.start_turn(prompt, session_id, path, **headers)
+        if not response.streaming:
+            return response, None
+        return response, b''.join(response.streaming_content).decode()
+
+    async def apost_turn(self, prompt=None, session_id=None, path='/api/llm/async', **headers):
+        """Variante di post_turn per la view asincrona (da eseguire con async_to_sync)"""
+        response = await self.async_client.post(
+            path, self.request_body(prompt or self.STARTER, session_id),
+            content_type='application/json', headers=headers
+        )
+        if not response.streaming:
+            return response, None
+        return response, ''.join([chunk.decode() async for chunk in response.streaming_content])
+
+    def session_turn(self, prompt=None, session_id=None, path='/api/llm/sync'):
+        """Turno completo sulla view sincrona, restituisce il session_id"""
+        return first_event(self.post_turn(prompt, session_id, path)[1])['session_id']
+
+    def asession_turn(self, prompt=None, session_id=None, path='/api/llm/async'):
+        """Turno completo sulla view asincrona, restituisce il session_id"""
+        return first_event(async_to_sync(self.apost_turn)(prompt, session_id, path)[1])['session_id']
+
+
+class LLMApiQueryCountTests(LLMTurnTestMixin, TestCase):
+    """Numero di query per turno di /api/llm (regressioni sulla persistenza del turno)"""
+
+    def writes(self, queries):
+        return [q['sql'].split()[0] for q in queries if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+    def test_first_turn(self):
+        # snapshot della configurazione (configurazione + tools), poi sessione + messaggi in una transazione
+        with self.assertNumQueries(6) as ctx:
+            self.post_turn()
+
+        self.assertEqual(self.writes(ctx.captured_queries), ['INSERT', 'INSERT'])
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    def test_follow_up_turn(self):
+        session_id = self.session_turn()
+
+        # sessione, messaggi recenti, poi UPDATE + bulk INSERT in una transazione (configurazione in memoria)
+        with self.assertNumQueries(6) as ctx:
+            self.post_turn("per studenti delle medie", session_id)
+
+        self.assertEqual(self.writes(ctx.captured_queries), ['UPDATE', 'INSERT'])
+
+        session = ChatSession.objects.get(session_id=session_id)
+        self.assertEqual(session.iteration_count, 2)
+        self.assertEqual(
+            list(session.messages.values_list('role', flat=True)),
+            ['user', 'assistant', 'user', 'assistant']
+        )
+
+    def test_original_prompt_captured_at_creation(self):
+        session_id = self.session_turn()
+        self.post_turn("per studenti delle medie", session_id)
+
+        session = ChatSession.objects.get(session_id=session_id)
+        self.assertEqual(session.original_prompt, "scrivi un articolo sul clima")
+
+        # Nessuna query per ricostruire il contesto dell'agente
+        with self.assertNumQueries(0):
+            context = build_agent_context(session, "altro")
+        self.assertEqual(context['original_prompt'], "scrivi un articolo sul clima")
+
+    def test_failed_stream_still_saves_turn(self):
+        session_id = self.session_turn()
+
+        self.upstream.side_effect = RuntimeError("upstream down")
+        self.post_turn("per studenti delle medie", session_id)
+
+        session = ChatSession.objects.get(session_id=session_id)
+        self.assertEqual(session.iteration_count, 2)
+        self.assertEqual(session.messages.filter(role='user').count(), 2)
+        self.assertEqual(session.messages.filter(role='assistant').count(), 1)
+
+
+class LLMApiAsyncQueryCountTests(LLMTurnTestMixin, TestCase):
+    """Numero di query per turno di /api/llm/async"""
+
+    def test_follow_up_turn(self):
+        # assertNumQueries deve girare fuori dall'event loop: il turno viene eseguito con async_to_sync
+        session_id = self.asession_turn()
+
+        with self.assertNumQueries(6):
+            self.asession_turn("per studenti delle medie", session_id)
+
+
+class LLMApiAsyncTests(LLMTurnTestMixin, TestCase):
+    """Turno completo di /api/llm/async con AsyncOpenAI finto, confrontato con /api/llm/sync"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+
+    def patch_upstream(self):
+        # Client finti creati dal registry (home/llm_clients.py), non sostituiti nella view
+        invalidate_clients()
+        self.addCleanup(invalidate_clients)
+        self.patch('home.llm_clients.OpenAI', return_value=client_with(self.upstream))
+        self.patch('home.llm_clients.AsyncOpenAI', return_value=client_with(self.async_upstream))
+
+    def assert_turn(self, turn, prompt):
+        response, body = turn
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = sse_events(body)
+        session = ChatSession.objects.get(session_id=events[0]['session_id'])
+
+        self.assertEqual(''.join(event.get('content', '') for event in events), "Ciao a tutti")
+        self.assertEqual(events[1]['agent_phase'], session.agent_phase)
+        self.assertTrue(body.endswith("data: [DONE]\n\n"))
+
+        messages = list(session.messages.order_by('timestamp', 'id').values_list('role', 'content'))
+        self.assertEqual(messages[-2:], [('user', prompt), ('assistant', "Ciao a tutti")])
+        self.assertEqual(session.message_count, len(messages))
+        return session
+
+    def test_async_turn(self):
+        session = self.assert_turn(async_to_sync(self.apost_turn)(), self.STARTER)
+        self.assertEqual(session.iteration_count, 1)
+
+        request = self.async_upstream.call_args.kwargs
+        self.assertEqual(request['model'], "gpt-4o-mini")
+        self.assertTrue(request['stream'])
+        self.assertEqual(request['messages'][-1], {"role": "user", "content": self.STARTER})
+
+        turn = async_to_sync(self.apost_turn)("per studenti delle medie", session.session_id)
+        session = self.assert_turn(turn, "per studenti delle medie")
+        self.assertEqual(session.iteration_count, 2)
+        self.assertEqual(session.message_count, 4)
+        self.upstream.assert_not_called()
+
+    def test_same_turn_as_sync_route(self):
+        sync_session = self.assert_turn(self.post_turn(), self.STARTER)
+        async_session = self.assert_turn(async_to_sync(self.apost_turn)(), self.STARTER)
+
+        fields = ('agent_phase', 'iteration_count', 'confidence_score', 'collected_info', 'message_count')
+        self.assertEqual(
+            [getattr(async_session, field) for field in fields],
+            [getattr(sync_session, field) for field in fields]
+        )
+        self.assertEqual(
+            self.async_upstream.call_args.kwargs['messages'], self.upstream.call_args.kwargs['messages']
+        )
+
+
+class ConfigurationSnapshotTests(TestCase):
+    """Snapshot delle configurazioni in memoria e invalidazione via segnali"""
+
+    def setUp(self):
+        self.configuration = LLMConfiguration.objects.create(
+            name="Test", model_name="gpt-4o-mini", api_key="test", is_default=True
+        )
+        self.tool = Tool.objects.create(
+            name="web_search", display_name="Web Search", description="Ricerca web",
+            provider="openai", tool_type="web_search"
+        )
+
+    def test_cached_snapshot_needs_no_queries(self):
+        get_configuration_snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_configuration_snapshot().pk, self.configuration.pk)
+            self.assertEqual(get_configuration_snapshot(self.configuration.pk).model_name, "gpt-4o-mini")
+
+    def test_returned_values_are_copies(self):
+        snapshot = get_configuration_snapshot()
+        snapshot.get_api_parameters()['tools'] = ['x']
+        self.assertNotIn('tools', snapshot.get_api_parameters())
+        with self.assertRaises(AttributeError):
+            snapshot.model_name = "gpt-4o"
+
+    def test_configuration_save_invalidates(self):
+        get_configuration_snapshot()
+        self.configuration.model_name = "gpt-4o"
+        self.configuration.save()
+        self.assertEqual(get_configuration_snapshot().model_name, "gpt-4o")
+
+    def test_tools_change_invalidates(self):
+        self.assertEqual(get_configuration_snapshot().get_tools(), [])
+
+        self.configuration.tools.add(self.tool)
+        self.assertEqual(get_configuration_snapshot().get_tools(), [{'type': 'web_search'}])
+
+        self.tool.is_active = False
+        self.tool.save()
+        self.assertEqual(get_configuration_snapshot().get_tools(), [])
+
+    def test_inactive_configuration_not_found(self):
+        self.configuration.is_active = False
+        self.configuration.save()
+        self.assertIsNone(get_configuration_snapshot(self.configuration.pk))
+        self.assertIsNone(get_configuration_snapshot())
+
+
+class ChatSessionCountersTests(LLMTurnTestMixin, TestCase):
+    """Contatori denormalizzati di ChatSession"""
+
+    USAGE = SimpleNamespace(prompt_tokens=100, completion_tokens=20, prompt_tokens_details=None)
+
+    def test_counters_follow_messages(self):
+        session_id = self.session_turn()
+        self.post_turn("per studenti delle medie", session_id)
+
+        session = ChatSession.objects.get(session_id=session_id)
+        self.assertEqual(session.message_count, 4)
+        self.assertEqual(session.message_count, session.messages.count())
+        self.assertEqual(session.total_tokens, 240)
+        self.assertAlmostEqual(
+            session.last_message_at, session.messages.last().timestamp, delta=timedelta(seconds=1)
+        )
+
+    def test_admin_changelist_queries_do_not_grow_with_sessions(self):
+        admin_user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin_user)
+        self.post_turn()
+
+        with self.assertNumQueries(7):
+            self.client.get('/admin/home/chatsession/')
+
+        for _ in range(5):
+            self.post_turn()
+
+        with self.assertNumQueries(7):
+            response = self.client.get('/admin/home/chatsession/')
+        self.assertEqual(response.status_code, 200)
+
+
+class MessageSearchTests(TestCase):
+    """Ricerca full-text nei messaggi (indice FTS5 su SQLite)"""
+
+    def setUp(self):
+        configuration = LLMConfiguration.objects.create(name="Test", model_name="gpt-4o-mini", api_key="test")
+        self.session = ChatSession.objects.create(session_id="s1", configuration=configuration)
+        self.other = ChatSession.objects.create(session_id="s2", configuration=configuration)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(session=self.session, role='user', content="Scrivi un articolo sul cambiamento climatico"),
+            ChatMessage(session=self.session, role='assistant', content="Il clima cambia: clima, clima e ancora clima"),
+            ChatMessage(session=self.other, role='user', content="Un riassunto sul clima per la classe"),
+            ChatMessage(session=self.other, role='user', content="Una poesia sul mare"),
+            ChatMessage(session=self.other, role='assistant', content="Ecco una poesia sulle onde"),
+            ChatMessage(session=self.other, role='user', content="Rendila più breve"),
+        ])
+
+    def test_ranked_results(self):
+        results, has_next = search_messages("clima")
+        self.assertFalse(has_next)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['role'], 'assistant')
+        self.assertIn("**clima**", results[0]['snippet'])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = ChatMessage.objects.get(content__contains="mare")
+        message.content = "Una poesia sul clima"
+        message.save()
+        self.assertEqual(len(search_messages("clima")[0]), 3)
+
+        message.delete()
+        self.assertEqual(len(search_messages("mare")[0]), 0)
+
+    def test_pagination_and_session_filter(self):
+        results, has_next = search_messages("clima", page=1, page_size=1)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(has_next)
+
+        results, _ = search_messages("clima", session_pk=self.other.pk)
+        self.assertEqual([r['session_id'] for r in results], ["s2"])
+
+    def test_fts_syntax_is_escaped(self):
+        self.assertEqual(search_messages('clima" OR (mare*')[0], [])
+        self.assertEqual(search_messages('"()*')[0], [])
+
+    def test_endpoint_requires_session_for_non_staff(self):
+        response = self.client.get('/api/messages/search', {'q': 'clima'})
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get('/api/messages/search', {'q': 'clima', 'session_id': 's1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def test_admin_search_uses_index(self):
+        admin_user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(admin_user)
+
+        response = self.client.get('/admin/home/chatmessage/', {'q': 'clima'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+        response = self.client.get('/admin/home/chatmessage/', {'q': 's2'})
+        self.assertEqual(response.context['cl'].result_count, 4)
+
+
+class SessionHistoryTests(TestCase):
+    """Cronologia paginata con cursore e GET condizionale"""
+
+    def setUp(self):
+        configuration = LLMConfiguration.objects.create(name="Test", model_name="gpt-4o-mini", api_key="test")
+        self.session = ChatSession.objects.create(session_id="s1", configuration=configuration, message_count=5)
+        # bulk_create: i messaggi possono avere lo stesso timestamp, il cursore usa anche l'id
+        ChatMessage.objects.bulk_create([
+            ChatMessage(session=self.session, role='user' if i % 2 == 0 else 'assistant', content=f"messaggio {i}")
+            for i in range(5)
+        ])
+        self.url = '/api/session/s1/history'
+
+    def test_keyset_pagination(self):
+        contents = []
+        cursor = None
+        pages = 0
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(self.url, params).json()
+            contents += [m['content'] for m in data['messages']]
+            pages += 1
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(contents, [f"messaggio {i}" for i in range(5)])
+
+    def test_page_size_is_capped(self):
+        with mock.patch('home.views.HISTORY_MAX_PAGE_SIZE', 3):
+            data = self.client.get(self.url, {'limit': 1000}).json()
+        self.assertEqual(len(data['messages']), 3)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'non-valido'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 0}).status_code, 400)
+        self.assertEqual(self.client.get('/api/session/manca/history').status_code, 404)
+
+    def test_unchanged_history_returns_304_without_reading_messages(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_turn_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+
+        turn = TurnPersistence(self.session)
+        turn.add_message('user', "nuovo messaggio")
+        turn.commit()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['messages'][-1]['content'], "nuovo messaggio")
+
+
+@override_settings(EXTRACTION_MODE='inline', EXTRACTION_LOCAL_THRESHOLD=2.0)
+class TokenUsageTests(LLMTurnTestMixin, TestCase):
+    """Usage delle chiamate dell'agente e di estrazione salvato sui messaggi"""
+
+    USAGE = SimpleNamespace(
+        prompt_tokens=100, completion_tokens=20, prompt_tokens_details=SimpleNamespace(cached_tokens=64)
+    )
+
+    def setUp(self):
+        super().setUp()
+        # Risultati di estrazione di altri test: qui serve la chiamata all'LLM
+        caches['extraction'].clear()
+        self.patch('home.extraction.get_client', return_value=client_with(lambda **kwargs: extraction_response(
+            '{"category": "contesto", "value": "studenti delle medie", "confidence": 0.9}'
+        )))
+
+    def test_usage_saved_on_messages(self):
+        session_id = self.session_turn()
+        self.post_turn("il testo è per una classe di ragazzi", session_id)
+
+        messages = list(ChatSession.objects.get(session_id=session_id).messages.order_by('timestamp', 'id'))
+        assistant = messages[-1]
+        self.assertEqual(
+            (assistant.prompt_tokens, assistant.cached_tokens, assistant.completion_tokens, assistant.tokens_used),
+            (100, 64, 20, 120)
+        )
+
+        user = messages[-2]
+        self.assertEqual((user.extraction_prompt_tokens, user.extraction_completion_tokens, user.tokens_used), (50, 10, 60))
+        self.assertEqual(user.agent_phase, assistant.agent_phase)
+        # Primo turno: nessuna estrazione
+        self.assertIsNone(messages[0].tokens_used)
+
+    def test_aggregates(self):
+        session_id = self.session_turn()
+        self.post_turn("il testo è per una classe di ragazzi", session_id)
+
+        by_configuration = get_token_usage_by_configuration()
+        self.assertEqual(len(by_configuration), 1)
+        self.assertEqual(by_configuration[0]['session__configuration__name'], "Test")
+        self.assertEqual(by_configuration[0]['total_tokens'], 120 + 60 + 120)
+        self.assertEqual(by_configuration[0]['extraction_prompt_tokens'], 50)
+
+        by_phase = {row['agent_phase']: row for row in get_token_usage_by_phase()}
+        self.assertEqual(sum(row['total_tokens'] for row in by_phase.values()), 300)
+        self.assertEqual(by_phase['analyze']['prompt_tokens'], 100)
+
+        self.assertEqual(self.client.get('/api/usage').status_code, 403)
+
+    def test_prompt_cache_stats_in_usage_endpoint(self):
+        # Contatori del processo: confronto con i valori prima del turno
+        before = get_prompt_cache_stats().get('analyze', {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+        self.post_turn()
+        User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.login(username="staff", password="pw")
+
+        stats = self.client.get('/api/usage').json()['prompt_cache']['analyze']
+        self.assertEqual(
+            (stats['requests'] - before['requests'], stats['prompt_tokens'] - before['prompt_tokens'],
+             stats['cached_tokens'] - before['cached_tokens']),
+            (1, 100, 64)
+        )
+        self.assertEqual(stats['hit_rate'], round(stats['cached_tokens'] / stats['prompt_tokens'], 3))
+
+
+@skipUnless(metrics_available(), "prometheus-client non installato")
+class MetricsTests(LLMTurnTestMixin, TestCase):
+    """Endpoint Prometheus /metrics"""
+
+    CONFIGURATION = {'name': "Metriche"}
+    USAGE = SimpleNamespace(prompt_tokens=100, completion_tokens=20, prompt_tokens_details=None)
+
+    def sample(self, text, name, **labels):
+        """Valore di una serie nel formato testo Prometheus (0 se assente)"""
+        selector = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+        for line in text.splitlines():
+            if line.startswith(name + '{'):
+                series, value = line.rsplit(' ', 1)
+                series_labels = ','.join(sorted(series[len(name) + 1:-1].split(',')))
+                if series_labels == selector:
+                    return float(value)
+        return 0.0
+
+    def test_turn_metrics_exported(self):
+        labels = {'configuration': "Metriche", 'provider': 'openai', 'phase': 'analyze'}
+        before = self.client.get('/metrics').content.decode()
+
+        self.post_turn()
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        after = response.content.decode()
+
+        for name in ('tutor_llm_requests_total', 'tutor_llm_time_to_first_token_seconds_count',
+                     'tutor_llm_stream_duration_seconds_count', 'tutor_llm_tokens_per_second_count'):
+            self.assertEqual(self.sample(after, name, **labels) - self.sample(before, name, **labels), 1, name)
+
+        self.assertEqual(
+            self.sample(after, 'tutor_llm_tokens_total', kind='completion', **labels)
+            - self.sample(before, 'tutor_llm_tokens_total', kind='completion', **labels),
+            20
+        )
+
+    @override_settings(METRICS_TOKEN='segreto')
+    def test_token_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer segreto').status_code, 200)
+
+
+class TracingTests(LLMTurnTestMixin, TestCase):
+    """Span per fase dei turni di /api/llm ed export JSONL"""
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.trace_path = Path(tmp.name) / 'traces.jsonl'
+        tracing = override_settings(TRACING_EXPORTER='jsonl', TRACING_JSONL_PATH=str(self.trace_path))
+        tracing.enable()
+        self.addCleanup(tracing.disable)
+
+    def traced_turn(self, prompt=None, session_id=None):
+        response, body = self.post_turn(prompt, session_id)
+        event = first_event(body)
+        self.assertEqual(response['X-Trace-Id'], event['trace_id'])
+        return event
+
+    def test_span_nesting(self):
+        trace = Trace()
+        with trace.span('stream'):
+            pass
+        with self.assertRaises(ValueError):
+            with trace.span('persistence'):
+                raise ValueError("errore")
+
+        self.assertEqual([span['name'] for span in trace.spans], ['stream', 'persistence'])
+        self.assertEqual(trace.spans[1]['error'], 'ValueError')
+        self.assertEqual(set(trace.summary()['stages']), {'stream', 'persistence'})
+
+    def test_turn_trace_saved_and_exported(self):
+        first = self.traced_turn()
+        second = self.traced_turn("per studenti delle medie", first['session_id'])
+
+        messages = ChatMessage.objects.filter(role='user').order_by('timestamp', 'id')
+        self.assertEqual([m.trace['trace_id'] for m in messages], [first['trace_id'], second['trace_id']])
+        self.assertTrue({
+            'configuration', 'session_lookup', 'determine_next_phase', 'history',
+            'agent_prompt', 'upstream_connect', 'stream'
+        } <= set(messages[1].trace['stages']))
+
+        exported = [json.loads(line) for line in self.trace_path.read_text().splitlines()]
+        self.assertEqual([trace['trace_id'] for trace in exported], [first['trace_id'], second['trace_id']])
+        self.assertEqual(exported[1]['attributes']['session_id'], first['session_id'])
+        self.assertEqual(exported[1]['attributes']['turn'], 2)
+        self.assertEqual(exported[1]['spans'][-1]['name'], 'persistence')
+
+    def test_async_turn_exported_off_event_loop(self):
+        export_threads = []
+        export = JsonlExporter.export
+
+        def record(exporter, trace):
+            export_threads.append(threading.get_ident())
+            export(exporter, trace)
+
+        async def post_turn():
+            _, body = await self.apost_turn()
+            return threading.get_ident(), first_event(body)
+
+        with mock.patch.object(JsonlExporter, 'export', record):
+            loop_thread, event = async_to_sync(post_turn)()
+
+        exported = [json.loads(line) for line in self.trace_path.read_text().splitlines()]
+        self.assertEqual([trace['trace_id'] for trace in exported], [event['trace_id']])
+        self.assertEqual(len(export_threads), 1)
+        self.assertNotEqual(export_threads[0], loop_thread)
+
+    def test_jsonl_rotation(self):
+        exporter = JsonlExporter(str(self.trace_path))
+        traces = [Trace() for _ in range(3)]
+        line_size = len(json.dumps(traces[0].to_dict()).encode()) + 1
+
+        with override_settings(TRACING_JSONL_MAX_BYTES=line_size * 2):
+            for trace in traces:
+                exporter.export(trace.to_dict())
+
+        rotated = Path(f"{self.trace_path}.1")
+        self.assertEqual([json.loads(line)['trace_id'] for line in rotated.read_text().splitlines()],
+                         [traces[0].trace_id, traces[1].trace_id])
+        self.assertEqual([json.loads(line)['trace_id'] for line in self.trace_path.read_text().splitlines()],
+                         [traces[2].trace_id])
+
+    def test_admin_turn_breakdown(self):
+        first = self.traced_turn()
+        session = ChatSession.objects.get(session_id=first['session_id'])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(f'/admin/home/chatsession/{session.pk}/change/')
+
+        self.assertContains(response, first['trace_id'][:12])
+        self.assertContains(response, 'upstream_connect')
+
+
+class SSEEncoderTests(TestCase):
+    """Accorpamento dei delta dello stream in frame SSE"""
+
+    def frames(self, output):
+        return [json.loads(frame[len('data: '):]) for frame in output.split('\n\n') if frame]
+
+    def test_first_token_flushed_then_coalesced(self):
+        encoder = SSEEncoder(window_ms=10_000, max_bytes=1000)
+
+        self.assertEqual(self.frames(encoder.content("Ciao")), [{"content": "Ciao"}])
+        self.assertEqual(encoder.content(" come"), '')
+        self.assertEqual(encoder.content(" stai?"), '')
+        self.assertEqual(self.frames(encoder.flush()), [{"content": " come stai?"}])
+        self.assertEqual(encoder.flush(), '')
+
+    def test_size_threshold(self):
+        encoder = SSEEncoder(window_ms=10_000, max_bytes=8)
+        encoder.content("a")
+
+        self.assertEqual(encoder.content("perché"), '')
+        # "è" occupa due byte in UTF-8: 6 + 3 byte superano la soglia
+        self.assertEqual(self.frames(encoder.content("già")), [{"content": "perchégià"}])
+
+    def test_event_flushes_pending_content(self):
+        encoder = SSEEncoder(window_ms=10_000, max_bytes=1000)
+        encoder.content("a")
+        encoder.content("b")
+
+        output = encoder.event({"agent_phase": "refine", "content": ""})
+        self.assertEqual(self.frames(output), [{"content": "b"}, {"agent_phase": "refine", "content": ""}])
+
+    def test_no_window_sends_every_delta(self):
+        encoder = SSEEncoder(window_ms=0, max_bytes=1000)
+        self.assertEqual([self.frames(encoder.content(t)) for t in "abc"], [[{"content": t}] for t in "abc"])
+
+    def test_utf8_without_escapes(self):
+        frame = SSEEncoder(window_ms=0, max_bytes=1000).content("città 🌍")
+        self.assertIn("città 🌍", frame)
+        self.assertNotIn("\\u", frame)
+
+    def test_async_flush_when_upstream_pauses(self):
+        async def upstream():
+            for token in ("a", "b", "c"):
+                yield token
+            await asyncio.sleep(0.05)
+            yield "d"
+
+        async def collect():
+            encoder = SSEEncoder(window_ms=10, max_bytes=1000)
+            frames = []
+            async for token in iterate_with_flush(upstream(), encoder):
+                frame = encoder.flush() if token is None else encoder.content(token)
+                if frame:
+                    frames.extend(self.frames(frame))
+            frames.extend(self.frames(encoder.flush()))
+            return [frame["content"] for frame in frames]
+
+        # "b" e "c" partono allo scadere della finestra, senza attendere "d"
+        self.assertEqual(async_to_sync(collect)(), ["a", "bc", "d"])
+
+    @override_settings(SSE_COALESCE_MS=10_000, SSE_COALESCE_BYTES=1000)
+    def test_turn_frames_coalesced(self):
+        LLMConfiguration.objects.create(name="Test", model_name="gpt-4o-mini", api_key="test", is_default=True)
+        with mock.patch('home.views.get_client', return_value=client_with(
+            lambda **kwargs: fake_stream("Per", "fetto", "! Già", " fatto")
+        )):
+            response = self.client.post(
+                '/api/llm/sync', json.dumps({"prompt": "scrivi un articolo sul clima"}),
+                content_type='application/json'
+            )
+            body = b''.join(response.streaming_content).decode()
+
+        contents = [
+            json.loads(line[len('data: '):]).get('content')
+            for line in body.split('\n') if line.startswith('data: {')
+        ]
+        self.assertEqual([c for c in contents if c], ["Per", "fetto! Già fatto"])
+
+
+def event_ids(body):
+    return [line[len('id: '):] for line in body.split('\n') if line.startswith('id: ')]
+
+
+@contextmanager
+def cache_call_threads():
+    """Thread da cui vengono eseguite le operazioni sulle cache locmem (API sincrone e asincrone)"""
+    threads = set()
+
+    def record(method):
+        def call(cache, *args, **kwargs):
+            threads.add(threading.get_ident())
+            return method(cache, *args, **kwargs)
+        return call
+
+    methods = ('get', 'set', 'add', 'incr', 'get_many', 'set_many', 'delete')
+    patchers = [mock.patch.object(LocMemCache, name, record(getattr(LocMemCache, name))) for name in methods]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        yield threads
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+
+
+class ResumableStreamTests(LLMTurnTestMixin, TestCase):
+    """ID evento, buffer dei turni e ripresa con Last-Event-ID"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+
+    def setUp(self):
+        super().setUp()
+        caches['streams'].clear()
+
+    def test_events_numbered_and_buffered(self):
+        response, body = self.post_turn()
+        turn_id = response['X-Trace-Id']
+
+        ids = event_ids(body)
+        self.assertEqual(ids, [f"{turn_id}:{n}" for n in range(1, len(ids) + 1)])
+
+        state = get_buffered_stream(turn_id)
+        self.assertTrue(state['done'])
+        self.assertEqual(''.join(state['events']), body)
+
+    def test_resume_with_last_event_id(self):
+        response, body = self.post_turn()
+        turn_id = response['X-Trace-Id']
+
+        resumed, resumed_body = self.post_turn(**{'Last-Event-ID': f"{turn_id}:2"})
+        self.assertEqual(resumed_body, ''.join(get_buffered_stream(turn_id)['events'][2:]))
+        self.assertIn("data: [DONE]", resumed_body)
+        # Nessuna nuova chiamata all'LLM e nessun nuovo turno
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+        resumed = self.client.get(f'/api/llm/stream/{turn_id}', {'last_event_id': f"{turn_id}:2"})
+        self.assertEqual(b''.join(resumed.streaming_content).decode(), resumed_body)
+
+    def test_resume_async(self):
+        response, body = self.post_turn()
+        turn_id = response['X-Trace-Id']
+
+        _, resumed_body = async_to_sync(self.apost_turn)(**{'Last-Event-ID': f"{turn_id}:0"})
+        self.assertEqual(resumed_body, body)
+        self.async_upstream.assert_not_called()
+
+    def test_unknown_stream(self):
+        response = self.client.get('/api/llm/stream/sconosciuto')
+        self.assertEqual(response.status_code, 404)
+
+
+class ResumableDisconnectTests(LLMTurnTestMixin, TransactionTestCase):
+    """Il turno prosegue in background quando il client si disconnette"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+
+    def setUp(self):
+        super().setUp()
+        caches['streams'].clear()
+
+    def wait_for_turn(self, turn_id):
+        for _ in range(100):
+            state = get_buffered_stream(turn_id)
+            if state and state['done']:
+                return state
+            time.sleep(0.05)
+        self.fail("Il turno non è terminato in background")
+
+    def test_disconnect_then_resume(self):
+        response = self.start_turn()
+        turn_id = response['X-Trace-Id']
+        received = next(iter(response.streaming_content)).decode()
+        response.close()
+
+        state = self.wait_for_turn(turn_id)
+        self.assertEqual(ChatMessage.objects.get(role='assistant').content, "Ciao a tutti")
+
+        resumed = self.client.get(f'/api/llm/stream/{turn_id}', headers={'Last-Event-ID': event_ids(received)[-1]})
+        body = received + b''.join(resumed.streaming_content).decode()
+        self.assertEqual(body, ''.join(state['events']))
+
+
+@override_settings(RESUMABLE_CHECKPOINT_MS=0)
+class ResumableBufferTests(TestCase):
+    """Checkpoint incrementali del buffer e cache fuori dall'event loop"""
+
+    def setUp(self):
+        caches['streams'].clear()
+
+    def fill_buffer(self, count):
+        buffer = TurnStreamBuffer("t1")
+        for n in range(count):
+            buffer.append(f"data: {n}\n\n")
+        buffer.finish()
+        return buffer
+
+    def test_checkpoint_writes_only_new_events(self):
+        with mock.patch.object(LocMemCache, 'set_many', autospec=True, side_effect=LocMemCache.set_many) as set_many:
+            buffer = self.fill_buffer(3)
+
+        segments = [
+            events for call in set_many.call_args_list
+            for key, events in call.args[1].items() if key != 'stream:t1'
+        ]
+        self.assertEqual(segments, [[event] for event in buffer.events])
+        self.assertEqual(get_buffered_stream("t1"), {
+            'events': buffer.events, 'done': True, 'updated': mock.ANY
+        })
+
+    def test_resume_reads_only_later_segments(self):
+        buffer = self.fill_buffer(3)
+
+        with mock.patch.object(LocMemCache, 'get_many', autospec=True, side_effect=LocMemCache.get_many) as get_many:
+            state = get_buffered_stream("t1", 2)
+
+        self.assertEqual(state['events'], buffer.events[2:])
+        self.assertEqual(list(get_many.call_args.args[1]), ['stream:t1:2'])
+
+    def test_expired_segment_interrupts_resume(self):
+        self.fill_buffer(3)
+        caches['streams'].delete('stream:t1:0')
+
+        self.assertIsNone(get_buffered_stream("t1"))
+        self.assertEqual(get_buffered_stream("t1", 1)['events'][-1].split('\n')[1], "data: 2")
+
+    def test_async_relay_and_replay_off_event_loop(self):
+        async def frames():
+            for n in range(3):
+                yield f"data: {n}\n\n"
+
+        async def run():
+            loop_thread = threading.get_ident()
+            buffer = TurnStreamBuffer("t1")
+            relayed = [frame async for frame in arelay_stream(frames(), buffer)]
+            replayed = [event async for event in areplay_stream("t1", 1)]
+            return loop_thread, relayed, replayed
+
+        with cache_call_threads() as cache_threads:
+            loop_thread, relayed, replayed = async_to_sync(run)()
+
+        self.assertEqual(replayed, relayed[1:])
+        self.assertTrue(cache_threads)
+        self.assertNotIn(loop_thread, cache_threads)
+
+
+class ClosableStream:
+    """Stream dell'upstream finto che registra la chiusura della risposta HTTP"""
+
+    def __init__(self, *tokens):
+        self.chunks = fake_stream(*tokens)
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        while not self.closed and self.sent < len(self.chunks):
+            self.sent += 1
+            yield self.chunks[self.sent - 1]
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncClosableStream(ClosableStream):
+
+    async def __aiter__(self):
+        for chunk in self:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+class StalledStream(ClosableStream):
+    """Stream dell'upstream finto che dopo il primo chunk resta fermo finché la risposta non viene chiusa"""
+
+    STALL = 10
+
+    def __init__(self, *tokens):
+        super().__init__(*tokens)
+        self.closed_event = threading.Event()
+
+    def __iter__(self):
+        self.sent = 1
+        yield self.chunks[0]
+        self.closed_event.wait(self.STALL)
+
+    def close(self):
+        self.closed = True
+        self.closed_event.set()
+
+
+class AsyncStalledStream(StalledStream):
+
+    async def __aiter__(self):
+        self.sent = 1
+        yield self.chunks[0]
+        await asyncio.sleep(self.STALL)
+
+    async def close(self):
+        self.closed = True
+
+
+async def disconnect_after_first_token(response):
+    """
+    Legge lo stream della view asincrona fino al primo token, poi cancella il
+    task di lettura come l'handler ASGI alla disconnessione del client.
+
+    Returns:
+        bool: True se il task è stato cancellato
+    """
+    first_content = asyncio.Event()
+
+    async def consume():
+        async for chunk in response.streaming_content:
+            if b'"Ciao"' in chunk:
+                first_content.set()
+
+    task = asyncio.create_task(consume())
+    await first_content.wait()
+    task.cancel()
+    await asyncio.wait([task])
+    return task.cancelled()
+
+
+LONG_ANSWER = ("Ciao",) + (" parola",) * 100
+
+
+def cancelled_total():
+    if not metrics_available():
+        return 0
+    from prometheus_client import REGISTRY
+    return REGISTRY.get_sample_value('tutor_llm_cancelled_total', {
+        'configuration': "Test", 'provider': 'openai', 'phase': 'analyze'
+    }) or 0
+
+
+@override_settings(SSE_COALESCE_MS=0, RESUMABLE_STREAM_GRACE=0)
+class UpstreamCancellationTests(LLMTurnTestMixin, TestCase):
+    """Disconnessione del client durante lo stream: upstream chiuso e risposta parziale salvata"""
+
+    def assert_truncated_turn(self, upstream):
+        self.assertTrue(upstream.closed)
+        self.assertLess(upstream.sent, len(upstream.chunks))
+        self.assertTrue(ChatMessage.objects.filter(role='user').exists())
+        answer = ChatMessage.objects.get(role='assistant')
+        self.assertTrue(answer.truncated)
+        self.assertEqual(answer.content, "Ciao")
+        session = ChatSession.objects.get()
+        self.assertEqual(session.message_count, 2)
+        self.assertTrue(ChatMessage.objects.get(role='user').trace['trace_id'])
+
+    def test_sync_disconnect(self):
+        upstream = ClosableStream(*LONG_ANSWER)
+        cancelled_before = cancelled_total()
+        self.use_stream(upstream)
+        response = self.start_turn()
+        content = iter(response.streaming_content)
+        received = ''
+        while '"Ciao"' not in received:
+            received += next(content).decode()
+        response.close()
+
+        self.assert_truncated_turn(upstream)
+        history = self.client.get(f"/api/session/{ChatSession.objects.get().session_id}/history").json()
+        self.assertEqual([m['truncated'] for m in history['messages']], [False, True])
+        if metrics_available():
+            self.assertEqual(cancelled_total() - cancelled_before, 1)
+
+    def test_async_disconnect(self):
+        upstream = AsyncClosableStream(*LONG_ANSWER)
+
+        async def turn():
+            response = await self.async_client.post(
+                '/api/llm/async', self.request_body(self.STARTER, None), content_type='application/json'
+            )
+            self.assertTrue(await disconnect_after_first_token(response))
+
+        self.use_stream(upstream)
+        async_to_sync(turn)()
+
+        self.assert_truncated_turn(upstream)
+
+
+@override_settings(SSE_COALESCE_MS=0, UPSTREAM_CANCEL_AFTER=0)
+class ResumableCancellationTests(LLMTurnTestMixin, TransactionTestCase):
+    """Turno proseguito in background annullato se nessun client riprende lo stream"""
+
+    def setUp(self):
+        super().setUp()
+        caches['streams'].clear()
+
+    wait_for_turn = ResumableDisconnectTests.wait_for_turn
+
+    def test_detached_turn_cancelled(self):
+        upstream = ClosableStream(*LONG_ANSWER)
+        self.use_stream(upstream)
+        response = self.start_turn()
+        turn_id = response['X-Trace-Id']
+        content = iter(response.streaming_content)
+        while '"Ciao"' not in next(content).decode():
+            pass
+        response.close()
+
+        state = self.wait_for_turn(turn_id)
+
+        self.assertTrue(upstream.closed)
+        self.assertLess(upstream.sent, len(upstream.chunks))
+        self.assertIn('"truncated": true', state['events'][-1])
+        self.assertTrue(ChatMessage.objects.get(role='assistant').truncated)
+
+    def assert_cancelled_on_time(self, upstream, state, disconnected):
+        # Annullato alla scadenza del timer, non alla fine dell'attesa dell'upstream
+        self.assertLess(time.monotonic() - disconnected, StalledStream.STALL / 2)
+        self.assertTrue(upstream.closed)
+        self.assertIn('"truncated": true', state['events'][-1])
+        answer = ChatMessage.objects.get(role='assistant')
+        self.assertTrue(answer.truncated)
+        self.assertEqual(answer.content, "Ciao")
+
+    @override_settings(UPSTREAM_CANCEL_AFTER=0.2)
+    def test_stalled_upstream_cancelled_on_time(self):
+        upstream = StalledStream(*LONG_ANSWER)
+        self.use_stream(upstream)
+        response = self.start_turn()
+        turn_id = response['X-Trace-Id']
+        content = iter(response.streaming_content)
+        while '"Ciao"' not in next(content).decode():
+            pass
+        response.close()
+        disconnected = time.monotonic()
+
+        self.assert_cancelled_on_time(upstream, self.wait_for_turn(turn_id), disconnected)
+
+    @override_settings(UPSTREAM_CANCEL_AFTER=0.2)
+    def test_async_stalled_upstream_cancelled_on_time(self):
+        upstream = AsyncStalledStream(*LONG_ANSWER)
+
+        async def turn():
+            response = await self.async_client.post(
+                '/api/llm/async', self.request_body(self.STARTER, None), content_type='application/json'
+            )
+            await disconnect_after_first_token(response)
+            disconnected = time.monotonic()
+            # Il task del turno gira sull'event loop di questo test
+            while time.monotonic() - disconnected < StalledStream.STALL:
+                state = await aget_buffered_stream(response['X-Trace-Id'])
+                if state and state['done']:
+                    return state, disconnected
+                await asyncio.sleep(0.05)
+            self.fail("Il turno non è stato annullato")
+
+        self.use_stream(upstream)
+        state, disconnected = async_to_sync(turn)()
+
+        self.assert_cancelled_on_time(upstream, state, disconnected)
+
+
+class IdempotencyTests(LLMTurnTestMixin, TestCase):
+    """Richieste duplicate con la stessa Idempotency-Key"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+
+    def setUp(self):
+        super().setUp()
+        caches['streams'].clear()
+
+    def keyed_turn(self, prompt=None, key="chiave-1"):
+        return self.post_turn(prompt, **{'Idempotency-Key': key})
+
+    def test_completed_turn_replayed(self):
+        response, body = self.keyed_turn()
+        replayed, replayed_body = self.keyed_turn()
+
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed['X-Trace-Id'], response['X-Trace-Id'])
+        self.assertEqual(replayed_body, body)
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertEqual(ChatSession.objects.get().iteration_count, 1)
+
+    def test_different_keys_start_new_turns(self):
+        self.keyed_turn(key="chiave-1")
+        self.keyed_turn(key="chiave-2")
+        self.assertEqual(self.upstream.call_count, 2)
+
+    def test_key_reused_with_other_body(self):
+        self.keyed_turn()
+        response, _ = self.keyed_turn(prompt="un altro messaggio")
+        self.assertEqual(response.status_code, 422)
+
+    def test_key_too_long(self):
+        response, _ = self.keyed_turn(key="x" * 256)
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_buffer(self):
+        response, _ = self.keyed_turn()
+        caches['streams'].delete(f"stream:{response['X-Trace-Id']}")
+
+        duplicate, _ = self.keyed_turn()
+        self.assertEqual(duplicate.status_code, 409)
+        self.assertEqual(self.upstream.call_count, 1)
+
+    def test_async_duplicate(self):
+        response, body = self.keyed_turn()
+
+        _, duplicate_body = async_to_sync(self.apost_turn)(**{'Idempotency-Key': "chiave-1"})
+
+        self.assertEqual(duplicate_body, body)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    def test_async_key_handling_off_event_loop(self):
+        headers = {'Idempotency-Key': "chiave-async"}
+
+        async def run():
+            first, first_body = await self.apost_turn(**headers)
+            duplicate, duplicate_body = await self.apost_turn(**headers)
+            return threading.get_ident(), first, first_body, duplicate, duplicate_body
+
+        with cache_call_threads() as cache_threads:
+            loop_thread, first, first_body, duplicate, duplicate_body = async_to_sync(run)()
+
+        self.assertEqual(duplicate['Idempotent-Replayed'], 'true')
+        self.assertEqual(duplicate['X-Trace-Id'], first['X-Trace-Id'])
+        self.assertEqual(duplicate_body, first_body)
+        self.assertNotIn(loop_thread, cache_threads)
+
+
+class IdempotencyInFlightTests(LLMTurnTestMixin, TransactionTestCase):
+    """Un duplicato che arriva durante il turno riceve lo stesso stream"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+
+    def setUp(self):
+        super().setUp()
+        caches['streams'].clear()
+
+    def test_duplicate_attached_before_first_event(self):
+        # Il primo turno è registrato ma il suo stream non è ancora iniziato
+        first = self.start_turn(**{'Idempotency-Key': "chiave-1"})
+        duplicate = self.start_turn(**{'Idempotency-Key': "chiave-1"})
+        self.assertEqual(duplicate['X-Trace-Id'], first['X-Trace-Id'])
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            first_body = executor.submit(lambda: b''.join(first.streaming_content).decode())
+            duplicate_body = b''.join(duplicate.streaming_content).decode()
+
+        self.assertEqual(duplicate_body, first_body.result())
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(ChatSession.objects.get().iteration_count, 1)
+
+
+class ResponseCacheTests(LLMTurnTestMixin, TestCase):
+    """Cache delle risposte della fase di analisi"""
+
+    TOKENS = ("Ciao", " a", " tutti")
+    CONFIGURATION = {'temperature': 0, 'cache_responses': True}
+
+    def setUp(self):
+        super().setUp()
+        caches['responses'].clear()
+
+    def answered_turn(self, prompt, session_id=None):
+        """session_id e testo della risposta di un turno sulla view sincrona"""
+        return self.answer(self.post_turn(prompt, session_id)[1])
+
+    def answer(self, body):
+        events = sse_events(body)
+        return events[0]['session_id'], ''.join(event['content'] for event in events)
+
+    def test_same_starter_prompt_served_from_cache(self):
+        first_session, first_answer = self.answered_turn("scrivi un articolo sul clima")
+        second_session, second_answer = self.answered_turn("  Scrivi un articolo   SUL clima")
+
+        self.assertEqual(self.upstream.call_count, 1)
+        self.assertEqual(second_answer, first_answer)
+        self.assertNotEqual(first_session, second_session)
+        # Il turno servito dalla cache viene salvato come gli altri
+        answer = ChatMessage.objects.get(session__session_id=second_session, role='assistant')
+        self.assertEqual(answer.content, "Ciao a tutti")
+        self.assertEqual(ChatSession.objects.get(session_id=second_session).iteration_count, 1)
+
+    def test_follow_up_turns_not_cached(self):
+        session_id, _ = self.answered_turn("scrivi un articolo sul clima")
+        self.answered_turn("per studenti delle medie", session_id)
+        other_session, _ = self.answered_turn("scrivi un articolo sul clima")
+        self.answered_turn("per studenti delle medie", other_session)
+
+        self.assertEqual(self.upstream.call_count, 3)
+
+    def test_opt_in_per_configuration(self):
+        self.configuration.cache_responses = False
+        self.configuration.save()
+
+        self.answered_turn("scrivi un articolo sul clima")
+        self.answered_turn("scrivi un articolo sul clima")
+        self.assertEqual(self.upstream.call_count, 2)
+
+    def test_key_includes_request_parameters(self):
+        system_messages = [{"role": "system", "content": "istruzioni"}]
+        key = response_cache.get_response_cache_key(
+            'analyze', system_messages, "Ciao", "gpt-4o-mini", {'temperature': 0}
+        )
+        self.assertEqual(key, response_cache.get_response_cache_key(
+            'analyze', system_messages, " ciao ", "gpt-4o-mini", {'temperature': 0}
+        ))
+        self.assertNotEqual(key, response_cache.get_response_cache_key(
+            'analyze', system_messages, "Ciao", "gpt-4o-mini", {'temperature': 0.7}
+        ))
+        self.assertNotEqual(key, response_cache.get_response_cache_key(
+            'analyze', system_messages, "Ciao", "gpt-4o", {'temperature': 0}
+        ))
+
+    def test_replay_chunks(self):
+        content = "Ciao!  Ecco il prompt:\n\n- punto uno 🌍 \n"
+        chunks = response_cache.replay_chunks(content)
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(''.join(chunk.choices[0].delta.content for chunk in chunks), content)
+
+    def test_async_hit(self):
+        self.answered_turn("scrivi un articolo sul clima")
+
+        _, body = async_to_sync(self.apost_turn)()
+
+        self.assertEqual(self.answer(body)[1], "Ciao a tutti")
+        self.async_upstream.assert_not_called()
+
+    def test_async_cache_off_event_loop(self):
+        async def run():
+            # Miss (risposta salvata in cache), poi hit
+            bodies = [(await self.apost_turn())[1], (await self.apost_turn())[1]]
+            return threading.get_ident(), bodies
+
+        with cache_call_threads() as cache_threads:
+            loop_thread, bodies = async_to_sync(run)()
+
+        self.assertEqual([self.answer(body)[1] for body in bodies], ["Ciao a tutti", "Ciao a tutti"])
+        self.assertEqual(self.async_upstream.call_count, 1)
+        self.assertNotIn(loop_thread, cache_threads)
+
+
+def extraction_response(content):
+    """Risposta non in streaming della chiamata di estrazione"""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=50, completion_tokens=10, prompt_tokens_details=None)
+    )
+
+
+class ExtractionTierTests(TestCase):
+    """Livelli dell'estrazione: classificatore locale, cache, LLM, fallback"""
+
+    AMBIGUOUS = "mah, vediamo cosa viene fuori alla fine"
+
+    def setUp(self):
+        self.configuration = LLMConfiguration.objects.create(name="Test", model_name="gpt-4o-mini", api_key="test")
+        caches['extraction'].clear()
+        self.create = mock.Mock(return_value=extraction_response(
+            '{"category": "obiettivo", "value": "un testo qualsiasi", "confidence": 0.9}'
+        ))
+        client = client_with(self.create)
+        patcher = mock.patch('home.extraction.get_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def extract(self, message):
+        return extract_info_from_response(message, 'interview', {}, self.configuration)
+
+    def tier_counts(self):
+        return {tier: values['count'] for tier, values in get_extraction_tier_stats().items()}
+
+    def test_clear_short_answer_skips_llm(self):
+        self.assertEqual(classify_locally("lista puntata")['category'], 'output_format')
+        before = self.tier_counts()
+
+        info, usage = self.extract("lista puntata")
+
+        self.assertEqual(info, {'output_format': "lista puntata"})
+        self.assertIsNone(usage)
+        self.create.assert_not_called()
+        self.assertEqual(self.tier_counts()['local'] - before['local'], 1)
+
+    def test_ambiguous_message_falls_through(self):
+        self.assertEqual(classify_locally(self.AMBIGUOUS)['confidence'], 0.0)
+        before = self.tier_counts()
+
+        info, usage = self.extract(self.AMBIGUOUS)
+        self.assertEqual(info, {'obiettivo': "un testo qualsiasi"})
+        self.assertEqual(usage['prompt_tokens'], 50)
+
+        # Stessa risposta: dalla cache, senza una seconda chiamata
+        info, usage = self.extract(self.AMBIGUOUS)
+        self.assertEqual(info, {'obiettivo': "un testo qualsiasi"})
+        self.assertIsNone(usage)
+        self.assertEqual(self.create.call_count, 1)
+
+        # LLM non disponibile: keyword del fallback
+        self.create.side_effect = RuntimeError("upstream down")
+        info, _ = self.extract("vorrei qualcosa di formale")
+        self.assertEqual(info['obiettivo'], "vorrei qualcosa di formale")
+
+        after = self.tier_counts()
+        self.assertEqual(
+            {tier: after[tier] - before[tier] for tier in after},
+            {'local': 0, 'cache': 1, 'llm': 1, 'fallback': 1}
+        )
+
+    def test_async_variant_same_tiers(self):
+        acreate = mock.AsyncMock(side_effect=lambda **kwargs: self.create(**kwargs))
+        client = client_with(acreate)
+
+        async def run(messages):
+            return [await aextract_info_from_response(message, 'interview', {}, self.configuration) for message in messages]
+
+        before = self.tier_counts()
+        with mock.patch('home.extraction.get_async_client', return_value=client):
+            results = async_to_sync(run)(["lista puntata", self.AMBIGUOUS, self.AMBIGUOUS])
+            self.create.side_effect = RuntimeError("upstream down")
+            results += async_to_sync(run)(["vorrei qualcosa di formale"])
+
+        self.assertEqual([info for info, _ in results[:3]], [
+            {'output_format': "lista puntata"}, {'obiettivo': "un testo qualsiasi"}, {'obiettivo': "un testo qualsiasi"}
+        ])
+        self.assertEqual([usage is not None for _, usage in results[:3]], [False, True, False])
+        self.assertEqual(results[3][0]['obiettivo'], "vorrei qualcosa di formale")
+        after = self.tier_counts()
+        self.assertEqual(
+            {tier: after[tier] - before[tier] for tier in after},
+            {'local': 1, 'cache': 1, 'llm': 1, 'fallback': 1}
+        )
+
+    @override_settings(EXTRACTION_LOCAL_THRESHOLD=2.0)
+    def test_threshold_above_one_disables_local_tier(self):
+        info, usage = self.extract("lista puntata")
+
+        self.create.assert_called_once()
+        self.assertEqual(info, {'obiettivo': "un testo qualsiasi"})
+        self.assertIsNotNone(usage)
+
+    def test_tier_stats_in_usage_endpoint(self):
+        self.extract("lista puntata")
+        User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.login(username="staff", password="pw")
+
+        tiers = self.client.get('/api/usage').json()['extraction_tiers']
+        self.assertEqual(set(tiers), {'local', 'cache', 'llm', 'fallback'})
+        self.assertGreaterEqual(tiers['local']['count'], 1)
+
+
+class ExtractionCacheTests(TestCase):
+    """Cache dei risultati di estrazione e contatori hit/miss"""
+
+    RESULT = {'category': 'contesto', 'value': "studenti delle medie", 'confidence': 0.9}
+
+    def setUp(self):
+        caches['extraction'].clear()
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(get_cached_extraction("per la mia classe", {}, "gpt-4o-mini"))
+        set_cached_extraction("per la mia classe", {}, "gpt-4o-mini", self.RESULT)
+        # Spazi e maiuscole non cambiano la chiave
+        self.assertEqual(get_cached_extraction("  Per la mia   classe", {}, "gpt-4o-mini"), self.RESULT)
+
+        stats = get_extraction_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+
+    def test_model_and_prompt_version_invalidate(self):
+        set_cached_extraction("per la mia classe", {}, "gpt-4o-mini", self.RESULT)
+
+        self.assertIsNone(get_cached_extraction("per la mia classe", {}, "gpt-4o"))
+        with mock.patch('home.extraction.EXTRACTION_PROMPT_VERSION', 'altra-versione'):
+            self.assertIsNone(get_cached_extraction("per la mia classe", {}, "gpt-4o-mini"))
+        # Le categorie già compilate fanno parte della chiave
+        self.assertIsNone(get_cached_extraction("per la mia classe", {'obiettivo': "un articolo"}, "gpt-4o-mini"))
+        self.assertEqual(get_extraction_cache_stats()['misses'], 3)
+
+    def test_stats_in_usage_endpoint(self):
+        get_cached_extraction("per la mia classe", {}, "gpt-4o-mini")
+        User.objects.create_user("staff", password="pw", is_staff=True)
+        self.client.login(username="staff", password="pw")
+
+        stats = self.client.get('/api/usage').json()['extraction_cache']
+        self.assertEqual(stats['misses'], 1)
+        self.assertIn('prompt_version', stats)
+
+    @override_settings(EXTRACTION_LOCAL_THRESHOLD=2.0)
+    def test_async_extraction_cache_off_event_loop(self):
+        configuration = LLMConfiguration(name="Test", model_name="gpt-4o-mini", api_key="test")
+        create = mock.AsyncMock(return_value=extraction_response(json.dumps(self.RESULT)))
+        client = client_with(create)
+
+        async def run():
+            results = [
+                await aextract_info_from_response("per la mia classe", 'analyze', {}, configuration)
+                for _ in range(2)
+            ]
+            return threading.get_ident(), results
+
+        with mock.patch('home.extraction.get_async_client', return_value=client), \
+                cache_call_threads() as cache_threads:
+            loop_thread, results = async_to_sync(run)()
+
+        # Prima chiamata all'LLM (miss), seconda dalla cache (hit)
+        self.assertEqual(create.await_count, 1)
+        self.assertEqual(results[1][0]['contesto'], "studenti delle medie")
+        self.assertIsNone(results[1][1])
+        stats = get_extraction_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertNotIn(loop_thread, cache_threads)
+
+
+def history_message(role, content, tokens):
+    return ChatMessage(role=role, content=content, content_tokens=tokens)
+
+
+class HistoryBudgetTests(TestCase):
+    """Selezione della cronologia in base al budget di token"""
+
+    def test_oldest_messages_dropped_first(self):
+        # Dal più recente al più vecchio, come li legge la view
+        messages = [
+            history_message('assistant', "terza", 10),
+            history_message('user', "seconda", 10),
+            history_message('assistant', "prima", 10),
+        ]
+        budget = 2 * (10 + MESSAGE_OVERHEAD_TOKENS)
+
+        packed = pack_history(messages, budget, "gpt-4o-mini")
+
+        self.assertEqual(packed, [{'role': 'user', 'content': "seconda"}, {'role': 'assistant', 'content': "terza"}])
+
+    def test_overflowing_message_truncated(self):
+        long_text = "parola " * 2000
+        messages = [
+            history_message('user', "recente", 10),
+            history_message('assistant', long_text, count_tokens(long_text, "gpt-4o-mini")),
+            history_message('user', "vecchio", 10),
+        ]
+        budget = 10 + MESSAGE_OVERHEAD_TOKENS + 200
+
+        packed = pack_history(messages, budget, "gpt-4o-mini")
+
+        self.assertEqual([m['role'] for m in packed], ['assistant', 'user'])
+        truncated = packed[0]['content']
+        self.assertTrue(truncated.endswith(TRUNCATION_MARKER))
+        self.assertLessEqual(count_tokens(truncated, "gpt-4o-mini"), 200 + count_tokens(TRUNCATION_MARKER, "gpt-4o-mini"))
+
+    def test_too_little_space_left_drops_message(self):
+        messages = [history_message('user', "recente", 10), history_message('assistant', "x " * 500, 500)]
+        packed = pack_history(messages, 10 + MESSAGE_OVERHEAD_TOKENS + 20, "gpt-4o-mini")
+        self.assertEqual(packed, [{'role': 'user', 'content': "recente"}])
+
+    @override_settings(HISTORY_MAX_TOKENS=1000000)
+    def test_context_window_override(self):
+        configuration = LLMConfiguration(name="Test", model_name="gpt-4o-mini", max_tokens=512)
+        self.assertEqual(get_context_window(configuration), 128000)
+        default_budget = get_history_budget(configuration, ["istruzioni"])
+
+        configuration.context_window = 2000
+        self.assertEqual(get_context_window(configuration), 2000)
+        budget = get_history_budget(configuration, ["istruzioni"])
+
+        self.assertEqual(default_budget - budget, 128000 - 2000)
+        self.assertLess(budget, 2000 - 512)
+
+        # Parti fisse più grandi della finestra: nessuna cronologia
+        self.assertEqual(get_history_budget(configuration, ["x " * 4000]), 0)
+
+    @override_settings(HISTORY_MAX_TOKENS=300)
+    def test_history_max_tokens_caps_budget(self):
+        configuration = LLMConfiguration(name="Test", model_name="gpt-4o-mini", max_tokens=512)
+        self.assertEqual(get_history_budget(configuration, ["istruzioni"]), 300)
+
+
+class HistoryTokenCountTests(LLMTurnTestMixin, TestCase):
+    """content_tokens calcolato una sola volta e salvato con bulk_update"""
+
+    def test_missing_counts_saved_with_bulk_update(self):
+        session_id = self.session_turn()
+        # Messaggi salvati prima che esistesse il conteggio
+        ChatMessage.objects.update(content_tokens=None)
+
+        with mock.patch.object(ChatMessage.objects, 'bulk_update', wraps=ChatMessage.objects.bulk_update) as bulk_update:
+            self.post_turn("per studenti delle medie", session_id)
+
+        bulk_update.assert_called_once()
+        updated, fields = bulk_update.call_args.args
+        self.assertEqual(fields, ['content_tokens'])
+        self.assertEqual(len(updated), 2)
+        for message in ChatMessage.objects.all():
+            self.assertEqual(message.content_tokens, count_tokens(message.content, "gpt-4o-mini"))
+
+        # Conteggi già presenti: nessun aggiornamento
+        with mock.patch.object(ChatMessage.objects, 'bulk_update') as bulk_update:
+            self.post_turn("tono semplice", session_id)
+        bulk_update.assert_not_called()
+
+
+@override_settings(SUMMARY_EVERY_N_TURNS=1)
+class ConversationSummaryInjectionTests(LLMTurnTestMixin, TestCase):
+    """Il riassunto sostituisce la cronologia solo quando qualche messaggio resta fuori"""
+
+    def setUp(self):
+        super().setUp()
+        self.schedule = self.patch('home.views.schedule_summary_update')
+
+        self.session_id = self.session_turn()
+        ChatSession.objects.filter(session_id=self.session_id).update(conversation_summary="L'utente vuole un articolo")
+        self.schedule.reset_mock()
+
+    def follow_up(self):
+        """Messaggi inviati all'LLM per il secondo turno"""
+        self.post_turn("per studenti delle medie", self.session_id)
+        return self.upstream.call_args.kwargs['messages']
+
+    def summary_messages(self, messages):
+        return [m for m in messages if m['role'] == 'system' and m['content'].startswith(SUMMARY_HEADER)]
+
+    def test_summary_skipped_when_history_fits(self):
+        messages = self.follow_up()
+
+        self.assertEqual(self.summary_messages(messages), [])
+        self.assertIn("scrivi un articolo sul clima", [m['content'] for m in messages if m['role'] == 'user'])
+        self.schedule.assert_not_called()
+
+    @override_settings(HISTORY_MAX_TOKENS=8)
+    def test_summary_injected_when_history_evicted(self):
+        messages = self.follow_up()
+
+        summary = self.summary_messages(messages)
+        self.assertEqual(len(summary), 1)
+        self.assertIn("L'utente vuole un articolo", summary[0]['content'])
+        self.assertNotIn("scrivi un articolo sul clima", [m['content'] for m in messages if m['role'] == 'user'])
+        self.schedule.assert_called_once()
+
+
+def summary_response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+# Il job chiude la connessione del proprio thread: nei test gira nel thread principale
+@mock.patch('home.summary.connection')
+class ConversationSummaryUpdateTests(TestCase):
+    """Aggiornamento del riassunto in background"""
+
+    def setUp(self):
+        configuration = LLMConfiguration.objects.create(name="Test", model_name="gpt-4o-mini", api_key="test")
+        self.session = ChatSession.objects.create(session_id="s1", configuration=configuration, message_count=10)
+        ChatMessage.objects.bulk_create([
+            ChatMessage(session=self.session, role='user' if i % 2 == 0 else 'assistant', content=f"messaggio {i}")
+            for i in range(10)
+        ])
+
+    def run_update(self, create):
+        client = client_with(create)
+        with mock.patch('home.summary.get_client', return_value=client):
+            update_conversation_summary(self.session.pk)
+        self.session.refresh_from_db()
+
+    def test_summarizes_all_but_recent_messages(self, connection):
+        requests = []
+
+        def create(**kwargs):
+            requests.append(kwargs['messages'][-1]['content'])
+            return summary_response("Riassunto")
+
+        self.run_update(create)
+
+        self.assertEqual(self.session.conversation_summary, "Riassunto")
+        self.assertEqual(self.session.summarized_message_count, 10 - SUMMARY_KEEP_RECENT)
+        self.assertIn("messaggio 3", requests[0])
+        self.assertNotIn("messaggio 4", requests[0])
+
+        # Nessun nuovo messaggio da riassumere: niente chiamata all'LLM
+        self.run_update(lambda **kwargs: self.fail("riassunto già aggiornato"))
+
+    def test_concurrent_update_wins(self, connection):
+        def create(**kwargs):
+            # Un altro job aggiorna il riassunto mentre questo aspetta l'LLM
+            ChatSession.objects.filter(pk=self.session.pk).update(
+                conversation_summary="Riassunto dell'altro job", summarized_message_count=2
+            )
+            return summary_response("Riassunto superato")
+
+        self.run_update(create)
+
+        self.assertEqual(self.session.conversation_summary, "Riassunto dell'altro job")
+        self.assertEqual(self.session.summarized_message_count, 2)
+
+
+@override_settings(EXTRACTION_LOCAL_THRESHOLD=2.0)
+class ExtractionModeTests(LLMTurnTestMixin, TestCase):
+    """Le modalità concurrent e deferred lasciano la sessione come la modalità inline"""
+
+    EXTRACTION_RESULT = '{"category": "contesto", "value": "studenti delle medie", "confidence": 0.9}'
+
+    def setUp(self):
+        super().setUp()
+
+        async def acreate(**kwargs):
+            return extraction_response(self.EXTRACTION_RESULT)
+
+        self.patch('home.extraction.get_client', return_value=client_with(
+            lambda **kwargs: extraction_response(self.EXTRACTION_RESULT)
+        ))
+        self.patch('home.extraction.get_async_client', return_value=client_with(acreate))
+
+    def post_sync(self, prompt, session_id=None):
+        return sse_events(self.post_turn(prompt, session_id)[1])
+
+    def post_async(self, prompt, session_id=None):
+        return sse_events(async_to_sync(self.apost_turn)(prompt, session_id)[1])
+
+    def run_turns(self, post, mode):
+        """Due turni con la modalità indicata: stato finale della sessione ed eventi del secondo turno"""
+        # Ogni esecuzione parte senza risultati di estrazione in cache
+        caches['extraction'].clear()
+        with override_settings(EXTRACTION_MODE=mode):
+            session_id = post("scrivi un articolo sul clima")[0]['session_id']
+            events = post("il testo è per una classe di ragazzi", session_id)
+
+        session = ChatSession.objects.get(session_id=session_id)
+        state = (session.collected_info, session.confidence_score, session.iteration_count, session.agent_phase)
+        return session, state, events
+
+    def assert_same_as_inline(self, mode):
+        for post in (self.post_sync, self.post_async):
+            with self.subTest(view=post.__name__):
+                _, inline_state, _ = self.run_turns(post, 'inline')
+                session, state, events = self.run_turns(post, mode)
+
+                self.assertEqual(state, inline_state)
+                self.assertEqual(session.collected_info['contesto'], "studenti delle medie")
+                self.assertEqual(session.messages.count(), 4)
+
+                # L'ultimo evento riporta fase e confidence dopo l'estrazione
+                self.assertEqual(events[-1], {
+                    "agent_phase": session.agent_phase,
+                    "confidence_score": round(session.confidence_score, 1),
+                    "content": ""
+                })
+
+    def test_concurrent_mode(self):
+        self.assert_same_as_inline('concurrent')
+
+    def test_deferred_mode(self):
+        self.assert_same_as_inline('deferred')
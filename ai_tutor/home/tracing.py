@@ -0,0 +1,205 @@
+"""
+Tracing per fase di un turno di /api/llm.
+
+Ogni turno ha un trace con ID proprio e uno span per fase (lookup della
+sessione, determine_next_phase, estrazione, cronologia, prompt dell'agente,
+connessione all'upstream, stream dei token, salvataggio). Gli span misurano
+solo perf_counter: il costo è trascurabile rispetto al turno.
+
+A fine turno il trace viene:
+- riassunto in ChatMessage.trace sul messaggio utente del turno (ripartizione
+  per fase visibile nell'admin della sessione)
+- inviato all'exporter scelto da settings.TRACING_EXPORTER:
+  'jsonl' (default, una riga JSON per turno in TRACING_JSONL_PATH),
+  'otlp' (OpenTelemetry, pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http),
+  'none', oppure il percorso di una classe con metodo export(trace_dict)
+
+L'endpoint ASGI usa Trace.afinish: l'export (scrittura su file per 'jsonl')
+gira in un thread e non blocca l'event loop. Il file JSONL viene ruotato
+quando supera TRACING_JSONL_MAX_BYTES (il precedente resta in <path>.1).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Fasi del turno, nell'ordine in cui vengono mostrate
+TRACE_STAGES = [
+    'configuration', 'session_lookup', 'determine_next_phase', 'extraction', 'history',
+    'agent_prompt', 'upstream_connect', 'stream', 'persistence',
+]
+
+
+class Trace:
+    """Span di un turno, misurati rispetto all'inizio della richiesta"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.attributes = {}
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Misura un blocco come span (anche attorno a uno yield nel generatore SSE)"""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time.perf_counter(), error=error, **attributes)
+
+    def add_span(self, name, start, end, **attributes):
+        self.spans.append({
+            'name': name,
+            'start_ms': round((start - self.started) * 1000, 2),
+            'duration_ms': round((end - start) * 1000, 2),
+            **{key: value for key, value in attributes.items() if value is not None},
+        })
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def stage_durations(self):
+        """Millisecondi per fase (somma degli span con lo stesso nome)"""
+        durations = {}
+        for span in self.spans:
+            durations[span['name']] = round(durations.get(span['name'], 0) + span['duration_ms'], 2)
+        return durations
+
+    def summary(self):
+        """Riassunto salvato su ChatMessage.trace"""
+        return {
+            'trace_id': self.trace_id,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'stages': self.stage_durations(),
+        }
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'started_at': self.started_at.isoformat(),
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'attributes': self.attributes,
+            'spans': self.spans,
+        }
+
+    def finish(self):
+        """Invia il trace all'exporter configurato (gli errori dell'exporter vengono solo loggati)"""
+        exporter = get_exporter()
+        if exporter is None:
+            return
+        try:
+            exporter.export(self.to_dict())
+        except Exception as e:
+            logger.warning(f"Export trace {self.trace_id} fallito: {str(e)}")
+
+    async def afinish(self):
+        """Variante asincrona di finish: l'export gira in un thread, fuori dall'event loop"""
+        await sync_to_async(self.finish, thread_sensitive=False)()
+
+
+class JsonlExporter:
+    """Accoda ogni trace come riga JSON in un file locale, ruotato oltre TRACING_JSONL_MAX_BYTES"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = (json.dumps(trace, ensure_ascii=False) + "\n").encode('utf-8')
+        path = self.path or settings.TRACING_JSONL_PATH
+        with self._lock:
+            self._rotate(path, len(line))
+            with open(path, 'ab') as f:
+                f.write(line)
+
+    def _rotate(self, path, incoming):
+        max_bytes = settings.TRACING_JSONL_MAX_BYTES
+        if not max_bytes:
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        # Il file precedente resta disponibile come <path>.1 (sovrascritto alla rotazione successiva)
+        if size and size + incoming > max_bytes:
+            os.replace(path, f"{path}.1")
+
+
+class OTLPExporter:
+    """
+    Invia i trace a un collector OpenTelemetry (OTLP/HTTP).
+
+    Endpoint e header si configurano con le variabili standard
+    OTEL_EXPORTER_OTLP_ENDPOINT / OTEL_EXPORTER_OTLP_HEADERS.
+    """
+
+    def __init__(self):
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider = TracerProvider(resource=Resource.create({'service.name': 'ai-tutor'}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self.tracer = provider.get_tracer(__name__)
+
+    def export(self, trace):
+        from opentelemetry import trace as otel_trace
+
+        start_ns = int(datetime.fromisoformat(trace['started_at']).timestamp() * 1e9)
+        root = self.tracer.start_span('llm_turn', start_time=start_ns, attributes={
+            'tutor.trace_id': trace['trace_id'],
+            **{f'tutor.{key}': value for key, value in trace['attributes'].items() if value is not None},
+        })
+        context = otel_trace.set_span_in_context(root)
+
+        for span in trace['spans']:
+            span_start = start_ns + int(span['start_ms'] * 1e6)
+            child = self.tracer.start_span(span['name'], context=context, start_time=span_start, attributes={
+                key: value for key, value in span.items() if key not in ('name', 'start_ms', 'duration_ms')
+            })
+            child.end(end_time=span_start + int(span['duration_ms'] * 1e6))
+
+        root.end(end_time=start_ns + int(trace['duration_ms'] * 1e6))
+
+
+EXPORTERS = {
+    'jsonl': JsonlExporter,
+    'otlp': OTLPExporter,
+}
+
+
+def get_exporter():
+    """Exporter selezionato da settings.TRACING_EXPORTER (None = tracing non esportato)"""
+    return _build_exporter(settings.TRACING_EXPORTER)
+
+
+@lru_cache(maxsize=None)
+def _build_exporter(name):
+    if not name or name == 'none':
+        return None
+
+    try:
+        exporter_class = EXPORTERS.get(name) or import_string(name)
+        return exporter_class()
+    except Exception as e:
+        logger.warning(f"Exporter di tracing '{name}' non disponibile: {str(e)}")
+        return None
@@ -0,0 +1,171 @@
+"""
+Lettura dei dati di utilizzo (token) restituiti dalle chiamate all'LLM.
+
+Con lo streaming l'usage arriva solo se richiesto (stream_options.include_usage)
+nell'ultimo chunk, che non ha choices. I token letti dalla cache del provider
+(prompt_tokens_details.cached_tokens) permettono di verificare se il layout a
+prefisso stabile (AGENT_PROMPT_LAYOUT='prefix') sta funzionando: i contatori
+per fase del processo sono in /api/usage (prompt_cache).
+
+L'usage di ogni chiamata viene salvato sul ChatMessage del turno (chiamata
+dell'agente sulla risposta, estrazione sul messaggio utente) e aggregato per
+configurazione e per fase con get_token_usage_by_configuration/_by_phase.
+"""
+
+import logging
+import threading
+
+from django.db.models import Count, Sum
+
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+# fase -> {'requests', 'prompt_tokens', 'cached_tokens'}
+_prompt_cache_stats = {}
+
+
+def read_usage(usage):
+    """
+    Converte l'oggetto usage del client OpenAI in un dict.
+
+    Args:
+        usage: CompletionUsage (o None)
+
+    Returns:
+        dict | None: {'prompt_tokens', 'completion_tokens', 'cached_tokens'}
+    """
+    if usage is None:
+        return None
+
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', None) if details is not None else None
+
+    return {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'cached_tokens': cached_tokens or 0,
+    }
+
+
+def record_prompt_cache_usage(phase, configuration, usage):
+    """
+    Registra e logga i token in cache di una chiamata dell'agente.
+
+    Args:
+        phase: Fase dell'agente
+        configuration: LLMConfiguration usata
+        usage: Dict restituito da read_usage
+    """
+    with _lock:
+        stats = _prompt_cache_stats.setdefault(phase, {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0})
+        stats['requests'] += 1
+        stats['prompt_tokens'] += usage['prompt_tokens']
+        stats['cached_tokens'] += usage['cached_tokens']
+
+    hit_rate = usage['cached_tokens'] / usage['prompt_tokens'] * 100 if usage['prompt_tokens'] else 0.0
+    logger.info(
+        f"Usage: config={configuration.name}, phase={phase}, prompt_tokens={usage['prompt_tokens']}, "
+        f"cached_tokens={usage['cached_tokens']} ({hit_rate:.0f}%), completion_tokens={usage['completion_tokens']}"
+    )
+
+
+def get_prompt_cache_stats():
+    """
+    Token in cache per fase (per processo).
+
+    Returns:
+        dict: {fase: {'requests', 'prompt_tokens', 'cached_tokens', 'hit_rate'}}
+    """
+    with _lock:
+        snapshot = {phase: dict(stats) for phase, stats in _prompt_cache_stats.items()}
+
+    for stats in snapshot.values():
+        stats['hit_rate'] = round(stats['cached_tokens'] / stats['prompt_tokens'], 3) if stats['prompt_tokens'] else 0.0
+
+    return snapshot
+
+
+def agent_usage_fields(usage):
+    """
+    Campi di ChatMessage per l'usage della chiamata dell'agente.
+
+    Args:
+        usage: Dict restituito da read_usage (o None)
+
+    Returns:
+        dict: Da passare a TurnPersistence.add_message (vuoto se usage è None)
+    """
+    if not usage:
+        return {}
+    return {
+        'prompt_tokens': usage['prompt_tokens'],
+        'completion_tokens': usage['completion_tokens'],
+        'cached_tokens': usage['cached_tokens'],
+        'tokens_used': usage['prompt_tokens'] + usage['completion_tokens'],
+    }
+
+
+def apply_extraction_usage(message, usage):
+    """
+    Registra l'usage della chiamata di estrazione sul messaggio utente analizzato.
+
+    Args:
+        message: ChatMessage (non ancora salvato)
+        usage: Dict restituito da read_usage (o None)
+    """
+    if not usage:
+        return
+    message.extraction_prompt_tokens = usage['prompt_tokens']
+    message.extraction_completion_tokens = usage['completion_tokens']
+    message.tokens_used = usage['prompt_tokens'] + usage['completion_tokens']
+
+
+USAGE_AGGREGATES = {
+    'messages': Count('id'),
+    'prompt_tokens': Sum('prompt_tokens', default=0),
+    'completion_tokens': Sum('completion_tokens', default=0),
+    'cached_tokens': Sum('cached_tokens', default=0),
+    'extraction_prompt_tokens': Sum('extraction_prompt_tokens', default=0),
+    'extraction_completion_tokens': Sum('extraction_completion_tokens', default=0),
+    'total_tokens': Sum('tokens_used', default=0),
+}
+
+
+def _aggregate_usage(group_by, queryset=None):
+    if queryset is None:
+        queryset = ChatMessage.objects.all()
+    return list(
+        queryset.filter(tokens_used__isnull=False)
+        .values(*group_by)
+        .annotate(**USAGE_AGGREGATES)
+        .order_by('-total_tokens')
+    )
+
+
+def get_token_usage_by_configuration(queryset=None):
+    """
+    Token spesi per configurazione LLM (dai messaggi salvati).
+
+    Args:
+        queryset: ChatMessage da considerare (default: tutti, es: filtrare per data)
+
+    Returns:
+        list: [{'session__configuration__id', 'session__configuration__name', 'messages', '*_tokens', 'total_tokens'}]
+    """
+    return _aggregate_usage(['session__configuration__id', 'session__configuration__name'], queryset)
+
+
+def get_token_usage_by_phase(queryset=None):
+    """
+    Token spesi per fase dell'agente (dai messaggi salvati).
+
+    Args:
+        queryset: ChatMessage da considerare (default: tutti)
+
+    Returns:
+        list: [{'agent_phase', 'messages', '*_tokens', 'total_tokens'}]
+    """
+    return _aggregate_usage(['agent_phase'], queryset)
@@ -1,14 +1,43 @@
-from django.shortcuts import render, get_object_or_404
-from django.http import StreamingHttpResponse, JsonResponse
+from django.shortcuts import render
+from django.http import StreamingHttpResponse, JsonResponse, Http404, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.conf import settings
+from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+import asyncio
+import base64
+import binascii
+import hashlib
 import json
 import logging
+import time
 import uuid
-from openai import OpenAI
+from calendar import timegm
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from .models import LLMConfiguration, ChatSession, ChatMessage
-from .agent_prompts import get_agent_prompt
+from .agent_prompts import get_agent_prompt, get_agent_prompt_parts
+from .llm_clients import get_client, get_async_client
+from .config_snapshots import get_configuration_snapshot, aget_configuration_snapshot
+from .extraction import (
+    extract_info_from_response, aextract_info_from_response, get_extraction_tier_stats, get_extraction_cache_stats
+)
+from .usage import (
+    read_usage, record_prompt_cache_usage, get_prompt_cache_stats, agent_usage_fields, apply_extraction_usage,
+    get_token_usage_by_configuration, get_token_usage_by_phase
+)
+from .history import count_tokens, fill_token_counts, get_history_budget, pack_history
+from .summary import build_summary_message, schedule_summary_update
+from .persistence import TurnPersistence
+from .metrics import TurnMetrics, observe_error, is_available as metrics_available, render_metrics
+from .search import search_messages
+from .tracing import Trace
+from .sse import sse_data, SSEEncoder, iterate_with_flush
+from . import idempotency, resumable, response_cache
 
 # Configura logging
 logger = logging.getLogger(__name__)
@@ -183,209 +212,334 @@ def determine_next_phase(session, user_message):
     return current_phase
 
 
-def extract_info_from_response(user_message, current_phase, collected_info, configuration):
+def build_agent_context(session, user_message=None):
     """
-    Estrae informazioni strutturate dalla risposta dell'utente usando l'LLM stesso.
-    Molto più accurato del semplice pattern matching.
+    Costruisce il contesto per l'agente corrente.
 
     Args:
-        user_message: Messaggio dell'utente
-        current_phase: Fase corrente
-        collected_info: Dict con info già raccolte
-        configuration: LLMConfiguration per fare la chiamata di estrazione
+        session: ChatSession object
+        user_message: Messaggio corrente dell'utente (opzionale)
 
     Returns:
-        dict: Informazioni aggiornate
-    """
-    # Se è la prima risposta o una risposta molto breve, usa approccio semplificato
-    if len(user_message.strip()) < 5:
-        return collected_info.copy()
-
-    # Costruisci un prompt di estrazione strutturata
-    extraction_prompt = f"""Analizza la seguente risposta dell'utente e estrai informazioni strutturate per costruire un prompt ottimale.
-
-RISPOSTA UTENTE:
-"{user_message}"
-
-INFORMAZIONI GIÀ RACCOLTE:
-{json.dumps(collected_info, ensure_ascii=False, indent=2)}
-
-COMPITO:
-Identifica quale tipo di informazione fornisce l'utente e classificala in UNA di queste categorie:
-- obiettivo: Lo scopo/task principale (es: "creare un articolo", "generare codice", "scrivere email")
-- contesto: Scenario d'uso, pubblico target, background (es: "per studenti", "in ambito aziendale")
-- vincoli: Limitazioni su lunghezza, tono, stile (es: "500 parole", "tono formale", "semplice")
-- output_format: Formato della risposta desiderato (es: "lista puntata", "JSON", "markdown")
-- role: Ruolo che l'AI dovrebbe assumere (es: "esperto di marketing", "tutor paziente")
-
-Rispondi SOLO con un JSON in questo formato:
-{{
-  "category": "obiettivo|contesto|vincoli|output_format|role|nessuna",
-  "value": "testo estratto dalla risposta utente (usa le sue parole, non parafrasare)",
-  "confidence": 0.0-1.0
-}}
-
-REGOLE:
-- Se la risposta non contiene info utili, usa category="nessuna"
-- Mantieni il testo originale dell'utente in "value"
-- Non inventare informazioni non presenti
-- Se l'utente fornisce più info, priorità all'aspetto più rilevante"""
+        dict: Contesto formattato per l'agente
+    """
+    # Costruisci il prompt raffinato dalle info raccolte
+    refined_prompt = build_refined_prompt(session.collected_info)
 
-    try:
-        # Chiama l'LLM per estrarre info
-        client = OpenAI(api_key=configuration.api_key, timeout=10)
-
-        response = client.chat.completions.create(
-            model=configuration.model_name,
-            messages=[
-                {"role": "system", "content": "Sei un assistente che estrae informazioni strutturate. Rispondi SOLO con JSON valido."},
-                {"role": "user", "content": extraction_prompt}
-            ],
-            temperature=0.3,  # Bassa temperatura per output più deterministico
-            max_tokens=200
-        )
+    context = {
+        # Prompt originale salvato alla creazione della sessione (nessuna query)
+        'original_prompt': session.original_prompt or "N/A",
+        'identified_issues': session.identified_issues,
+        'collected_info': session.collected_info,
+        'iteration_count': session.iteration_count,
+        'refined_prompt': refined_prompt,
+        'confidence_score': round(session.confidence_score, 1),
+        # Messaggio col riassunto da usare al posto della cronologia esclusa
+        'summary_message': build_summary_message(session.conversation_summary)
+    }
 
-        result_text = response.choices[0].message.content.strip()
+    return context
+
+
+def build_refined_prompt(collected_info):
+    """
+    Costruisce un prompt raffinato strutturato dalle informazioni raccolte.
+
+    Args:
+        collected_info: Dict con informazioni raccolte
 
-        # Parse JSON response
-        # Rimuovi eventuali markdown code blocks
-        if result_text.startswith('```'):
-            result_text = result_text.split('```')[1]
-            if result_text.startswith('json'):
-                result_text = result_text[4:]
+    Returns:
+        str: Prompt formattato
+    """
+    if not collected_info:
+        return ""
 
-        extraction_result = json.loads(result_text.strip())
+    # Memorizzato per valori: tra un turno e l'altro collected_info cambia di rado
+    return _build_refined_prompt(tuple(
+        str(collected_info[key]) if collected_info.get(key) else ''
+        for key, _ in REFINED_PROMPT_SECTIONS
+    ))
 
-        # Aggiorna collected_info se l'estrazione ha alta confidence
-        updated_info = collected_info.copy()
 
-        category = extraction_result.get('category', 'nessuna')
-        value = extraction_result.get('value', '')
-        confidence = extraction_result.get('confidence', 0.0)
+# Sezioni del prompt raffinato, nell'ordine di presentazione
+REFINED_PROMPT_SECTIONS = [
+    ('role', 'Ruolo'),
+    ('contesto', 'Contesto'),
+    ('obiettivo', 'Obiettivo'),
+    ('vincoli', 'Vincoli'),
+    ('output_format', 'Formato Output'),
+]
 
-        # Solo se confidence > 0.5 e categoria valida
-        if confidence > 0.5 and category in ['obiettivo', 'contesto', 'vincoli', 'output_format', 'role']:
-            if category == 'vincoli':
-                # Per vincoli, aggiungi invece di sovrascrivere
-                if updated_info.get('vincoli'):
-                    updated_info['vincoli'] += ' | ' + value
-                else:
-                    updated_info['vincoli'] = value
-            else:
-                # Per altri campi, aggiorna solo se vuoto o se nuovo valore è più dettagliato
-                if not updated_info.get(category) or len(value) > len(updated_info.get(category, '')):
-                    updated_info[category] = value
 
-        logger.info(f"Extraction: category={category}, confidence={confidence:.2f}, value_length={len(value)}")
+@lru_cache(maxsize=512)
+def _build_refined_prompt(values):
+    sections = []
 
-        return updated_info
+    for (_, label), value in zip(REFINED_PROMPT_SECTIONS, values):
+        if value:
+            sections.append(f"**{label}**: {value}")
 
-    except Exception as e:
-        # Fallback: se l'estrazione LLM fallisce, usa approccio keyword semplificato
-        logger.warning(f"LLM extraction failed: {str(e)}, using fallback keyword extraction")
-        return extract_info_fallback(user_message, collected_info)
+    return "\n".join(sections)
 
 
-def extract_info_fallback(user_message, collected_info):
+# Campi della sessione aggiornati da apply_agent_turn
+AGENT_STATE_FIELDS = ('collected_info', 'confidence_score', 'iteration_count', 'agent_phase')
+
+
+def apply_agent_turn(session, next_phase, updated_info=None):
     """
-    Fallback method: estrazione basata su keyword semplici.
-    Usato solo se l'estrazione LLM fallisce.
+    Applica alla sessione l'esito di un turno: info raccolte, confidence,
+    contatore iterazioni e fase. Non salva la sessione.
+
+    Args:
+        session: ChatSession object
+        next_phase: Fase determinata da determine_next_phase
+        updated_info: collected_info aggiornato dall'estrazione (opzionale)
+
+    Returns:
+        float: Nuovo confidence score
     """
-    updated_info = collected_info.copy()
-    message_lower = user_message.lower()
+    if updated_info is not None:
+        session.collected_info = updated_info
 
-    # Obiettivo
-    if any(word in message_lower for word in ['creare', 'generare', 'scrivere', 'fare', 'produrre', 'voglio', 'vorrei']):
-        if not updated_info.get('obiettivo'):
-            updated_info['obiettivo'] = user_message
+    # Calcola il confidence score basato sulle info raccolte
+    confidence = calculate_confidence_score(session.collected_info, next_phase)
+    session.confidence_score = confidence
 
-    # Contesto/Pubblico
-    if any(word in message_lower for word in ['per', 'studenti', 'professionisti', 'bambini', 'utenti', 'clienti', 'pubblico']):
-        if not updated_info.get('contesto'):
-            updated_info['contesto'] = user_message
+    # Incrementa il contatore di iterazioni
+    session.iteration_count += 1
 
-    # Vincoli (lunghezza, tono)
-    if any(word in message_lower for word in ['parole', 'caratteri', 'paragrafi', 'breve', 'lungo',
-                                               'formale', 'informale', 'tecnico', 'semplice']):
-        if not updated_info.get('vincoli'):
-            updated_info['vincoli'] = user_message
-        else:
-            updated_info['vincoli'] += ' | ' + user_message
+    # Aggiorna la fase
+    session.agent_phase = next_phase
 
-    # Formato output
-    if any(word in message_lower for word in ['lista', 'elenco', 'tabella', 'json', 'markdown', 'html']):
-        if not updated_info.get('output_format'):
-            updated_info['output_format'] = user_message
+    return confidence
 
-    # Ruolo
-    if any(word in message_lower for word in ['esperto', 'tutor', 'assistente', 'consulente', 'come']):
-        if not updated_info.get('role'):
-            updated_info['role'] = user_message
 
-    return updated_info
+def apply_extracted_info(session, updated_info):
+    """
+    Applica un'estrazione completata dopo l'avvio del turno (modalità
+    'concurrent' o 'deferred') e ricalcola il confidence sulla fase già scelta.
 
+    Il risultato è lo stesso stato che la modalità 'inline' avrebbe salvato:
+    il turno successivo decide la fase sul confidence aggiornato.
 
-def build_agent_context(session, user_message=None):
+    Args:
+        session: ChatSession object (fase già aggiornata da apply_agent_turn)
+        updated_info: collected_info restituito dall'estrazione
+
+    Returns:
+        float: Nuovo confidence score
     """
-    Costruisce il contesto per l'agente corrente.
+    session.collected_info = updated_info
+    confidence = calculate_confidence_score(updated_info, session.agent_phase)
+    session.confidence_score = confidence
+    return confidence
+
+
+def render_agent_prompt(phase, agent_context):
+    """
+    Prepara il prompt dell'agente secondo AGENT_PROMPT_LAYOUT.
+
+    Con 'inline' il contesto della sessione è interpolato nelle istruzioni;
+    con 'prefix' le istruzioni restano statiche (prefisso cacheabile dal
+    provider) e il contesto viene restituito a parte.
 
     Args:
-        session: ChatSession object
-        user_message: Messaggio corrente dell'utente (opzionale)
+        phase: Fase dell'agente
+        agent_context: Contesto costruito da build_agent_context
 
     Returns:
-        dict: Contesto formattato per l'agente
+        tuple: (prompt di sistema, contesto di sessione o stringa vuota)
     """
-    # Trova il primo messaggio utente (prompt originale)
-    original_message = session.messages.filter(role='user').first()
-    original_prompt = original_message.content if original_message else "N/A"
+    if settings.AGENT_PROMPT_LAYOUT == 'prefix':
+        return get_agent_prompt_parts(phase, agent_context)
 
-    # Costruisci il prompt raffinato dalle info raccolte
-    refined_prompt = build_refined_prompt(session.collected_info)
+    return get_agent_prompt(phase, agent_context), ''
 
-    context = {
-        'original_prompt': original_prompt,
-        'identified_issues': session.identified_issues,
-        'collected_info': session.collected_info,
-        'iteration_count': session.iteration_count,
-        'refined_prompt': refined_prompt,
-        'confidence_score': round(session.confidence_score, 1)
-    }
 
-    return context
+def build_system_messages(agent_system_prompt, configuration, session_context=''):
+    """
+    Prepara i system message per la chiamata all'LLM.
 
+    Args:
+        agent_system_prompt: Prompt dell'agente corrente (può essere vuoto)
+        configuration: ConfigurationSnapshot (fallback per il system message)
+        session_context: Contesto di sessione separato (layout 'prefix')
 
-def build_refined_prompt(collected_info):
+    Returns:
+        list: System message in formato chat completions
     """
-    Costruisce un prompt raffinato strutturato dalle informazioni raccolte.
+    messages = []
+
+    # Usa il prompt dell'agente come system message
+    if agent_system_prompt:
+        messages.append({"role": "system", "content": agent_system_prompt})
+    else:
+        # Fallback al contesto della configurazione
+        full_context = configuration.get_full_context()
+        if full_context:
+            messages.append({"role": "system", "content": full_context})
+
+    # Il contesto di sessione segue le istruzioni statiche, così il prefisso resta identico
+    if session_context:
+        messages.append({"role": "system", "content": session_context})
+
+    return messages
+
+
+def build_chat_messages(system_messages, history, prompt, summary_message=None):
+    """
+    Prepara la lista completa dei messaggi per la chiamata all'LLM.
 
     Args:
-        collected_info: Dict con informazioni raccolte
+        system_messages: Da build_system_messages
+        history: Cronologia selezionata da pack_history (ordine cronologico)
+        prompt: Nuovo messaggio dell'utente
+        summary_message: Riassunto dei messaggi esclusi dalla cronologia (opzionale)
 
     Returns:
-        str: Prompt formattato
+        list: Messaggi in formato chat completions
     """
-    if not collected_info:
-        return ""
+    if summary_message:
+        system_messages = system_messages + [summary_message]
+    return system_messages + history + [{"role": "user", "content": prompt}]
 
-    sections = []
 
-    if collected_info.get('role'):
-        sections.append(f"**Ruolo**: {collected_info['role']}")
+def pack_turn_history(configuration, system_messages, recent_messages, prompt, agent_context):
+    """
+    Seleziona la cronologia del turno e decide se inviare il riassunto.
 
-    if collected_info.get('contesto'):
-        sections.append(f"**Contesto**: {collected_info['contesto']}")
+    Il budget riserva lo spazio per il riassunto quando esiste; il riassunto
+    viene inviato solo se qualche messaggio resta fuori dalla cronologia.
 
-    if collected_info.get('obiettivo'):
-        sections.append(f"**Obiettivo**: {collected_info['obiettivo']}")
+    Args:
+        configuration: ConfigurationSnapshot
+        system_messages: Da build_system_messages
+        recent_messages: ChatMessage dal più recente, con content_tokens valorizzato
+        prompt: Nuovo messaggio dell'utente
+        agent_context: Contesto da build_agent_context
 
-    if collected_info.get('vincoli'):
-        sections.append(f"**Vincoli**: {collected_info['vincoli']}")
+    Returns:
+        tuple: (history, summary_message o None, True se parte della cronologia è esclusa)
+    """
+    summary_message = agent_context.get('summary_message')
+    fixed_texts = [m['content'] for m in system_messages] + [prompt]
+    if summary_message:
+        fixed_texts.append(summary_message['content'])
 
-    if collected_info.get('output_format'):
-        sections.append(f"**Formato Output**: {collected_info['output_format']}")
+    budget = get_history_budget(configuration, fixed_texts)
+    history = pack_history(recent_messages, budget, configuration.model_name)
+    evicted = len(history) < len(recent_messages) or len(recent_messages) >= HISTORY_FETCH_LIMIT
 
-    return "\n".join(sections)
+    return history, summary_message if evicted else None, evicted
+
+
+def should_update_summary(session, history_evicted):
+    """True se è il turno di aggiornare il riassunto (solo se la cronologia non entra nel budget)"""
+    every = settings.SUMMARY_EVERY_N_TURNS
+    return history_evicted and every > 0 and session.iteration_count % every == 0
+
+
+def build_request_parameters(configuration):
+    """
+    Restituisce i parametri della richiesta all'LLM, inclusi i tools abilitati.
+
+    Args:
+        configuration: ConfigurationSnapshot
+
+    Returns:
+        dict: Parametri per chat.completions.create
+    """
+    params = configuration.get_api_parameters()
+
+    # Chiedi l'usage nell'ultimo chunk dello stream (token in cache inclusi)
+    if params.get('stream'):
+        params.setdefault('stream_options', {'include_usage': True})
+
+    tools = configuration.get_tools()
+    if tools:
+        params['tools'] = tools
+        logger.info(f"Tools abilitati per questa richiesta: {[t.get('type', t) for t in tools]}")
+
+    return params
+
+
+def close_upstream(response):
+    """Chiude la risposta in streaming dell'upstream: il provider smette di generare"""
+    close = getattr(response, 'close', None)
+    if close is not None:
+        close()
+
+
+async def aclose_upstream(response):
+    """Variante asincrona di close_upstream (AsyncStream.close o aclose di un generatore)"""
+    close = getattr(response, 'close', None) or getattr(response, 'aclose', None)
+    if close is not None:
+        await close()
+
+
+def add_truncated_answer(turn, configuration, next_phase, assistant_content):
+    """
+    Accoda la risposta parziale di un turno annullato per disconnessione del client.
+
+    Returns:
+        int: Token stimati non generati (max_tokens meno quelli già ricevuti)
+    """
+    generated = count_tokens(assistant_content, configuration.model_name)
+    if assistant_content:
+        turn.add_message(
+            'assistant',
+            assistant_content,
+            content_tokens=generated,
+            agent_phase=next_phase,
+            truncated=True
+        )
+    return max((configuration.max_tokens or 0) - generated, 0)
+
+
+def encode_history_cursor(message):
+    """Cursore opaco (timestamp, id) che punta dopo il messaggio indicato"""
+    raw = f"{message['timestamp'].isoformat()}|{message['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor):
+    """
+    Decodifica un cursore di encode_history_cursor.
+
+    Returns:
+        tuple: (timestamp, id)
+
+    Raises:
+        ValueError: Se il cursore non è valido
+    """
+    try:
+        timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+def get_history_etag(session, cursor, limit):
+    """
+    ETag di una pagina di cronologia.
+
+    Dipende dall'ultimo aggiornamento e dal numero di messaggi della sessione
+    (ogni turno li modifica) e dai parametri della pagina richiesta.
+    """
+    version = f"{session['pk']}:{session['updated_at'].timestamp()}:{session['message_count']}:{cursor}:{limit}"
+    return hashlib.sha1(version.encode()).hexdigest()[:20]
+
+
+# Messaggi recenti letti dal database tra cui scegliere la cronologia da inviare
+HISTORY_FETCH_LIMIT = 50
+
+# Messaggi per pagina dell'endpoint della cronologia (default e massimo)
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# Thread per le estrazioni in modalità 'concurrent' sul percorso sincrono
+_extraction_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='extraction')
 
 
 # ============================================================================
@@ -401,179 +555,706 @@ def homepage(request):
     }
     return render(request, 'homepage.html', context)
 
+def resume_stream_response(turn_id, after):
+    """
+    Risposta SSE che riprende un turno dal suo buffer (vedi home/resumable.py).
+
+    Args:
+        turn_id: ID del turno (prima parte dell'ID evento)
+        after: Numero dell'ultimo evento ricevuto dal client
+    """
+    if not resumable.is_enabled() or not resumable.buffer_exists(turn_id):
+        return JsonResponse({"error": "Stream non disponibile"}, status=404)
+
+    response = StreamingHttpResponse(resumable.replay_stream(turn_id, after), content_type="text/event-stream")
+    response['X-Trace-Id'] = turn_id
+    return response
+
+
+async def aresume_stream_response(turn_id, after):
+    """Variante asincrona di resume_stream_response (la cache non blocca l'event loop)"""
+    if not resumable.is_enabled() or not await resumable.abuffer_exists(turn_id):
+        return JsonResponse({"error": "Stream non disponibile"}, status=404)
+
+    response = StreamingHttpResponse(resumable.areplay_stream(turn_id, after), content_type="text/event-stream")
+    response['X-Trace-Id'] = turn_id
+    return response
+
+
+KEY_TOO_LONG = {"error": "Idempotency-Key troppo lunga"}
+KEY_REUSED = {"error": "Idempotency-Key già usata per una richiesta diversa"}
+
+
+def _already_processed(registered):
+    # Turno registrato ma buffer non più disponibile (o stream riprendibili disattivati)
+    return JsonResponse({"error": "Richiesta già elaborata", "trace_id": registered}, status=409)
+
+
+def _replayed(response):
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def duplicate_request_response(request, turn_id):
+    """
+    Gestisce l'header Idempotency-Key (vedi home/idempotency.py).
+
+    Args:
+        request: Richiesta POST a /api/llm
+        turn_id: ID del turno che la richiesta avvierebbe
+
+    Returns:
+        HttpResponse per una richiesta duplicata o non valida,
+        None se la richiesta deve avviare il turno turn_id
+    """
+    key = request.headers.get(idempotency.HEADER)
+    if not key:
+        return None
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        return JsonResponse(KEY_TOO_LONG, status=400)
+
+    try:
+        registered = idempotency.lookup(key, request.body)
+        if registered is None:
+            if resumable.is_enabled():
+                resumable.open_buffer(turn_id)
+            registered = idempotency.claim(key, request.body, turn_id)
+    except idempotency.KeyReused:
+        return JsonResponse(KEY_REUSED, status=422)
+
+    if registered == turn_id:
+        return None
+
+    # Duplicato: nessun nuovo turno, gli eventi arrivano dal buffer del turno registrato
+    logger.info(f"Richiesta duplicata (Idempotency-Key): agganciata al turno {registered}")
+    if not resumable.is_enabled() or not resumable.buffer_exists(registered):
+        return _already_processed(registered)
+    return _replayed(resume_stream_response(registered, 0))
+
+
+async def aduplicate_request_response(request, turn_id):
+    """Variante asincrona di duplicate_request_response (API asincrone della cache)"""
+    key = request.headers.get(idempotency.HEADER)
+    if not key:
+        return None
+    if len(key) > idempotency.MAX_KEY_LENGTH:
+        return JsonResponse(KEY_TOO_LONG, status=400)
+
+    try:
+        registered = await idempotency.alookup(key, request.body)
+        if registered is None:
+            if resumable.is_enabled():
+                await resumable.aopen_buffer(turn_id)
+            registered = await idempotency.aclaim(key, request.body, turn_id)
+    except idempotency.KeyReused:
+        return JsonResponse(KEY_REUSED, status=422)
+
+    if registered == turn_id:
+        return None
+
+    logger.info(f"Richiesta duplicata (Idempotency-Key): agganciata al turno {registered}")
+    if not resumable.is_enabled() or not await resumable.abuffer_exists(registered):
+        return _already_processed(registered)
+    return _replayed(await aresume_stream_response(registered, 0))
+
+
+def resume_llm_stream(request, turn_id):
+    """
+    Riprende lo stream di un turno (GET, es: riconnessione di EventSource).
+
+    L'ultimo evento ricevuto arriva nell'header Last-Event-ID o nel parametro last_event_id.
+    """
+    last_turn_id, after = resumable.parse_event_id(
+        request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    )
+    if last_turn_id not in (None, turn_id):
+        return JsonResponse({"error": "Last-Event-ID di un altro turno"}, status=400)
+    return resume_stream_response(turn_id, after)
+
+
 @csrf_exempt
 def llm_api(request):
     """API endpoint per le richieste LLM con configurazioni personalizzate"""
     if request.method != "POST":
         return JsonResponse({"error": "Metodo non consentito"}, status=405)
 
+    # Riconnessione di un client che ha perso lo stream: nessuna nuova chiamata all'LLM
+    turn_id, after = resumable.parse_event_id(request.headers.get('Last-Event-ID'))
+    if turn_id:
+        return resume_stream_response(turn_id, after)
+
+    started = time.perf_counter()
+    trace = Trace()
+
     try:
         data = json.loads(request.body)
         prompt = data.get("prompt", "")
         configuration_id = data.get("configuration_id")
         session_id = data.get("session_id")
         
-        # Ottieni la configurazione
-        if configuration_id:
-            configuration = get_object_or_404(LLMConfiguration, id=configuration_id, is_active=True)
-        else:
-            # Usa la configurazione predefinita
-            configuration = LLMConfiguration.objects.filter(is_default=True, is_active=True).first()
-            if not configuration:
-                configuration = LLMConfiguration.objects.filter(is_active=True).first()
-                if not configuration:
-                    return JsonResponse({"error": "Nessuna configurazione LLM disponibile"}, status=400)
-        
+        # Ottieni la configurazione (snapshot in memoria, senza query dopo il primo turno)
+        with trace.span('configuration'):
+            configuration = get_configuration_snapshot(configuration_id)
+        if not configuration:
+            if configuration_id:
+                raise Http404("Configurazione LLM non trovata")
+            return JsonResponse({"error": "Nessuna configurazione LLM disponibile"}, status=400)
+
         logger.info(f"Richiesta LLM: config={configuration.name}, prompt_length={len(prompt)}")
+        turn_metrics = TurnMetrics(configuration, started)
 
         # Gestisci la sessione di chat
+        session = None
         if session_id:
-            try:
-                session = ChatSession.objects.get(session_id=session_id)
-            except ChatSession.DoesNotExist:
-                session = None
-        else:
-            session = None
-            
+            with trace.span('session_lookup'):
+                session = ChatSession.objects.filter(session_id=session_id).first()
+
         if not session:
-            session = ChatSession.objects.create(
+            # La nuova sessione viene inserita a fine turno insieme ai messaggi
+            session = ChatSession(
                 session_id=str(uuid.uuid4()),
-                configuration=configuration,
-                user=request.user if request.user.is_authenticated else None
+                configuration_id=configuration.pk,
+                user=request.user if request.user.is_authenticated else None,
+                original_prompt=prompt
             )
 
+        # Stessa Idempotency-Key di una richiesta già ricevuta: si aggancia al suo turno
+        duplicate = duplicate_request_response(request, trace.trace_id)
+        if duplicate is not None:
+            return duplicate
+
+        turn = TurnPersistence(session)
+        trace.set(session_id=session.session_id, configuration=configuration.name)
+        # Buffer per la ripresa dello stream (None se gli stream riprendibili sono disabilitati)
+        buffer = resumable.TurnStreamBuffer(trace.trace_id) if resumable.is_enabled() else None
+
         def stream():
+            user_message = None
+            encoder = SSEEncoder()
+            # True mentre la risposta dell'upstream è aperta (annullabile alla disconnessione)
+            streaming = False
+
+            def save_cancelled_turn():
+                # Chiude la connessione con il provider, che smette di generare, e salva la risposta parziale
+                close_upstream(response)
+                if pending_extraction is not None:
+                    pending_extraction.cancel()
+                saved_tokens = add_truncated_answer(turn, configuration, next_phase, assistant_content)
+                apply_extraction_usage(user_message, extraction_usage)
+                trace.set(cancelled=True)
+                user_message.trace = trace.summary()
+                try:
+                    turn.commit()
+                except Exception as commit_error:
+                    logger.error(f"Errore salvataggio turno: {str(commit_error)}")
+                turn_metrics.cancelled(saved_tokens)
+                trace.finish()
+                logger.info(f"Session {session.session_id}: client disconnesso, generazione annullata (~{saved_tokens} token risparmiati)")
+
             try:
-                # Invia session_id e fase agente come primo messaggio
-                yield "data: " + json.dumps({
+                # Invia session_id, trace_id e fase agente come primo messaggio
+                yield sse_data({
                     "session_id": session.session_id,
+                    "trace_id": trace.trace_id,
                     "content": "",
                     "agent_phase": session.agent_phase
-                }) + "\n\n"
+                })
 
                 # ============================================================================
                 # SISTEMA AGENTI - Logica di orchestrazione
                 # ============================================================================
 
                 # Determina la fase successiva in base allo stato della sessione
-                next_phase = determine_next_phase(session, prompt)
+                with trace.span('determine_next_phase'):
+                    next_phase = determine_next_phase(session, prompt)
+                turn_metrics.start_phase(next_phase)
 
                 # Estrai informazioni dalla risposta dell'utente (se non è la prima iterazione)
-                if session.iteration_count > 0:
-                    updated_info = extract_info_from_response(
-                        prompt,
-                        session.agent_phase,
-                        session.collected_info,
-                        configuration  # Passa la configurazione per l'estrazione LLM
-                    )
-                    session.collected_info = updated_info
-
-                # Calcola il confidence score basato sulle info raccolte
-                confidence = calculate_confidence_score(session.collected_info, next_phase)
-                session.confidence_score = confidence
-
-                # Incrementa il contatore di iterazioni
-                session.iteration_count += 1
-
-                # Aggiorna la fase
-                session.agent_phase = next_phase
-                session.save()
+                # In modalità 'concurrent' l'estrazione parte in background e viene
+                # applicata a fine stream; in 'deferred' parte solo a fine stream
+                extraction_mode = settings.EXTRACTION_MODE
+                needs_extraction = session.iteration_count > 0
+                extraction_args = (prompt, session.agent_phase, session.collected_info, configuration)
+                updated_info = None
+                extraction_usage = None
+                pending_extraction = None
+                if needs_extraction:
+                    if extraction_mode == 'concurrent':
+                        pending_extraction = _extraction_executor.submit(extract_info_from_response, *extraction_args)
+                    elif extraction_mode != 'deferred':
+                        with trace.span('extraction', mode=extraction_mode):
+                            updated_info, extraction_usage = extract_info_from_response(*extraction_args)
+
+                confidence = apply_agent_turn(session, next_phase, updated_info)
+                turn.update_session(*AGENT_STATE_FIELDS)
+                trace.set(phase=next_phase, turn=session.iteration_count)
 
                 # Log per debugging
                 logger.info(f"Session {session.session_id}: Phase={next_phase}, Confidence={confidence:.1f}%, Info={list(session.collected_info.keys())}")
 
                 # Invia aggiornamento di fase e confidence al frontend
-                yield "data: " + json.dumps({
+                yield sse_data({
                     "agent_phase": next_phase,
                     "confidence_score": round(confidence, 1),
                     "content": ""
-                }) + "\n\n"
+                })
 
-                # Costruisci il contesto per l'agente
-                agent_context = build_agent_context(session, prompt)
+                # Messaggi recenti (una sola query, indice session/timestamp)
+                recent_messages = []
+                if not session._state.adding:
+                    with trace.span('history'):
+                        recent_messages = list(session.messages.order_by('-timestamp', '-id')[:HISTORY_FETCH_LIMIT])
+                        counted = fill_token_counts(recent_messages, configuration.model_name)
+                        if counted:
+                            ChatMessage.objects.bulk_update(counted, ['content_tokens'])
 
-                # Ottieni il prompt specifico per l'agente corrente
-                agent_system_prompt = get_agent_prompt(next_phase, agent_context)
+                with trace.span('agent_prompt'):
+                    # Costruisci il contesto per l'agente
+                    agent_context = build_agent_context(session, prompt)
 
-                # ============================================================================
-                # Prepara i messaggi per la conversazione
-                # ============================================================================
-                messages = []
+                    # Ottieni il prompt specifico per l'agente corrente
+                    agent_system_prompt, session_context = render_agent_prompt(next_phase, agent_context)
 
-                # Usa il prompt dell'agente come system message
-                if agent_system_prompt:
-                    messages.append({"role": "system", "content": agent_system_prompt})
-                else:
-                    # Fallback al contesto della configurazione
-                    full_context = configuration.get_full_context()
-                    if full_context:
-                        messages.append({"role": "system", "content": full_context})
-
-                # Aggiungi la cronologia della conversazione (ultimi 6 messaggi per mantenere contesto ma limitare token)
-                previous_messages = session.messages.all().order_by('-timestamp')[:6]
-                previous_messages = reversed(list(previous_messages))  # Riordina cronologicamente
-                for msg in previous_messages:
-                    messages.append({"role": msg.role, "content": msg.content})
-
-                # Aggiungi il nuovo messaggio dell'utente
-                messages.append({"role": "user", "content": prompt})
-
-                # Salva il messaggio dell'utente
-                user_message = ChatMessage.objects.create(
-                    session=session,
-                    role='user',
-                    content=prompt
-                )
-
-                # Ottieni i parametri dalla configurazione
-                params = configuration.get_api_parameters()
-                client_config = configuration.get_client_config()
+                    system_messages = build_system_messages(agent_system_prompt, configuration, session_context)
 
-                # Ottieni i tools abilitati
-                tools = configuration.get_tools()
-                if tools:
-                    params['tools'] = tools
-                    logger.info(f"Tools abilitati per questa richiesta: {[t.get('type', t) for t in tools]}")
+                    # Cronologia della conversazione: i messaggi più recenti che entrano nel budget di token
+                    history, summary_message, history_evicted = pack_turn_history(
+                        configuration, system_messages, recent_messages, prompt, agent_context
+                    )
 
-                # Configura il client OpenAI (supporta anche API custom)
-                client = OpenAI(**client_config)
+                    messages = build_chat_messages(system_messages, history, prompt, summary_message)
 
-                response = client.chat.completions.create(
-                    messages=messages,
-                    **params
+                # Il messaggio dell'utente viene salvato con il resto del turno
+                user_message = turn.add_message(
+                    'user',
+                    prompt,
+                    content_tokens=count_tokens(prompt, configuration.model_name),
+                    agent_phase=next_phase
                 )
 
-                assistant_content = ""
+                # Ottieni i parametri dalla configurazione (inclusi i tools abilitati)
+                params = build_request_parameters(configuration)
 
-                for chunk in response:
-                    if chunk.choices and len(chunk.choices) > 0:
-                        delta = chunk.choices[0].delta
-                        if hasattr(delta, 'content') and delta.content:
-                            assistant_content += delta.content
-                            yield "data: " + json.dumps({"content": delta.content}) + "\n\n"
+                # Turno di analisi senza cronologia: la risposta può venire dalla cache (vedi home/response_cache.py)
+                response_cache_key = None
+                cached_content = None
+                if response_cache.is_cacheable(configuration, next_phase, history, params):
+                    response_cache_key = response_cache.get_response_cache_key(
+                        next_phase, system_messages, prompt, configuration.model_name, params
+                    )
+                    cached_content = response_cache.get_cached_response(response_cache_key, configuration, next_phase)
+                    trace.set(response_cache='hit' if cached_content is not None else 'miss')
+
+                if cached_content is not None:
+                    # Stessa risposta già generata per questo prompt: nessuna chiamata all'LLM
+                    response = response_cache.replay_chunks(cached_content)
+                else:
+                    # Client OpenAI condiviso dal registry (supporta anche API custom)
+                    client = get_client(configuration)
 
-                # Salva la risposta dell'assistente
+                    # Fino alla risposta HTTP dell'upstream (connessione e intestazioni)
+                    with trace.span('upstream_connect'):
+                        response = client.chat.completions.create(
+                            messages=messages,
+                            **params
+                        )
+
+                assistant_content = ""
+                usage = None
+                streaming = True
+                if buffer is not None:
+                    # Il timer di annullamento chiude la risposta anche se l'upstream non produce chunk
+                    buffer.watch_upstream(lambda: close_upstream(response))
+
+                # I delta vengono accorpati in frame (vedi home/sse.py)
+                with trace.span('stream'):
+                    for chunk in response:
+                        if chunk.choices and len(chunk.choices) > 0:
+                            delta = chunk.choices[0].delta
+                            if hasattr(delta, 'content') and delta.content:
+                                turn_metrics.first_token()
+                                assistant_content += delta.content
+                                frame = encoder.content(delta.content)
+                                if frame:
+                                    yield frame
+                        if getattr(chunk, 'usage', None):
+                            usage = read_usage(chunk.usage)
+                    frame = encoder.flush()
+                    if frame:
+                        yield frame
+                if buffer is not None and buffer.cancelled:
+                    # Risposta chiusa dal timer di annullamento mentre si attendeva un chunk
+                    save_cancelled_turn()
+                    return
+                streaming = False
+
+                if response_cache_key and cached_content is None and assistant_content:
+                    response_cache.set_cached_response(response_cache_key, assistant_content)
+
+                if usage:
+                    record_prompt_cache_usage(next_phase, configuration, usage)
+
+                # Risposta dell'assistente
                 if assistant_content:
-                    ChatMessage.objects.create(
-                        session=session,
-                        role='assistant',
-                        content=assistant_content
+                    turn.add_message(
+                        'assistant',
+                        assistant_content,
+                        content_tokens=count_tokens(assistant_content, configuration.model_name),
+                        agent_phase=next_phase,
+                        **agent_usage_fields(usage)
                     )
 
+                # Applica l'estrazione fuori dal percorso critico
+                extraction_applied = False
+                if needs_extraction and updated_info is None:
+                    # In modalità concurrent lo span misura solo l'attesa residua a fine stream
+                    with trace.span('extraction', mode=extraction_mode):
+                        if pending_extraction is not None:
+                            updated_info, extraction_usage = pending_extraction.result()
+                        else:
+                            updated_info, extraction_usage = extract_info_from_response(*extraction_args)
+                    confidence = apply_extracted_info(session, updated_info)
+                    turn.update_session('collected_info', 'confidence_score')
+                    extraction_applied = True
+                    logger.info(f"Session {session.session_id}: extraction ({extraction_mode}) applied, Confidence={confidence:.1f}%")
+
+                # Token della chiamata di estrazione sul messaggio utente analizzato
+                apply_extraction_usage(user_message, extraction_usage)
+
+                # Salva l'intero turno in un'unica transazione (con il riepilogo del trace)
+                user_message.trace = trace.summary()
+                with trace.span('persistence'):
+                    turn.commit()
+                turn_metrics.finish(usage)
+                trace.finish()
+
+                # Aggiorna in background il riassunto delle conversazioni lunghe
+                if should_update_summary(session, history_evicted):
+                    schedule_summary_update(session.pk)
+
+                if extraction_applied:
+                    yield encoder.event({
+                        "agent_phase": session.agent_phase,
+                        "confidence_score": round(confidence, 1),
+                        "content": ""
+                    })
+
                 yield "data: [DONE]\n\n"
 
+            except GeneratorExit:
+                # Client disconnesso (close() del generatore)
+                if streaming:
+                    save_cancelled_turn()
+                raise
+
             except Exception as e:
+                if streaming and buffer is not None and buffer.cancelled:
+                    # Lettura interrotta dalla chiusura della risposta da parte del timer di annullamento
+                    save_cancelled_turn()
+                    return
                 logger.error(f"Errore durante streaming: {str(e)}")
-                yield "data: " + json.dumps({"content": f"Errore: {str(e)}"}) + "\n\n"
+                turn_metrics.error('stream')
+                trace.set(error=str(e))
+                # Salva comunque stato della sessione e messaggio utente
+                if user_message is not None:
+                    user_message.trace = trace.summary()
+                try:
+                    turn.commit()
+                except Exception as commit_error:
+                    logger.error(f"Errore salvataggio turno: {str(commit_error)}")
+                trace.finish()
+                yield encoder.event({"content": f"Errore: {str(e)}"})
                 yield "data: [DONE]\n\n"
 
-        return StreamingHttpResponse(stream(), content_type="text/event-stream")
+        # Eventi con ID e buffer per la ripresa; il turno prosegue anche se il client si disconnette
+        events = stream()
+        if buffer is not None:
+            events = resumable.relay_stream(events, buffer)
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response['X-Trace-Id'] = trace.trace_id
+        return response
         
     except json.JSONDecodeError:
         logger.error("Errore parsing JSON")
         return JsonResponse({"error": "JSON non valido"}, status=400)
     except Exception as e:
         logger.error(f"Errore generico: {str(e)}")
+        observe_error(None, None, 'request')
+        return JsonResponse({"error": str(e)}, status=500)
+
+@csrf_exempt
+async def llm_api_async(request):
+    """
+    Variante asincrona di llm_api per lo stack ASGI.
+
+    Usa AsyncOpenAI e l'ORM asincrono: durante lo streaming non occupa un thread
+    del worker, quindi un singolo processo può servire molte sessioni in parallelo.
+    Il protocollo SSE è identico a quello di llm_api.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Metodo non consentito"}, status=405)
+
+    turn_id, after = resumable.parse_event_id(request.headers.get('Last-Event-ID'))
+    if turn_id:
+        return await aresume_stream_response(turn_id, after)
+
+    started = time.perf_counter()
+    trace = Trace()
+
+    try:
+        data = json.loads(request.body)
+        prompt = data.get("prompt", "")
+        configuration_id = data.get("configuration_id")
+        session_id = data.get("session_id")
+
+        # Ottieni la configurazione (snapshot in memoria, senza query dopo il primo turno)
+        with trace.span('configuration'):
+            configuration = await aget_configuration_snapshot(configuration_id)
+        if not configuration:
+            if configuration_id:
+                raise Http404("Configurazione LLM non trovata")
+            return JsonResponse({"error": "Nessuna configurazione LLM disponibile"}, status=400)
+
+        logger.info(f"Richiesta LLM (async): config={configuration.name}, prompt_length={len(prompt)}")
+        turn_metrics = TurnMetrics(configuration, started)
+
+        # Gestisci la sessione di chat
+        session = None
+        if session_id:
+            with trace.span('session_lookup'):
+                session = await ChatSession.objects.filter(session_id=session_id).afirst()
+
+        if not session:
+            user = await request.auser()
+            session = ChatSession(
+                session_id=str(uuid.uuid4()),
+                configuration_id=configuration.pk,
+                user=user if user.is_authenticated else None,
+                original_prompt=prompt
+            )
+
+        duplicate = await aduplicate_request_response(request, trace.trace_id)
+        if duplicate is not None:
+            return duplicate
+
+        turn = TurnPersistence(session)
+        trace.set(session_id=session.session_id, configuration=configuration.name)
+
+        async def stream():
+            user_message = None
+            encoder = SSEEncoder()
+            streaming = False
+            chunks = None
+            try:
+                yield sse_data({
+                    "session_id": session.session_id,
+                    "trace_id": trace.trace_id,
+                    "content": "",
+                    "agent_phase": session.agent_phase
+                })
+
+                with trace.span('determine_next_phase'):
+                    next_phase = determine_next_phase(session, prompt)
+                turn_metrics.start_phase(next_phase)
+
+                extraction_mode = settings.EXTRACTION_MODE
+                needs_extraction = session.iteration_count > 0
+                extraction_args = (prompt, session.agent_phase, session.collected_info, configuration)
+                updated_info = None
+                extraction_usage = None
+                pending_extraction = None
+                if needs_extraction:
+                    if extraction_mode == 'concurrent':
+                        pending_extraction = asyncio.create_task(aextract_info_from_response(*extraction_args))
+                    elif extraction_mode != 'deferred':
+                        with trace.span('extraction', mode=extraction_mode):
+                            updated_info, extraction_usage = await aextract_info_from_response(*extraction_args)
+
+                confidence = apply_agent_turn(session, next_phase, updated_info)
+                turn.update_session(*AGENT_STATE_FIELDS)
+                trace.set(phase=next_phase, turn=session.iteration_count)
+
+                logger.info(f"Session {session.session_id}: Phase={next_phase}, Confidence={confidence:.1f}%, Info={list(session.collected_info.keys())}")
+
+                yield sse_data({
+                    "agent_phase": next_phase,
+                    "confidence_score": round(confidence, 1),
+                    "content": ""
+                })
+
+                recent_messages = []
+                if not session._state.adding:
+                    with trace.span('history'):
+                        recent_messages = [
+                            msg async for msg in session.messages.order_by('-timestamp', '-id')[:HISTORY_FETCH_LIMIT]
+                        ]
+                        counted = fill_token_counts(recent_messages, configuration.model_name)
+                        if counted:
+                            await ChatMessage.objects.abulk_update(counted, ['content_tokens'])
+
+                with trace.span('agent_prompt'):
+                    agent_context = build_agent_context(session, prompt)
+                    agent_system_prompt, session_context = render_agent_prompt(next_phase, agent_context)
+
+                    system_messages = build_system_messages(agent_system_prompt, configuration, session_context)
+
+                    history, summary_message, history_evicted = pack_turn_history(
+                        configuration, system_messages, recent_messages, prompt, agent_context
+                    )
+
+                    messages = build_chat_messages(system_messages, history, prompt, summary_message)
+
+                user_message = turn.add_message(
+                    'user',
+                    prompt,
+                    content_tokens=count_tokens(prompt, configuration.model_name),
+                    agent_phase=next_phase
+                )
+
+                params = build_request_parameters(configuration)
+
+                response_cache_key = None
+                cached_content = None
+                if response_cache.is_cacheable(configuration, next_phase, history, params):
+                    response_cache_key = response_cache.get_response_cache_key(
+                        next_phase, system_messages, prompt, configuration.model_name, params
+                    )
+                    cached_content = await response_cache.aget_cached_response(response_cache_key, configuration, next_phase)
+                    trace.set(response_cache='hit' if cached_content is not None else 'miss')
+
+                if cached_content is not None:
+                    response = response_cache.areplay_chunks(cached_content)
+                else:
+                    client = get_async_client(configuration)
+
+                    with trace.span('upstream_connect'):
+                        response = await client.chat.completions.create(
+                            messages=messages,
+                            **params
+                        )
+
+                assistant_content = ""
+                usage = None
+                streaming = True
+
+                with trace.span('stream'):
+                    chunks = iterate_with_flush(response, encoder)
+                    async for chunk in chunks:
+                        if chunk is None:
+                            # L'upstream tace da SSE_COALESCE_MS: invia il contenuto accumulato
+                            yield encoder.flush()
+                            continue
+                        if chunk.choices and len(chunk.choices) > 0:
+                            delta = chunk.choices[0].delta
+                            if hasattr(delta, 'content') and delta.content:
+                                turn_metrics.first_token()
+                                assistant_content += delta.content
+                                frame = encoder.content(delta.content)
+                                if frame:
+                                    yield frame
+                        if getattr(chunk, 'usage', None):
+                            usage = read_usage(chunk.usage)
+                    frame = encoder.flush()
+                    if frame:
+                        yield frame
+                streaming = False
+
+                if response_cache_key and cached_content is None and assistant_content:
+                    await response_cache.aset_cached_response(response_cache_key, assistant_content)
+
+                if usage:
+                    record_prompt_cache_usage(next_phase, configuration, usage)
+
+                if assistant_content:
+                    turn.add_message(
+                        'assistant',
+                        assistant_content,
+                        content_tokens=count_tokens(assistant_content, configuration.model_name),
+                        agent_phase=next_phase,
+                        **agent_usage_fields(usage)
+                    )
+
+                extraction_applied = False
+                if needs_extraction and updated_info is None:
+                    with trace.span('extraction', mode=extraction_mode):
+                        if pending_extraction is not None:
+                            updated_info, extraction_usage = await pending_extraction
+                        else:
+                            updated_info, extraction_usage = await aextract_info_from_response(*extraction_args)
+                    confidence = apply_extracted_info(session, updated_info)
+                    turn.update_session('collected_info', 'confidence_score')
+                    extraction_applied = True
+                    logger.info(f"Session {session.session_id}: extraction ({extraction_mode}) applied, Confidence={confidence:.1f}%")
+
+                apply_extraction_usage(user_message, extraction_usage)
+
+                user_message.trace = trace.summary()
+                with trace.span('persistence'):
+                    await turn.acommit()
+                turn_metrics.finish(usage)
+                await trace.afinish()
+
+                if should_update_summary(session, history_evicted):
+                    schedule_summary_update(session.pk)
+
+                if extraction_applied:
+                    yield encoder.event({
+                        "agent_phase": session.agent_phase,
+                        "confidence_score": round(confidence, 1),
+                        "content": ""
+                    })
+
+                yield "data: [DONE]\n\n"
+
+            except (GeneratorExit, asyncio.CancelledError):
+                # Client disconnesso: aclose() del generatore o cancellazione del task
+                # della risposta da parte dell'handler ASGI
+                if streaming:
+                    if chunks is not None:
+                        await chunks.aclose()
+                    await aclose_upstream(response)
+                    if pending_extraction is not None:
+                        pending_extraction.cancel()
+                    saved_tokens = add_truncated_answer(turn, configuration, next_phase, assistant_content)
+                    apply_extraction_usage(user_message, extraction_usage)
+                    trace.set(cancelled=True)
+                    user_message.trace = trace.summary()
+                    try:
+                        await turn.acommit()
+                    except Exception as commit_error:
+                        logger.error(f"Errore salvataggio turno: {str(commit_error)}")
+                    turn_metrics.cancelled(saved_tokens)
+                    await trace.afinish()
+                    logger.info(f"Session {session.session_id}: client disconnesso, generazione annullata (~{saved_tokens} token risparmiati)")
+                raise
+
+            except Exception as e:
+                logger.error(f"Errore durante streaming (async): {str(e)}")
+                turn_metrics.error('stream')
+                trace.set(error=str(e))
+                if user_message is not None:
+                    user_message.trace = trace.summary()
+                try:
+                    await turn.acommit()
+                except Exception as commit_error:
+                    logger.error(f"Errore salvataggio turno: {str(commit_error)}")
+                await trace.afinish()
+                yield encoder.event({"content": f"Errore: {str(e)}"})
+                yield "data: [DONE]\n\n"
+
+        events = stream()
+        if resumable.is_enabled():
+            events = resumable.arelay_stream(events, resumable.TurnStreamBuffer(trace.trace_id))
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response['X-Trace-Id'] = trace.trace_id
+        return response
+
+    except json.JSONDecodeError:
+        logger.error("Errore parsing JSON")
+        return JsonResponse({"error": "JSON non valido"}, status=400)
+    except Exception as e:
+        logger.error(f"Errore generico: {str(e)}")
+        observe_error(None, None, 'request')
         return JsonResponse({"error": str(e)}, status=500)
 
 def get_configurations(request):
@@ -584,12 +1265,126 @@ def get_configurations(request):
     return JsonResponse(list(configurations), safe=False)
 
 def get_session_history(request, session_id):
-    """API endpoint per ottenere la cronologia di una sessione"""
+    """
+    API endpoint per ottenere la cronologia di una sessione.
+
+    Paginazione keyset in ordine cronologico: ?limit=N (massimo HISTORY_MAX_PAGE_SIZE)
+    e ?cursor=<next_cursor della pagina precedente>. Con If-None-Match o
+    If-Modified-Since una cronologia invariata risponde 304 leggendo solo la
+    riga della sessione.
+    """
+    session = ChatSession.objects.filter(session_id=session_id).values(
+        'pk', 'updated_at', 'message_count'
+    ).first()
+    if session is None:
+        return JsonResponse({"error": "Sessione non trovata"}, status=404)
+
+    cursor = request.GET.get("cursor") or None
     try:
-        session = ChatSession.objects.get(session_id=session_id)
-        messages = session.messages.all().order_by('timestamp').values(
-            'role', 'content', 'timestamp'
+        limit = min(int(request.GET.get("limit", HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+        after = decode_history_cursor(cursor) if cursor else None
+    except ValueError:
+        return JsonResponse({"error": "Parametri limit o cursor non validi"}, status=400)
+    if limit < 1:
+        return JsonResponse({"error": "Parametri limit o cursor non validi"}, status=400)
+
+    etag = quote_etag(get_history_etag(session, cursor, limit))
+    last_modified = timegm(session['updated_at'].utctimetuple())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        messages = ChatMessage.objects.filter(session_id=session['pk'])
+        if after:
+            timestamp, message_id = after
+            messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+        messages = list(
+            messages.order_by('timestamp', 'id').values('id', 'role', 'content', 'timestamp', 'truncated')[:limit + 1]
         )
-        return JsonResponse(list(messages), safe=False)
-    except ChatSession.DoesNotExist:
-        return JsonResponse({"error": "Sessione non trovata"}, status=404)
+
+        next_cursor = encode_history_cursor(messages[limit - 1]) if len(messages) > limit else None
+        response = JsonResponse({
+            "session_id": session_id,
+            "messages": [
+                {'role': m['role'], 'content': m['content'], 'timestamp': m['timestamp'], 'truncated': m['truncated']}
+                for m in messages[:limit]
+            ],
+            "next_cursor": next_cursor,
+        })
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Il browser può tenere la risposta ma deve sempre rivalidarla
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def search_chat_messages(request):
+    """
+    API endpoint per la ricerca full-text nei messaggi.
+
+    Query string: q (testo), page, page_size, session_id (opzionale).
+    Lo staff cerca in tutte le sessioni; gli altri utenti solo nella sessione
+    indicata da session_id, come per la cronologia.
+    """
+    query = request.GET.get("q", "").strip()
+    if not query:
+        return JsonResponse({"error": "Parametro q obbligatorio"}, status=400)
+
+    try:
+        page = int(request.GET.get("page", 1))
+        page_size = int(request.GET.get("page_size", 20))
+    except ValueError:
+        return JsonResponse({"error": "page e page_size devono essere numeri"}, status=400)
+
+    session_pk = None
+    session_id = request.GET.get("session_id")
+    if session_id:
+        session_pk = ChatSession.objects.filter(session_id=session_id).values_list('pk', flat=True).first()
+        if session_pk is None:
+            return JsonResponse({"error": "Sessione non trovata"}, status=404)
+    elif not request.user.is_staff:
+        return JsonResponse({"error": "session_id obbligatorio"}, status=403)
+
+    results, has_next = search_messages(query, page, page_size, session_pk)
+    return JsonResponse({
+        "query": query,
+        "page": page,
+        "has_next": has_next,
+        "results": results,
+    })
+
+def get_token_usage(request):
+    """
+    API endpoint (solo staff) con i token spesi per configurazione e per fase,
+    i token letti dalla cache del provider per fase e la ripartizione delle
+    estrazioni per livello (contatori del processo) con hit e miss della cache
+    di estrazione.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Accesso riservato allo staff"}, status=403)
+
+    return JsonResponse({
+        "by_configuration": get_token_usage_by_configuration(),
+        "by_phase": get_token_usage_by_phase(),
+        "prompt_cache": get_prompt_cache_stats(),
+        "extraction_tiers": get_extraction_tier_stats(),
+        "extraction_cache": get_extraction_cache_stats(),
+    })
+
+def metrics(request):
+    """
+    Endpoint Prometheus (formato testo) con le metriche di /api/llm.
+
+    Se METRICS_TOKEN è impostato richiede l'header Authorization: Bearer <token>.
+    """
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse("Unauthorized\n", status=401, content_type="text/plain")
+
+    if not metrics_available():
+        return HttpResponse(
+            "prometheus-client non installato (pip install prometheus-client)\n",
+            status=503, content_type="text/plain"
+        )
+
+    content, content_type = render_metrics()
+    return HttpResponse(content, content_type=content_type)